@@ -0,0 +1,91 @@
+"""
+Live tailing of activity feed errors and console output for in-flight sandboxes
+called on every poll so errors are reported as they happen, not scanned for after setup / teardown finishes
+"""
+from time import sleep
+
+from common import get_utc_timestamp, cap_error_events
+from sb_rest.sandbox_rest_api import SandboxRest
+
+DEFAULT_CONSOLE_TAIL_LINES = 20
+# error events can reach the feed just after the state change that ends a phase
+FINAL_SETTLE_SECONDS = 3
+
+
+class ActivityTailer(object):
+    def __init__(self, sb_rest, logger, console_tail_lines=DEFAULT_CONSOLE_TAIL_LINES):
+        """
+        each sandbox is only tailed by one worker at a time, so per-sandbox state needs no lock
+        :param SandboxRest sb_rest:
+        :param logging.Logger logger:
+        :param int console_tail_lines: console entries fetched per poll, 0 to skip console output
+        """
+        self._sb_rest = sb_rest
+        self._logger = logger
+        self._console_tail_lines = console_tail_lines
+        self._errors = {}
+        self._last_console_ids = {}
+        self._stages = {}
+
+    def tail(self, sandbox_id, stage=None):
+        """
+        read only what is new since the last poll of this sandbox
+        :param str sandbox_id:
+        :param str stage: current setup_stage - new errors are attributed to it, None for teardown
+        :return: new error events
+        """
+        if stage and self._stages.get(sandbox_id) != stage:
+            self._stages[sandbox_id] = stage
+            self._logger.info("Sandbox {} entered stage '{}' at {}".format(sandbox_id, stage, get_utc_timestamp()))
+
+        new_errors = list(self._sb_rest.read_new_activity(sandbox_id, error_only=True))
+        for event in new_errors:
+            self._logger.error("Live error on sandbox {}, stage '{}': {}".format(sandbox_id, stage or "teardown",
+                                                                               event.get("event_text")))
+        if new_errors:
+            self._errors[sandbox_id] = cap_error_events(self._errors.get(sandbox_id, []) + new_errors)
+
+        if self._console_tail_lines:
+            self._tail_console(sandbox_id)
+        return new_errors
+
+    def _tail_console(self, sandbox_id):
+        """
+        console output has no cursor param - fetch last N entries and log the ones after the last seen id
+        best effort - a failed read is logged and the next poll tries again
+        :param str sandbox_id:
+        """
+        try:
+            entries = self._sb_rest.get_console_output(sandbox_id, tail=self._console_tail_lines)
+        except Exception as e:
+            self._logger.warning("Console output of sandbox {} not read: {}".format(sandbox_id, str(e)))
+            return
+        if not entries:
+            return
+        entry_ids = [entry["id"] for entry in entries]
+        last_seen_id = self._last_console_ids.get(sandbox_id)
+        new_entries = entries[entry_ids.index(last_seen_id) + 1:] if last_seen_id in entry_ids else entries
+        for entry in new_entries:
+            self._logger.info("Console {} [{}]: {}".format(sandbox_id, entry.get("time"), entry.get("text")))
+        self._last_console_ids[sandbox_id] = entry_ids[-1]
+
+    def finish(self, sandbox_id, stage=None):
+        """
+        last read of a sandbox that reached Ready / Error / Ended - waits for late events, then hands over its errors
+        :param str sandbox_id:
+        :param str stage: see tail
+        :return: list of error events, None if there were none
+        """
+        sleep(FINAL_SETTLE_SECONDS)
+        self.tail(sandbox_id, stage)
+        return self.pop_errors(sandbox_id)
+
+    def pop_errors(self, sandbox_id):
+        """
+        hand over errors collected for a finished sandbox and drop its tail state
+        :param str sandbox_id:
+        :return: list of error events, None if there were none
+        """
+        self._last_console_ids.pop(sandbox_id, None)
+        self._stages.pop(sandbox_id, None)
+        return self._errors.pop(sandbox_id, None)
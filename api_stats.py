@@ -0,0 +1,193 @@
+"""
+Default SandboxRest instrumentation hook - per endpoint counters and latency histograms
+tells server time (ttfb) apart from client side time (rate budget / backoff wait, dns, connect)
+
+every thread records into its own shard, so the request path takes no lock
+shards are only merged when a summary is read
+"""
+import threading
+from collections import OrderedDict
+from time import time
+
+from latency import LatencyHistogram
+from sb_rest.instrumentation import ApiCallRecord
+
+DEFAULT_SUMMARY_INTERVAL_SECONDS = 60
+LATENCY_FIELDS = ("dns", "connect", "ttfb", "total", "wait")
+
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.throttles = 0
+        self.new_connections = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.status_codes = {}
+        self.latencies = {field: LatencyHistogram() for field in LATENCY_FIELDS}
+
+    def record(self, call):
+        """
+        :param ApiCallRecord call:
+        """
+        self.count += 1
+        self.retries += 1 if call.retries else 0
+        self.throttles += 1 if call.throttled else 0
+        self.bytes_sent += call.bytes_sent
+        self.bytes_received += call.bytes_received
+        self.status_codes[call.status] = self.status_codes.get(call.status, 0) + 1
+        if call.connect is not None:
+            self.new_connections += 1
+            self.latencies["dns"].record(call.dns)
+            self.latencies["connect"].record(call.connect)
+        self.latencies["ttfb"].record(call.ttfb)
+        self.latencies["total"].record(call.total)
+        if call.wait:
+            self.latencies["wait"].record(call.wait)
+
+    def merge(self, other):
+        """
+        :param _EndpointStats other:
+        """
+        self.count += other.count
+        self.retries += other.retries
+        self.throttles += other.throttles
+        self.new_connections += other.new_connections
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        for status, count in list(other.status_codes.items()):
+            self.status_codes[status] = self.status_codes.get(status, 0) + count
+        for field in LATENCY_FIELDS:
+            self.latencies[field].merge(other.latencies[field])
+
+    def to_dict(self):
+        summary = OrderedDict()
+        summary["count"] = self.count
+        summary["retries"] = self.retries
+        summary["throttles"] = self.throttles
+        summary["new_connections"] = self.new_connections
+        summary["bytes_sent"] = self.bytes_sent
+        summary["bytes_received"] = self.bytes_received
+        summary["status_codes"] = {str(k): v for k, v in sorted(self.status_codes.items())}
+        summary["latency"] = OrderedDict((field, self.latencies[field].to_dict()) for field in LATENCY_FIELDS)
+        return summary
+
+
+class ApiStats(object):
+    def __init__(self, logger=None, summary_interval_seconds=DEFAULT_SUMMARY_INTERVAL_SECONDS):
+        """
+        :param logging.Logger logger: live summary is logged here, None to disable
+        :param int summary_interval_seconds: seconds between live summaries, 0 to disable
+        """
+        self._logger = logger
+        self._summary_interval_seconds = summary_interval_seconds
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        # what earlier phases counted before a reset - live metrics keep counting across phases
+        self._retired = {}
+        self._summary_lock = threading.Lock()
+        self._started_at = time()
+        self._next_summary_at = self._started_at + summary_interval_seconds
+        self._last_summary_count = 0
+
+    def _get_shard(self):
+        """ this thread's endpoint -> stats dict, registered once per thread and reset """
+        shards = self._shards
+        shard = getattr(self._local, "shard", None)
+        if shard is None or getattr(self._local, "shards", None) is not shards:
+            shard = {}
+            with self._shards_lock:
+                shards.append(shard)
+            self._local.shard = shard
+            self._local.shards = shards
+        return shard
+
+    def record(self, call):
+        """
+        hook entry point, called by SandboxRest for every request attempt
+        :param ApiCallRecord call:
+        """
+        key = "{} {}".format(call.method, call.endpoint)
+        shard = self._get_shard()
+        stats = shard.get(key)
+        if stats is None:
+            stats = shard[key] = _EndpointStats()
+        stats.record(call)
+
+        if self._logger and self._summary_interval_seconds and time() >= self._next_summary_at:
+            # one thread logs, the rest carry on
+            if self._summary_lock.acquire(blocking=False):
+                try:
+                    self._log_summary()
+                finally:
+                    self._summary_lock.release()
+
+    def _merge_shards(self, shards=None):
+        """
+        :param list shards: endpoint -> stats dicts, this phase's shards when not passed
+        :return: OrderedDict of "<method> <endpoint>" -> merged _EndpointStats
+        """
+        if shards is None:
+            with self._shards_lock:
+                shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for key, stats in list(shard.items()):
+                merged.setdefault(key, _EndpointStats()).merge(stats)
+        return OrderedDict(sorted(merged.items()))
+
+    def _log_summary(self):
+        now = time()
+        if now < self._next_summary_at:
+            return
+        self._next_summary_at = now + self._summary_interval_seconds
+        merged = self._merge_shards()
+        total = _EndpointStats()
+        for stats in merged.values():
+            total.merge(stats)
+        calls_per_second = (total.count - self._last_summary_count) / float(self._summary_interval_seconds)
+        self._last_summary_count = total.count
+        self._logger.info("API calls: {} ({:.1f}/s), retries {}, new connections {}, ttfb p90 {}, wait p90 {}".format(
+            total.count, calls_per_second, total.retries, total.new_connections,
+            _format_seconds(total.latencies["ttfb"].percentile(90)),
+            _format_seconds(total.latencies["wait"].percentile(90))))
+        for key, stats in merged.items():
+            self._logger.info("    {}: {} calls, ttfb p50 {} p90 {}, total p90 {}, statuses {}".format(
+                key, stats.count,
+                _format_seconds(stats.latencies["ttfb"].percentile(50)),
+                _format_seconds(stats.latencies["ttfb"].percentile(90)),
+                _format_seconds(stats.latencies["total"].percentile(90)),
+                stats.status_codes))
+
+    def get_summary(self, reset=False):
+        """
+        json ready per endpoint summary for the json results report
+        :param bool reset: start counting from zero after this - one summary per setup / teardown phase
+        :return:
+        """
+        merged = self._merge_shards()
+        summary = OrderedDict()
+        summary["seconds"] = round(time() - self._started_at, 1)
+        summary["endpoints"] = OrderedDict((key, stats.to_dict()) for key, stats in merged.items())
+        if reset:
+            with self._shards_lock:
+                self._retired = self._merge_shards([self._retired] + self._shards)
+                self._shards = []
+            self._started_at = time()
+            self._last_summary_count = 0
+        return summary
+
+    def get_lifetime_stats(self):
+        """
+        counts since the instance was created, not reset per phase - for the live metrics endpoint
+        :return: OrderedDict of "<method> <endpoint>" -> merged _EndpointStats
+        """
+        with self._shards_lock:
+            shards = [self._retired] + list(self._shards)
+        return self._merge_shards(shards)
+
+
+def _format_seconds(seconds):
+    return "-" if seconds is None else "{:.3f}s".format(seconds)
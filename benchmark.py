@@ -0,0 +1,297 @@
+"""
+Benchmark suite - harness throughput and overhead against the local mock server (mock_server.py)
+start_sandboxes / stop_sandboxes run at each scale and are measured for
+wall time, api requests per sandbox, client cpu time, peak rss, in-memory state per sandbox
+and ready / ended detection latency
+(server side Ready / Ended to the poll that saw it)
+
+every scale gets a fresh mock server process and a fresh client process, so cpu and peak rss are the harness alone
+
+python benchmark.py --scales 10 100 1000 10000 --workers 50
+python benchmark.py --save-baseline                   (store results as the baseline)
+python benchmark.py --baseline benchmarks/old.json    (exits 1 on regression)
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import process_time, sleep
+from timeit import default_timer
+from urllib.request import urlopen
+
+try:
+    import resource
+except ImportError:
+    # windows - peak rss is left out of the results
+    resource = None
+
+import latency
+import my_globals
+from common import ApiConfig, RunConfig, ActiveWithErrorException, get_sandbox_rest, get_utc_timestamp, \
+    read_json_report_sandboxes, get_state_bytes
+from journal import get_journal_path, read_journal_sandboxes
+from logger import get_logger
+from mock_server import MockConfig, MockSandboxServer, load_mock_config
+from run_start_sandboxes import start_sandboxes
+from run_stop_sandboxes import stop_sandboxes, build_log_path
+
+DEFAULT_SCALES = [10, 100, 1000, 10000]
+DEFAULT_WORKERS = 50
+DEFAULT_PORT = 82
+DEFAULT_TOLERANCE = 0.2
+BASELINE_FILE_NAME = "baseline.json"
+BENCHMARK_BLUEPRINT = "benchmark"
+MOCK_READY_TIMEOUT_SECONDS = 10
+
+# short sandbox timelines - the benchmark is about harness overhead, not waiting
+BENCHMARK_MOCK_CONFIG = MockConfig(response_latency={"type": "constant", "seconds": 0},
+                                   pending_seconds={"type": "uniform", "min": 1, "max": 3},
+                                   stage_seconds={"type": "uniform", "min": 2, "max": 4},
+                                   teardown_seconds={"type": "uniform", "min": 3, "max": 6},
+                                   seed=0)
+
+# COMPARED WITH THE BASELINE - lower is better for all
+# a change is a regression when it is over the tolerance and over the metric's noise floor
+NOISE_FLOORS = OrderedDict([
+    ("start_seconds", 2),
+    ("stop_seconds", 2),
+    ("requests_per_sandbox", 0.5),
+    ("cpu_seconds", 1),
+    ("peak_rss_mb", 10),
+    ("state_bytes_per_sandbox", 64),
+    # detection latency moves with the polling cadence, up to half of polling_frequency_seconds run to run
+    ("ready_detection_p90", 5),
+    ("ended_detection_p90", 5)
+])
+
+
+def _serve_mock(mock_config, port):
+    MockSandboxServer(mock_config, "127.0.0.1", port).serve_forever()
+
+
+def _get_mock_stats(port):
+    with urlopen("http://127.0.0.1:{}/mock/stats".format(port)) as response:
+        return json.loads(response.read())
+
+
+def _wait_for_mock(port):
+    deadline = default_timer() + MOCK_READY_TIMEOUT_SECONDS
+    while True:
+        try:
+            return _get_mock_stats(port)
+        except OSError:
+            if default_timer() > deadline:
+                raise Exception("Mock server did not come up on port {}".format(port))
+            sleep(0.1)
+
+
+def _get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return round(peak_rss / (1024.0 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _get_detection_latency(sandboxes, server_times, client_event, server_key):
+    """
+    :param list sandboxes: json report sandboxes
+    :param dict server_times: mock stats per sandbox id
+    :param str client_event: latency timing key of the poll that saw the transition
+    :param str server_key: mock stats key of the transition
+    :return: json ready percentiles
+    """
+    histogram = latency.LatencyHistogram()
+    for sandbox in sandboxes:
+        detected_at = sandbox["timings"].get(client_event)
+        happened_at = server_times.get(sandbox["sandbox_id"], {}).get(server_key)
+        if detected_at is not None and happened_at is not None:
+            histogram.record(max(detected_at - happened_at, 0))
+    summary = histogram.to_dict()
+    return OrderedDict((key, summary.get(key)) for key in ["count", "p50", "p90", "max"])
+
+
+def run_scale(quantity, port, workers, bulk_polling, work_dir):
+    """
+    one measured start / stop flow - runs in its own process so cpu time and peak rss are this flow only
+    :param int quantity: sandboxes
+    :param int port: mock server port
+    :param int workers: thread pool size for api calls
+    :param bool bulk_polling:
+    :param str work_dir: json results / logs / history go here
+    :return: json ready metrics
+    """
+    Path(work_dir).mkdir(exist_ok=True, parents=True)
+    os.chdir(work_dir)
+    time_stamp = get_utc_timestamp()
+    log_file_path = build_log_path(time_stamp, BENCHMARK_BLUEPRINT)
+    Path(log_file_path).parent.mkdir(exist_ok=True, parents=True)
+    logger = get_logger(log_file_path, log_to_console=False)
+
+    api_config = ApiConfig(host="127.0.0.1", port=port, user="benchmark", password="benchmark", domain="Global")
+    run_config = RunConfig(blueprint_id=BENCHMARK_BLUEPRINT, sandbox_quantity=quantity,
+                           sandbox_duration_iso_formatted="PT2H0M", active_sandbox_minutes=0, blueprint_params=[],
+                           setup_polling_timeout=30, teardown_polling_timeout=30, estimated_setup_minutes=0,
+                           estimated_teardown_minutes=0, polling_frequency_seconds=10, bulk_polling=bulk_polling,
+                           min_polling_seconds=1)
+
+    cpu_start = process_time()
+    sb_rest = get_sandbox_rest(api_config, logger, workers)
+    try:
+        start = default_timer()
+        try:
+            start_sandboxes(sb_rest, run_config, time_stamp, logger, workers)
+        except ActiveWithErrorException:
+            # failed setups are part of the mock config, they are torn down like the rest
+            pass
+        start_seconds = default_timer() - start
+        start = default_timer()
+        stop_sandboxes(sb_rest, run_config, time_stamp, logger, workers)
+        stop_seconds = default_timer() - start
+    finally:
+        sb_rest.close()
+    cpu_seconds = process_time() - cpu_start
+
+    mock_stats = _get_mock_stats(port)
+    request_count = sum(count for key, count in mock_stats["request_counts"].items() if "/mock/" not in key)
+    json_file_path = build_log_path(time_stamp, BENCHMARK_BLUEPRINT, is_json_log=True)
+    sandboxes = read_json_report_sandboxes(json_file_path)
+    # what the flows hold per sandbox once teardown finished - same objects as resume builds from the journal
+    state_bytes = get_state_bytes(read_journal_sandboxes(get_journal_path(json_file_path), expand_errors=False))
+    ready_detection = _get_detection_latency(sandboxes, mock_stats["sandboxes"], latency.SETUP_FINISHED,
+                                             "setup_finished_at")
+    ended_detection = _get_detection_latency(sandboxes, mock_stats["sandboxes"], latency.ENDED, "ended_at")
+
+    metrics = OrderedDict()
+    metrics["sandboxes"] = quantity
+    metrics["start_seconds"] = round(start_seconds, 2)
+    metrics["stop_seconds"] = round(stop_seconds, 2)
+    metrics["requests"] = request_count
+    metrics["requests_per_sandbox"] = round(request_count / float(quantity), 2)
+    metrics["cpu_seconds"] = round(cpu_seconds, 2)
+    metrics["peak_rss_mb"] = _get_peak_rss_mb()
+    metrics["state_bytes_per_sandbox"] = state_bytes // quantity
+    metrics["ready_detection_p90"] = ready_detection["p90"]
+    metrics["ended_detection_p90"] = ended_detection["p90"]
+    metrics["ready_detection"] = ready_detection
+    metrics["ended_detection"] = ended_detection
+    return metrics
+
+
+def run_benchmarks(scales, workers, bulk_polling, mock_config, port, time_stamp):
+    """
+    :param list scales: sandbox quantities
+    :param int workers:
+    :param bool bulk_polling:
+    :param MockConfig mock_config:
+    :param int port: mock server port, the harness is pointed at it for every api call including login
+    :param str time_stamp:
+    :return: json ready results
+    """
+    context = multiprocessing.get_context("spawn")
+    benchmark_dir = os.path.join(os.getcwd(), my_globals.BENCHMARKS_FOLDER, time_stamp)
+    results = OrderedDict()
+    results["time_stamp"] = time_stamp
+    results["environment"] = OrderedDict([("python", platform.python_version()),
+                                          ("platform", platform.platform()),
+                                          ("cpu_count", os.cpu_count())])
+    results["settings"] = OrderedDict([("workers", workers),
+                                       ("bulk_polling", bulk_polling),
+                                       ("mock_config", mock_config._asdict())])
+    results["scales"] = OrderedDict()
+    for quantity in scales:
+        print("=== Benchmarking {} sandboxes ===".format(quantity))
+        mock_process = context.Process(target=_serve_mock, args=(mock_config, port), daemon=True)
+        mock_process.start()
+        try:
+            _wait_for_mock(port)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as client_pool:
+                metrics = client_pool.submit(run_scale, quantity, port, workers, bulk_polling,
+                                             os.path.join(benchmark_dir, str(quantity))).result()
+        finally:
+            mock_process.terminate()
+            mock_process.join()
+        print(json.dumps({key: value for key, value in metrics.items() if not isinstance(value, dict)}))
+        results["scales"][str(quantity)] = metrics
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    :param dict results: run_benchmarks output
+    :param dict baseline: run_benchmarks output stored earlier
+    :param float tolerance: allowed relative increase, 0.2 is 20%
+    :return: list of json ready comparisons, one per scale and metric
+    """
+    comparisons = []
+    for scale, metrics in results["scales"].items():
+        baseline_metrics = baseline["scales"].get(scale)
+        if not baseline_metrics:
+            continue
+        for metric, noise_floor in NOISE_FLOORS.items():
+            value = metrics.get(metric)
+            baseline_value = baseline_metrics.get(metric)
+            if value is None or baseline_value is None:
+                continue
+            change = value - baseline_value
+            comparison = OrderedDict()
+            comparison["scale"] = scale
+            comparison["metric"] = metric
+            comparison["baseline"] = baseline_value
+            comparison["value"] = value
+            comparison["change_percent"] = round(100.0 * change / baseline_value, 1) if baseline_value else None
+            comparison["regression"] = change > noise_floor and change > baseline_value * tolerance
+            comparisons.append(comparison)
+    return comparisons
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the harness against the local mock server")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="sandbox quantities to run")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="thread pool size for api calls")
+    parser.add_argument("--bulk-polling", action="store_true", help="poll with one sandbox list request")
+    parser.add_argument("--mock-config", help="json file with mock server settings, see mock_server.py")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="mock server port")
+    parser.add_argument("--baseline", help="results file to compare with, default benchmarks/baseline.json")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative increase over the baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    args = parser.parse_args()
+
+    mock_config = load_mock_config(args.mock_config) if args.mock_config else BENCHMARK_MOCK_CONFIG
+    time_stamp = get_utc_timestamp()
+    results = run_benchmarks(args.scales, args.workers, args.bulk_polling, mock_config, args.port, time_stamp)
+
+    benchmarks_folder = os.path.join(os.getcwd(), my_globals.BENCHMARKS_FOLDER)
+    baseline_path = args.baseline or os.path.join(benchmarks_folder, BASELINE_FILE_NAME)
+    regressions = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        results["baseline"] = baseline_path
+        results["comparison"] = compare_with_baseline(results, baseline, args.tolerance)
+        regressions = [c for c in results["comparison"] if c["regression"]]
+        for comparison in results["comparison"]:
+            print("{:>6} {:<22} baseline {:>10} now {:>10} ({}%){}".format(
+                comparison["scale"], comparison["metric"], comparison["baseline"], comparison["value"],
+                comparison["change_percent"], "  REGRESSION" if comparison["regression"] else ""))
+    elif args.baseline:
+        raise Exception("Baseline file '{}' not found".format(args.baseline))
+
+    results_path = os.path.join(benchmarks_folder, "{}.json".format(time_stamp))
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=4)
+    print("Benchmark results written: '{}'".format(results_path))
+    if args.save_baseline:
+        with open(os.path.join(benchmarks_folder, BASELINE_FILE_NAME), 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Baseline saved")
+
+    if regressions:
+        print("=== {} regressions over baseline ===".format(len(regressions)))
+        sys.exit(1)
@@ -0,0 +1,402 @@
+"""
+Command execution load - fire component commands across all Ready sandboxes at a target rate
+every execution in flight is tracked by one multiplexed poller, a PollingScheduler heap keyed by execution id,
+instead of a blocking @retry loop per execution like sb_rest/sandbox_polling_helpers
+queue / run latency percentiles and failure rates per command go to the "commands" section of the json report
+
+python command_load.py --workers 10    (against the Ready sandboxes of the latest run)
+"""
+import argparse
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
+
+import latency
+from common import get_config_data, get_sandbox_rest, map_api_calls, write_json_report_section, RampProfile
+from journal import get_journal_path, read_journal_sandboxes
+from logger import get_logger
+from polling_scheduler import PollingScheduler, DurationHistory
+from ramp_profile import LaunchScheduler, BURST, CONSTANT
+from results_store import get_latest_json_log_timestamp
+from run_stop_sandboxes import build_log_path, _get_sandbox_data_from_json
+from workload import split_by_weight, interleave
+
+COMMANDS_PHASE = "commands"
+
+# EXECUTION STATUSES - the last three never come from the api
+EXECUTION_PENDING = "Pending"
+EXECUTION_COMPLETED = "Completed"
+EXECUTION_FAILED = "Failed"
+EXECUTION_START_FAILED = "StartFailed"
+EXECUTION_TIMED_OUT = "TimedOut"
+EXECUTION_POLL_FAILED = "PollFailed"
+FINISHED_STATUSES = [EXECUTION_COMPLETED, EXECUTION_FAILED]
+
+# failed status polls in a row before an execution is given up on
+MAX_STATUS_POLL_FAILURES = 3
+
+
+class ExecutionData(object):
+    # one per command execution - no instance __dict__, a run can have many per sandbox
+    __slots__ = ("execution_id", "sandbox_id", "command_name", "requested_at", "started_at", "ended_at",
+                 "detected_at", "status", "error")
+
+    def __init__(self, sandbox_id, command_name, requested_at):
+        """
+        client times are epoch seconds of this host, started_at / ended_at come from the server
+        :param str sandbox_id:
+        :param str command_name:
+        :param float requested_at:
+        """
+        self.execution_id = None
+        self.sandbox_id = sandbox_id
+        self.command_name = command_name
+        self.requested_at = requested_at
+        self.started_at = None
+        self.ended_at = None
+        self.detected_at = None
+        self.status = EXECUTION_PENDING
+        self.error = None
+
+    def get_ordered_dict(self):
+        return OrderedDict((key, getattr(self, key)) for key in self.__slots__)
+
+
+def _parse_execution_time(value):
+    """ api times are ISO 8601 UTC, e.g. 2021-06-01T10:00:00.123Z """
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=timezone.utc).timestamp()
+
+
+def get_ready_sandboxes(sandbox_data_list):
+    """
+    :param list sandbox_data_list: SandboxErrorData
+    :return: sandboxes that finished setup without error and were not torn down
+    """
+    return [sb_data for sb_data in sandbox_data_list
+            if latency.SETUP_FINISHED in sb_data.timings and not sb_data.failed_setup_stage
+            and latency.ENDED not in sb_data.timings]
+
+
+def get_command_plan(command_load, execution_count):
+    """
+    command of every execution, each command's share spread evenly over the run
+    :param CommandLoadConfig command_load:
+    :param int execution_count:
+    :return: list of command dicts, one per execution
+    """
+    commands = list(command_load.commands)
+    quantities = split_by_weight(execution_count, [command.get("weight", 1) for command in commands])
+    return [commands[index] for index in interleave(quantities)]
+
+
+def _get_component_ids(sb_rest, sandbox_id, logger):
+    """
+    :return: OrderedDict of component name to id, in api order
+    """
+    try:
+        components = sb_rest.get_sandbox_components(sandbox_id)
+    except Exception as e:
+        exc_msg = "Could not get components of sandbox '{}': {}".format(sandbox_id, str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+    return OrderedDict((component["name"], component["id"]) for component in components)
+
+
+def _start_execution(sb_rest, sandbox_id, component_ids, command, logger):
+    """
+    send one command start request. a rejected start is recorded on the execution, it does not stop the load
+    :param SandboxRest sb_rest:
+    :param str sandbox_id:
+    :param dict component_ids: _get_component_ids output
+    :param dict command: entry of the "commands" config list
+    :param logging.Logger logger:
+    :return: ExecutionData
+    """
+    execution = ExecutionData(sandbox_id, command["command_name"], time())
+    component_name = command.get("component_name")
+    component_id = component_ids.get(component_name) if component_name else next(iter(component_ids.values()), None)
+    try:
+        if not component_id:
+            raise Exception("No component '{}' in sandbox".format(component_name or ""))
+        response = sb_rest.start_component_command(sandbox_id, component_id, command["command_name"],
+                                                   command.get("params", []))
+        execution.execution_id = response["executionId"]
+    except Exception as e:
+        execution.status = EXECUTION_START_FAILED
+        execution.error = str(e)
+        logger.error("Command '{}' not started in sandbox '{}': {}".format(command["command_name"], sandbox_id,
+                                                                        str(e)))
+    return execution
+
+
+def _get_execution_status(sb_rest, execution_id, logger):
+    """
+    poll execution once - safe to run in worker threads
+    a failed poll is logged and comes back as None, the other executions in flight carry on
+    :return: tuple of execution details or None, epoch time of poll
+    """
+    # rate quota responses are retried inside SandboxRest
+    try:
+        exc_data = sb_rest.get_execution_data(execution_id)
+    except Exception as e:
+        logger.error("Issue during execution polling of '{}': {}".format(execution_id, str(e)))
+        return None, time()
+    return exc_data, time()
+
+
+def _get_command_entry(executions, elapsed_seconds):
+    """
+    :param list executions: ExecutionData of one command, or of all
+    :param float elapsed_seconds: wall time of the load phase
+    :return: tuple of json ready stats, OrderedDict of queue / run / total LatencyHistogram
+    """
+    statuses = [execution.status for execution in executions]
+    histograms = OrderedDict((name, latency.LatencyHistogram()) for name in ["queue", "run", "total"])
+    for execution in executions:
+        if execution.status not in FINISHED_STATUSES:
+            continue
+        # queue latency spans client and server clocks - skew between them shows up here
+        if execution.started_at:
+            histograms["queue"].record(execution.started_at - execution.requested_at)
+        if execution.started_at and execution.ended_at:
+            histograms["run"].record(execution.ended_at - execution.started_at)
+        histograms["total"].record((execution.ended_at or execution.detected_at) - execution.requested_at)
+    finished_count = sum(1 for status in statuses if status in FINISHED_STATUSES)
+    failed_count = len(statuses) - statuses.count(EXECUTION_COMPLETED)
+
+    entry = OrderedDict()
+    entry["executions"] = len(executions)
+    entry["completed"] = statuses.count(EXECUTION_COMPLETED)
+    entry["failed"] = statuses.count(EXECUTION_FAILED)
+    entry["start_errors"] = statuses.count(EXECUTION_START_FAILED)
+    entry["timed_out"] = statuses.count(EXECUTION_TIMED_OUT)
+    entry["poll_errors"] = statuses.count(EXECUTION_POLL_FAILED)
+    entry["failure_rate"] = round(failed_count / float(len(executions)), 4) if executions else 0
+    entry["throughput_per_minute"] = round(finished_count * 60 / elapsed_seconds, 2) if elapsed_seconds else 0
+    entry["latency"] = OrderedDict((name, histogram.to_dict()) for name, histogram in histograms.items())
+    return entry, histograms
+
+
+def build_command_report(executions, elapsed_seconds):
+    """
+    :param list executions: ExecutionData
+    :param float elapsed_seconds:
+    :return: json ready "commands" section of the report
+    """
+    by_command = OrderedDict()
+    for execution in executions:
+        by_command.setdefault(execution.command_name, []).append(execution)
+    report = OrderedDict()
+    report["elapsed_seconds"] = round(elapsed_seconds, 1)
+    report["overall"], _ = _get_command_entry(executions, elapsed_seconds)
+    report["per_command"] = OrderedDict((command_name, _get_command_entry(command_executions, elapsed_seconds)[0])
+                                        for command_name, command_executions in by_command.items())
+    report["executions"] = [execution.get_ordered_dict() for execution in executions]
+    return report
+
+
+def format_command_summary(executions, elapsed_seconds):
+    """
+    one block per command for logging
+    :param list executions: ExecutionData
+    :param float elapsed_seconds:
+    :return:
+    """
+    by_command = OrderedDict()
+    for execution in executions:
+        by_command.setdefault(execution.command_name, []).append(execution)
+    lines = []
+    for command_name, command_executions in by_command.items():
+        entry, histograms = _get_command_entry(command_executions, elapsed_seconds)
+        lines.append("  {}: {} executions, failure rate {:.1%}, {} per minute".format(
+            command_name, entry["executions"], entry["failure_rate"], entry["throughput_per_minute"]))
+        for name, histogram in histograms.items():
+            lines.append("    {} latency: {}".format(name, latency.format_latency_summary(histogram)))
+    return "\n".join(lines)
+
+
+def run_command_load(sb_rest, run_config, time_stamp, logger, workers=0):
+    """
+    :param SandboxRest sb_rest:
+    :param RunConfig run_config:
+    :param str time_stamp: run whose Ready sandboxes get the commands
+    :param logging.Logger logger:
+    :param int workers: fan polls out over a thread pool of this size. 0 runs serially
+    :return: list of ExecutionData
+    """
+    if not run_config.command_load.commands:
+        raise Exception("No commands in 'command_load' section of run_config")
+    executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+    try:
+        return _run_command_load(sb_rest, run_config, time_stamp, logger, executor)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _run_command_load(sb_rest, run_config, time_stamp, logger, executor):
+    json_file_path = build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)
+    journal_path = get_journal_path(json_file_path)
+    if os.path.exists(journal_path):
+        sandbox_data_list = read_journal_sandboxes(journal_path, expand_errors=False)
+    else:
+        sandbox_data_list = _get_sandbox_data_from_json(json_file_path)
+    ready_sandboxes = get_ready_sandboxes(sandbox_data_list)
+    if not ready_sandboxes:
+        raise Exception("No Ready sandboxes in run {} to run commands in".format(time_stamp))
+
+    command_load = run_config.command_load
+    poll_spacing = 0 if executor else 1
+    component_ids = dict(zip([sb_data.sandbox_id for sb_data in ready_sandboxes],
+                             map_api_calls(lambda sb_data: _get_component_ids(sb_rest, sb_data.sandbox_id, logger),
+                                           ready_sandboxes, executor, poll_spacing)))
+    execution_count = len(ready_sandboxes) * command_load.executions_per_sandbox
+    command_plan = get_command_plan(command_load, execution_count)
+
+    def fire(index):
+        sandbox_id = ready_sandboxes[index % len(ready_sandboxes)].sandbox_id
+        return _start_execution(sb_rest, sandbox_id, component_ids[sandbox_id], command_plan[index], logger)
+
+    # FIRE COMMANDS - open loop at the target rate, same launch scheduler as the sandbox ramp
+    shape = CONSTANT if command_load.rate_per_second > 0 else BURST
+    ramp_profile = RampProfile(shape=shape, rate_per_minute=command_load.rate_per_second * 60,
+                               launch_workers=command_load.launch_workers)
+    logger.info("=== Running {} commands in {} Ready sandboxes, {} per second ===".format(
+        execution_count, len(ready_sandboxes), command_load.rate_per_second if shape == CONSTANT else "all at once"))
+    start = time()
+    launcher = LaunchScheduler(fire, execution_count, ramp_profile, logger)
+    launcher.start()
+
+    # ONE SCHEDULER FOR ALL EXECUTIONS IN FLIGHT
+    # first poll per execution lands at the fastest duration seen for its command in earlier runs
+    duration_history = DurationHistory(run_config.blueprint_id)
+    scheduler = PollingScheduler(command_load.min_polling_seconds, command_load.max_polling_seconds)
+    expected_durations = {command["command_name"]: duration_history.get_expected_durations(
+        _get_history_phase(command["command_name"])) for command in command_load.commands}
+    executions = []
+    in_flight = {}
+    poll_failures = {}
+    timeout_seconds = 60 * command_load.timeout_minutes
+    t_end = time() + timeout_seconds
+
+    def add_fired(fired_executions):
+        for execution in fired_executions:
+            executions.append(execution)
+            if execution.status == EXECUTION_START_FAILED:
+                continue
+            in_flight[execution.execution_id] = execution
+            command_expected = expected_durations[execution.command_name]
+            first_poll_delay = scheduler.get_first_poll_delay(command_load.min_polling_seconds / 60.0,
+                                                              command_expected)
+            scheduler.add(execution.execution_id, execution.requested_at, first_poll_delay, command_expected)
+        if fired_executions:
+            return max(t_end, time() + timeout_seconds)
+        return t_end
+
+    # POLL EXECUTIONS
+    # statuses are fetched in workers, ExecutionData is only updated here on the calling thread
+    try:
+        while in_flight or not launcher.is_done():
+            max_wait = None
+            if not launcher.is_done():
+                # wake up regularly to pick up executions started since the last poll
+                t_end = add_fired(launcher.get_launched())
+                max_wait = command_load.min_polling_seconds
+            execution_ids = scheduler.wait_for_due(t_end, 0, max_wait)
+            if not execution_ids:
+                if time() < t_end:
+                    continue
+                # POLLING TIMEOUT - what is still running is reported, not waited for
+                logger.error("{} executions not finished within {} minutes".format(len(in_flight),
+                                                                                 command_load.timeout_minutes))
+                for execution in in_flight.values():
+                    execution.status = EXECUTION_TIMED_OUT
+                launcher.close()
+                break
+
+            statuses = map_api_calls(lambda execution_id: _get_execution_status(sb_rest, execution_id, logger),
+                                     execution_ids, executor, poll_spacing)
+            for execution_id, (exc_data, polled_at) in zip(execution_ids, statuses):
+                execution = in_flight[execution_id]
+                if exc_data is None:
+                    # retried on its next turn - only an execution that can't be polled at all is given up on
+                    poll_failures[execution_id] = poll_failures.get(execution_id, 0) + 1
+                    if poll_failures[execution_id] < MAX_STATUS_POLL_FAILURES:
+                        scheduler.reschedule(execution_id)
+                        continue
+                    execution.status = EXECUTION_POLL_FAILED
+                    execution.error = "Status not polled in {} tries".format(MAX_STATUS_POLL_FAILURES)
+                    logger.error("Command '{}' in sandbox '{}' given up on: {}".format(
+                        execution.command_name, execution.sandbox_id, execution.error))
+                    scheduler.remove(execution_id)
+                    del in_flight[execution_id]
+                    continue
+                poll_failures.pop(execution_id, None)
+                execution.started_at = _parse_execution_time(exc_data.get("started"))
+                if exc_data["status"] not in FINISHED_STATUSES:
+                    # status is passed as the stage - Pending to Running gets a quick follow up poll
+                    scheduler.reschedule(execution_id, exc_data["status"])
+                    continue
+                execution.status = exc_data["status"]
+                execution.ended_at = _parse_execution_time(exc_data.get("ended"))
+                execution.detected_at = polled_at
+                if execution.status == EXECUTION_FAILED:
+                    execution.error = exc_data.get("output")
+                    logger.error("Command '{}' failed in sandbox '{}'".format(execution.command_name,
+                                                                              execution.sandbox_id))
+                duration_history.record(_get_history_phase(execution.command_name),
+                                        scheduler.get_duration_estimate(execution_id))
+                scheduler.remove(execution_id)
+                del in_flight[execution_id]
+    finally:
+        # partial results on failure or ctrl+c too
+        elapsed_seconds = time() - start
+        launcher.close()
+        duration_history.save()
+        instrumentation = sb_rest.get_instrumentation()
+        api_summary = instrumentation.get_summary(reset=True) if instrumentation else None
+        write_json_report_section(json_file_path, COMMANDS_PHASE, build_command_report(executions, elapsed_seconds),
+                                  api_summary, COMMANDS_PHASE)
+        logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    logger.info("Commands Done. Elapsed: '{}' minutes".format(round(elapsed_seconds / 60, 1)))
+    logger.info("Command latency and failure rate per command:\n{}".format(
+        format_command_summary(executions, elapsed_seconds)))
+    logger.info("Launch schedule stats: {}".format(launcher.get_launch_stats()))
+    return executions
+
+
+def _get_history_phase(command_name):
+    """ command durations are kept next to setup / teardown in the blueprint's DurationHistory """
+    return "command {}".format(command_name)
+
+
+if __name__ == "__main__":
+    """
+    When Triggering commands independently, latest timestamp is used
+    """
+    parser = argparse.ArgumentParser(description="Run component commands in the Ready sandboxes of the latest run")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls. 0 runs serially")
+    args = parser.parse_args()
+
+    try:
+        api_config, run_config = get_config_data()
+    except Exception as e:
+        exc_msg = "Make sure config.json file is present. See ReadME for sample. Exception: {}".format(str(e))
+        raise Exception(exc_msg)
+
+    latest_json_time_stamp = get_latest_json_log_timestamp(run_config.blueprint_id)
+    log_path = build_log_path(latest_json_time_stamp, run_config.blueprint_id)
+    logger = get_logger(log_path)
+    try:
+        sb_rest = get_sandbox_rest(api_config, logger, args.workers)
+    except Exception as e:
+        exc_msg = "Could not get sandbox rest session: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+
+    run_command_load(sb_rest, run_config, latest_json_time_stamp, logger, args.workers)
@@ -1,12 +1,23 @@
 import json
 import os
+import sys
 import typing
 from collections import OrderedDict
 from datetime import datetime
+from pathlib import Path
+from time import sleep, time
 
-from my_globals import TIMESTAMP_FORMATTING
+import error_signatures
+import latency
+from api_stats import ApiStats
+from metrics import start_metrics_exporter, DEFAULT_METRICS_PORT, DEFAULT_METRICS_HOST
+from my_globals import TIMESTAMP_FORMATTING, HISTORY_FOLDER
+from sb_rest.auth import Credential
+from sb_rest.sandbox_rest_api import SandboxRest
+from workload import WorkloadBlueprint, DEFAULT_WORKLOAD_NAME, split_by_weight, build_blueprint_report
 
 CONFIG_FILE_NAME = "config.json"
+TOKEN_CACHE_FILE_NAME = "token_cache.json"
 
 
 class ApiConfig(typing.NamedTuple):
@@ -15,6 +26,59 @@ class ApiConfig(typing.NamedTuple):
     user: str
     password: str
     domain: str
+    pool_connections: int = 10
+    pool_maxsize: int = 10
+    pool_block: bool = False
+    keep_alive: bool = True
+    requests_per_second: float = 0
+    rate_burst: int = 1
+    max_requests_per_second: float = 0
+    max_retries: int = 5
+    instrumentation: bool = False
+    instrumentation_summary_seconds: int = 60
+    credentials: tuple = ()
+    token_cache_path: str = ""
+    token_ttl_minutes: float = 60
+    metrics: bool = False
+    metrics_port: int = DEFAULT_METRICS_PORT
+    metrics_host: str = DEFAULT_METRICS_HOST
+
+
+class RampProfile(typing.NamedTuple):
+    """ launch load shape, rates are sandbox launches per minute. see ramp_profile.py """
+    shape: str = "burst"
+    rate_per_minute: float = 60
+    end_rate_per_minute: float = 0
+    ramp_minutes: float = 10
+    step_rate_per_minute: float = 0
+    step_minutes: float = 1
+    spike_rate_per_minute: float = 0
+    spike_at_minute: float = 0
+    spike_minutes: float = 1
+    target_active: int = 0
+    poisson: bool = False
+    seed: typing.Optional[int] = None
+    launch_workers: int = 0
+
+
+class SoakConfig(typing.NamedTuple):
+    """ steady state soak - see run_soak.py """
+    target_active: int = 0
+    dwell_minutes: typing.Optional[float] = None
+    duration_minutes: float = 60
+    stats_interval_seconds: int = 60
+    stats_window_minutes: float = 10
+
+
+class CommandLoadConfig(typing.NamedTuple):
+    """ command execution load once sandboxes are Ready - see command_load.py """
+    commands: tuple = ()
+    rate_per_second: float = 1
+    executions_per_sandbox: int = 1
+    min_polling_seconds: float = 1
+    max_polling_seconds: float = 10
+    timeout_minutes: float = 10
+    launch_workers: int = 0
 
 
 class RunConfig(typing.NamedTuple):
@@ -28,6 +92,15 @@ class RunConfig(typing.NamedTuple):
     estimated_setup_minutes: int
     estimated_teardown_minutes: int
     polling_frequency_seconds: int
+    max_concurrency: int = 50
+    bulk_polling: bool = False
+    min_polling_seconds: int = 5
+    live_tail: bool = False
+    console_tail_lines: int = 20
+    ramp_profile: RampProfile = RampProfile()
+    soak: SoakConfig = SoakConfig()
+    workload: typing.Tuple[WorkloadBlueprint, ...] = ()
+    command_load: CommandLoadConfig = CommandLoadConfig()
 
 
 class ActiveWithErrorException(Exception):
@@ -65,49 +138,309 @@ def get_config_data() -> typing.Tuple[ApiConfig, RunConfig]:
     api_data = data["api_data"]
     run_data = data["run_config"]
 
+    # OPTIONAL CONNECTION POOL SETTINGS
+    pool_data = api_data.get("connection_pool", {})
+    pool_defaults = ApiConfig._field_defaults
+
+    # OPTIONAL SHARED RATE BUDGET - 0 is unlimited
+    rate_data = api_data.get("rate_limit", {})
+
+    # OPTIONAL PER ENDPOINT API CALL STATS
+    instrumentation_data = api_data.get("instrumentation", {})
+
+    # OPTIONAL MORE ACCOUNTS - requests go round robin over "user" and these
+    credentials = tuple(Credential(username=credential["user"], password=credential["password"],
+                                   domain=credential.get("domain", api_data["domain"]))
+                        for credential in api_data.get("credentials", []))
+
+    # OPTIONAL LIVE METRICS ENDPOINT
+    metrics_data = api_data.get("metrics", {})
+
+    # TOKEN CACHE - opt-in, the token is written to disk in plain text. reused across processes until it expires
+    token_data = api_data.get("token_cache", {})
+    token_cache_path = ""
+    if token_data.get("enabled", False):
+        token_cache_path = token_data.get("path") or os.path.join(current_dir, HISTORY_FOLDER, TOKEN_CACHE_FILE_NAME)
+
     api_config = ApiConfig(host=api_data["sandbox_rest_server"],
                            port=api_data["port"],
                            user=api_data["user"],
                            password=api_data["password"],
-                           domain=api_data["domain"])
+                           domain=api_data["domain"],
+                           pool_connections=pool_data.get("pool_connections", pool_defaults["pool_connections"]),
+                           pool_maxsize=pool_data.get("pool_maxsize", pool_defaults["pool_maxsize"]),
+                           pool_block=pool_data.get("pool_block", pool_defaults["pool_block"]),
+                           keep_alive=pool_data.get("keep_alive", pool_defaults["keep_alive"]),
+                           requests_per_second=rate_data.get("requests_per_second",
+                                                             pool_defaults["requests_per_second"]),
+                           rate_burst=rate_data.get("burst", pool_defaults["rate_burst"]),
+                           max_requests_per_second=rate_data.get("max_requests_per_second",
+                                                                 pool_defaults["max_requests_per_second"]),
+                           max_retries=rate_data.get("max_retries", pool_defaults["max_retries"]),
+                           instrumentation=instrumentation_data.get("enabled", pool_defaults["instrumentation"]),
+                           instrumentation_summary_seconds=instrumentation_data.get(
+                               "summary_interval_seconds", pool_defaults["instrumentation_summary_seconds"]),
+                           credentials=credentials,
+                           token_cache_path=token_cache_path,
+                           token_ttl_minutes=token_data.get("ttl_minutes", pool_defaults["token_ttl_minutes"]),
+                           metrics=metrics_data.get("enabled", pool_defaults["metrics"]),
+                           metrics_port=metrics_data.get("port", pool_defaults["metrics_port"]),
+                           metrics_host=metrics_data.get("host", pool_defaults["metrics_host"]))
+
+    # OPTIONAL LAUNCH LOAD SHAPE - default launches everything up front
+    ramp_data = run_data.get("ramp_profile", {})
+    ramp_defaults = RampProfile._field_defaults
+    ramp_profile = RampProfile(**{field: ramp_data.get(field, default) for field, default in ramp_defaults.items()})
+
+    # OPTIONAL SOAK MODE SETTINGS
+    soak_data = run_data.get("soak", {})
+    soak_config = SoakConfig(**{field: soak_data.get(field, default)
+                                for field, default in SoakConfig._field_defaults.items()})
 
+    run_defaults = RunConfig._field_defaults
     sandbox_duration_minutes = run_data["sandbox_duration_minutes"]
     sandbox_duration_iso_formatted = _get_iso_formatted_time_from_minutes(sandbox_duration_minutes)
-    run_config = RunConfig(blueprint_id=run_data["blueprint_id"],
-                           sandbox_quantity=run_data["sandbox_quantity"],
+
+    # OPTIONAL COMMAND EXECUTION LOAD - only runs when commands are listed
+    command_data = run_data.get("command_load", {})
+    command_config = CommandLoadConfig(**{field: command_data.get(field, default)
+                                          for field, default in CommandLoadConfig._field_defaults.items()})
+    command_config = command_config._replace(commands=tuple(command_config.commands))
+
+    # OPTIONAL MIXED WORKLOAD - several blueprints interleaved in one run, in place of blueprint_id / blueprint_params
+    # results and logs are kept under the workload name
+    workload_data = run_data.get("workload", {})
+    workload = _get_workload(workload_data, run_data) if workload_data else ()
+    run_config = RunConfig(blueprint_id=workload_data.get("name", DEFAULT_WORKLOAD_NAME) if workload
+                           else run_data["blueprint_id"],
+                           sandbox_quantity=sum(bp.sandbox_quantity for bp in workload) if workload
+                           else run_data["sandbox_quantity"],
                            sandbox_duration_iso_formatted=sandbox_duration_iso_formatted,
                            active_sandbox_minutes=run_data["active_sandbox_minutes"],
                            setup_polling_timeout=run_data["setup_polling_timeout"],
                            teardown_polling_timeout=run_data["teardown_polling_timeout"],
-                           blueprint_params=run_data["blueprint_params"],
+                           blueprint_params=run_data.get("blueprint_params", []) if workload
+                           else run_data["blueprint_params"],
                            estimated_setup_minutes=run_data["estimated_setup_minutes"],
                            estimated_teardown_minutes=run_data["estimated_teardown_minutes"],
-                           polling_frequency_seconds=run_data["polling_frequency_seconds"])
+                           polling_frequency_seconds=run_data["polling_frequency_seconds"],
+                           max_concurrency=run_data.get("max_concurrency", run_defaults["max_concurrency"]),
+                           bulk_polling=run_data.get("bulk_polling", run_defaults["bulk_polling"]),
+                           min_polling_seconds=run_data.get("min_polling_seconds", run_defaults["min_polling_seconds"]),
+                           live_tail=run_data.get("live_tail", run_defaults["live_tail"]),
+                           console_tail_lines=run_data.get("console_tail_lines", run_defaults["console_tail_lines"]),
+                           ramp_profile=ramp_profile,
+                           soak=soak_config,
+                           workload=workload,
+                           command_load=command_config)
     return api_config, run_config
 
 
+def _get_workload(workload_data, run_data):
+    """
+    blueprints with a "sandbox_quantity" get exactly that, the rest of the run's "sandbox_quantity" is split
+    between the others by "weight"
+    :param dict workload_data: "workload" section of run_config
+    :param dict run_data: run_config section
+    :return: tuple of WorkloadBlueprint
+    """
+    blueprints_data = workload_data["blueprints"]
+    blueprint_ids = [bp_data["blueprint_id"] for bp_data in blueprints_data]
+    if len(set(blueprint_ids)) != len(blueprint_ids):
+        raise Exception("workload blueprints must be unique, got {}".format(blueprint_ids))
+    weight_default = WorkloadBlueprint._field_defaults["weight"]
+    weighted = [bp_data for bp_data in blueprints_data if "sandbox_quantity" not in bp_data]
+    fixed_quantity = sum(bp_data["sandbox_quantity"] for bp_data in blueprints_data if bp_data not in weighted)
+    weighted_quantities = split_by_weight(run_data.get("sandbox_quantity", 0) - fixed_quantity,
+                                          [bp_data.get("weight", weight_default) for bp_data in weighted])
+    quantities = dict(zip([bp_data["blueprint_id"] for bp_data in weighted], weighted_quantities))
+
+    workload = []
+    for bp_data in blueprints_data:
+        duration_minutes = bp_data.get("sandbox_duration_minutes", run_data["sandbox_duration_minutes"])
+        workload.append(WorkloadBlueprint(
+            blueprint_id=bp_data["blueprint_id"],
+            blueprint_params=bp_data.get("blueprint_params", []),
+            sandbox_quantity=bp_data.get("sandbox_quantity", quantities.get(bp_data["blueprint_id"], 0)),
+            sandbox_duration_iso_formatted=_get_iso_formatted_time_from_minutes(duration_minutes),
+            weight=bp_data.get("weight", weight_default)))
+    return tuple(workload)
+
+
+def get_sandbox_rest(api_config, logger=None, workers=0):
+    """
+    build SandboxRest session from api config
+    :param ApiConfig api_config:
+    :param logging.Logger logger:
+    :param int workers: thread pool size - connection pool is grown to at least this size
+    :return:
+    """
+    instrumentation = None
+    if api_config.instrumentation:
+        instrumentation = ApiStats(logger, api_config.instrumentation_summary_seconds)
+    elif api_config.metrics:
+        # request latency for the metrics endpoint, without the live log summary
+        instrumentation = ApiStats()
+    sb_rest = SandboxRest(username=api_config.user,
+                         password=api_config.password,
+                         server=api_config.host,
+                         port=api_config.port,
+                         domain=api_config.domain,
+                         pool_connections=api_config.pool_connections,
+                         pool_maxsize=max(api_config.pool_maxsize, workers),
+                         pool_block=api_config.pool_block,
+                         keep_alive=api_config.keep_alive,
+                         requests_per_second=api_config.requests_per_second,
+                         rate_burst=api_config.rate_burst,
+                         max_requests_per_second=api_config.max_requests_per_second,
+                         max_retries=api_config.max_retries,
+                         instrumentation=instrumentation,
+                         credentials=api_config.credentials,
+                         token_cache_path=api_config.token_cache_path,
+                         token_ttl_seconds=api_config.token_ttl_minutes * 60,
+                         logger=logger)
+    if api_config.metrics:
+        start_metrics_exporter(sb_rest, api_config.metrics_port, api_config.metrics_host, logger)
+    return sb_rest
+
+
+def get_sandboxes_by_id(sb_rest, logger, show_historic=False):
+    """
+    bulk poll - one list request for all sandboxes, indexed by sandbox id
+    :param SandboxRest sb_rest:
+    :param logging.Logger logger:
+    :param bool show_historic: include completed sandboxes
+    :return: dict of sandbox id to listed sandbox details
+    """
+    try:
+        data = sb_rest.get_sandboxes(show_historic)
+    except Exception as e:
+        exc_msg = "Issue during bulk polling: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+    listed_sandboxes = data if isinstance(data, list) else data.get("sandboxes", [])
+    return {sb["id"]: sb for sb in listed_sandboxes}
+
+
+def map_api_calls(func, items, executor=None, spacing_seconds=0):
+    """
+    run func over items - fanned out over thread pool if given, else serially with a sleep after each call
+    results come back in the order of items either way
+    :param func:
+    :param list items:
+    :param concurrent.futures.ThreadPoolExecutor executor:
+    :param int spacing_seconds: buffer between serial api requests
+    :return: iterator of results
+    """
+    if executor:
+        return executor.map(func, items)
+    return _serial_map(func, items, spacing_seconds)
+
+
+def _serial_map(func, items, spacing_seconds):
+    for item in items:
+        yield func(item)
+        sleep(spacing_seconds)
+
+
+# PER SANDBOX BOUNDS - a flapping setup or an error storm can't grow one sandbox's state without limit
+MAX_SETUP_STAGE_MARKS = 50
+MAX_ERRORS_PER_SANDBOX = 100
+
+
+def cap_error_events(events):
+    """
+    the first MAX_ERRORS_PER_SANDBOX - 1 events and the last one - the earliest errors point at the cause,
+    the last one marks where the next phase's errors start
+    :param list events: activity feed events or error references
+    :return: list, the same one when under the cap
+    """
+    if not events or len(events) <= MAX_ERRORS_PER_SANDBOX:
+        return events
+    return events[:MAX_ERRORS_PER_SANDBOX - 1] + events[-1:]
+
+
+def _compact_timings(timings):
+    """ timings read back from json - keys and stage names interned, stage marks as tuples like mark_setup_stage """
+    compact = {sys.intern(key): value for key, value in timings.items()}
+    if latency.SETUP_STAGES in compact:
+        compact[latency.SETUP_STAGES] = [(sys.intern(stage), timestamp)
+                                         for stage, timestamp in compact[latency.SETUP_STAGES]]
+    return compact
+
+
 class SandboxErrorData(object):
-    def __init__(self, sandbox_id, failed_setup_stage=None, setup_errors=None, teardown_errors=None):
+    # one per sandbox for the whole run - no instance __dict__, tens of thousands of them are held at once
+    __slots__ = ("sandbox_id", "failed_setup_stage", "setup_errors", "teardown_errors", "timings", "blueprint_id")
+
+    def __init__(self, sandbox_id, failed_setup_stage=None, setup_errors=None, teardown_errors=None, timings=None,
+                 blueprint_id=None):
         """
         To gather error data from sandboxes during orchestration
+        stage names are interned - every sandbox goes through the same few, and polls parse a new string each time
         :param str sandbox_id:
+        :param list setup_errors: activity feed events, or error_signatures references once journaled
+        :param dict timings: epoch seconds of orchestration events, keys from latency module
+        :param str blueprint_id: set in mixed workload runs only
         """
         self.sandbox_id = sandbox_id
-        self.failed_setup_stage = failed_setup_stage if failed_setup_stage else None
+        self.failed_setup_stage = sys.intern(failed_setup_stage) if failed_setup_stage else None
         self.setup_errors = setup_errors if setup_errors else None
         self.teardown_errors = teardown_errors if teardown_errors else None
+        self.timings = _compact_timings(timings) if timings else {}
+        self.blueprint_id = sys.intern(blueprint_id) if blueprint_id else None
 
-    def get_ordered_json(self):
+    def mark_time(self, event, timestamp=None):
         """
-        order the dict before returning JSON - to keep report output consistent
-        :return:
+        record first occurrence of a timing event
+        :param str event: key from latency module
+        :param float timestamp: epoch seconds, now if not passed
         """
+        self.timings.setdefault(event, round(timestamp or time(), 3))
+
+    def mark_setup_stage(self, stage, timestamp):
+        """
+        record setup stage transition - repeated polls of the same stage are ignored
+        past MAX_SETUP_STAGE_MARKS marks the last one is moved instead, stage latency then lumps the rest together
+        :param str stage:
+        :param float timestamp: epoch seconds
+        """
+        if not stage:
+            return
+        stages = self.timings.setdefault(latency.SETUP_STAGES, [])
+        if stages and stages[-1][0] == stage:
+            return
+        if len(stages) >= MAX_SETUP_STAGE_MARKS:
+            stages.pop()
+        stages.append((sys.intern(stage), round(timestamp, 3)))
+
+    def get_ordered_dict(self):
+        """ same keys as the constructor - blueprint_id only when set, single blueprint reports don't repeat it """
         my_dict = OrderedDict()
         my_dict["sandbox_id"] = self.sandbox_id
+        if self.blueprint_id:
+            my_dict["blueprint_id"] = self.blueprint_id
         my_dict["failed_setup_stage"] = self.failed_setup_stage
         my_dict["setup_errors"] = self.setup_errors
         my_dict["teardown_errors"] = self.teardown_errors
-        return json.dumps(my_dict, indent=4)
+        my_dict["timings"] = self.timings
+        return my_dict
+
+    def get_ordered_json(self):
+        """
+        order the dict before returning JSON - to keep report output consistent
+        :return:
+        """
+        return json.dumps(self.get_ordered_dict(), indent=4)
+
+
+# TOP LEVEL REPORT SECTIONS WRITTEN BY THEIR OWN PHASE - kept when the sandbox data is rewritten
+PRESERVED_REPORT_SECTIONS = ["commands"]
+
+
+def get_sandbox_name(time_stamp, blueprint_id):
+    """ every sandbox of a run gets this name - resume finds sandboxes the journal missed by it """
+    return sandbox_name_truncater("{} - {}".format(time_stamp, blueprint_id))
 
 
 def sandbox_name_truncater(input_str: str):
@@ -120,5 +453,108 @@ def sandbox_name_truncater(input_str: str):
         return input_str
 
 
+def get_state_bytes(objects):
+    """
+    deep size of in-memory run state - objects shared between sandboxes (interned strings, keys) are counted once
+    :param list objects: e.g. SandboxErrorData of a run
+    :return: bytes
+    """
+    seen = set()
+    pending = list(objects)
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            pending.extend(obj)
+        elif hasattr(obj, "__slots__"):
+            pending.extend(getattr(obj, slot) for slot in obj.__slots__ if hasattr(obj, slot))
+        elif hasattr(obj, "__dict__"):
+            pending.append(obj.__dict__)
+    return total
+
+
 def get_json_from_nested_obj(obj):
     return json.dumps(obj, default=lambda o: getattr(o, '__dict__', str(o)), indent=4)
+
+
+def write_json_report(json_file_path, sandbox_data_list, api_summary=None, phase=None):
+    """
+    json results report - per sandbox data plus latency percentiles per phase and setup stage
+    mixed workload runs add sandbox counts, failures and latency per blueprint
+    error events are clustered into signatures, sandboxes keep a reference to theirs - see error_signatures
+    api call summaries are kept per phase, so teardown does not overwrite the one written after setup
+    :param str json_file_path:
+    :param list sandbox_data_list: SandboxErrorData
+    :param dict api_summary: instrumentation summary of this phase, None when not instrumented
+    :param str phase: "setup" / "teardown"
+    :return:
+    """
+    report = OrderedDict()
+    signatures, sandboxes = error_signatures.build_error_report(sandbox_data_list)
+    report["sandboxes"] = sandboxes
+    report["latency"] = latency.build_latency_report(sandbox_data_list)
+    blueprints = build_blueprint_report(sandbox_data_list)
+    if blueprints:
+        report["blueprints"] = blueprints
+    report["error_signatures"] = signatures
+    previous_report = _read_json_report(json_file_path)
+    for section in PRESERVED_REPORT_SECTIONS + ["api_calls"]:
+        if section in previous_report:
+            report[section] = previous_report[section]
+    _write_json_report(json_file_path, report, api_summary, phase)
+
+
+def write_json_report_section(json_file_path, section, data, api_summary=None, phase=None):
+    """
+    add / replace one top level section of the json results report, e.g. "commands"
+    :param str json_file_path:
+    :param str section: one of PRESERVED_REPORT_SECTIONS, so later report writes keep it
+    :param data: json ready
+    :param dict api_summary: see write_json_report
+    :param str phase:
+    :return:
+    """
+    report = _read_json_report(json_file_path)
+    report[section] = data
+    _write_json_report(json_file_path, report, api_summary, phase)
+
+
+def _read_json_report(json_file_path):
+    if not os.path.exists(json_file_path):
+        return OrderedDict()
+    with open(json_file_path) as f:
+        report = json.load(f, object_pairs_hook=OrderedDict)
+    return report if isinstance(report, dict) else OrderedDict()
+
+
+def _write_json_report(json_file_path, report, api_summary, phase):
+    """ api_calls is always the last section - summaries of earlier phases are kept """
+    api_calls = report.pop("api_calls", None) or OrderedDict()
+    if api_summary:
+        api_calls[phase] = api_summary
+    if api_calls:
+        report["api_calls"] = api_calls
+    Path(json_file_path).parent.mkdir(exist_ok=True, parents=True)
+    with open(json_file_path, 'w') as f:
+        f.write(get_json_from_nested_obj(report))
+
+
+def read_json_report_sandboxes(json_file_path):
+    """
+    reports written before latency was added are a plain list of sandboxes
+    error references are expanded to full activity feed events
+    :param str json_file_path:
+    :return: list of sandbox dicts
+    """
+    with open(json_file_path) as f:
+        data = json.load(f, object_pairs_hook=OrderedDict)
+    if isinstance(data, list):
+        return data
+    return error_signatures.expand_error_refs(data["sandboxes"], data.get("error_signatures") or {})
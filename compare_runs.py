@@ -0,0 +1,333 @@
+"""
+Run comparison - a candidate run against a baseline run, from their json results reports
+setup / teardown latency percentiles, setup failure rate overall and per failed setup stage, teardown failure rate
+and setup throughput, each with a statistical test so run to run noise is not flagged
+- latency percentiles and throughput: bootstrap confidence interval of the change (sandboxes resampled)
+- latency distribution: one sided Mann-Whitney U test, candidate slower than baseline
+- failure rates: one sided two-proportion z test, candidate failing more than baseline
+a change is a regression when it is significant and over the tolerance / minimum change
+
+python compare_runs.py json-results/<blueprint>/<baseline>.json json-results/<blueprint>/<candidate>.json
+python compare_runs.py --blueprint <id>        (latest run against the one before it, from the results store)
+exits 1 on regression
+"""
+import argparse
+import json
+import math
+import random
+import sys
+from collections import OrderedDict
+
+import latency
+from common import read_json_report_sandboxes
+from results_store import ResultsStore
+
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_RESAMPLES = 1000
+DEFAULT_SEED = 0
+# timings are only as precise as polling - smaller latency changes are not flagged however significant
+DEFAULT_MIN_CHANGE_SECONDS = 5
+DEFAULT_MIN_FAILURE_RATE_CHANGE = 0.01
+
+# PHASE -> (START TIMING, END TIMING), same intervals as the report's "latency" section
+COMPARED_PHASES = OrderedDict([
+    ("setup", (latency.START_REQUESTED, latency.SETUP_FINISHED)),
+    ("teardown", (latency.STOP_REQUESTED, latency.ENDED))
+])
+
+
+def get_phase_samples(sandboxes):
+    """
+    :param list sandboxes: sandbox dicts of a json results report
+    :return: OrderedDict of phase to list of seconds
+    """
+    samples = OrderedDict((phase, []) for phase in COMPARED_PHASES)
+    for sandbox in sandboxes:
+        timings = sandbox.get("timings") or {}
+        for phase, (start_key, end_key) in COMPARED_PHASES.items():
+            if start_key in timings and end_key in timings:
+                samples[phase].append(timings[end_key] - timings[start_key])
+    return samples
+
+
+def get_failure_counts(sandboxes):
+    """
+    setup failures per failed setup stage are over all sandboxes of the run, so the stage rates add up to
+    setup_failure_rate and a stage the baseline never failed in is still compared
+    :param list sandboxes: sandbox dicts of a json results report
+    :return: OrderedDict of rate name to (failed, total)
+    """
+    failed_stages = OrderedDict()
+    for sandbox in sandboxes:
+        failed_stage = sandbox.get("failed_setup_stage")
+        if failed_stage:
+            failed_stages[failed_stage] = failed_stages.get(failed_stage, 0) + 1
+    stopped = [sandbox for sandbox in sandboxes if latency.STOP_REQUESTED in (sandbox.get("timings") or {})]
+
+    counts = OrderedDict()
+    counts["setup_failure_rate"] = (sum(failed_stages.values()), len(sandboxes))
+    counts["teardown_failure_rate"] = (sum(1 for sandbox in stopped if sandbox.get("teardown_errors")), len(stopped))
+    for stage, failed in failed_stages.items():
+        counts["setup_failure_rate {}".format(stage)] = (failed, len(sandboxes))
+    return counts
+
+
+def get_setup_intervals(sandboxes):
+    """
+    :param list sandboxes: sandbox dicts of a json results report
+    :return: list of (start requested, setup finished) of sandboxes that set up without failing
+    """
+    intervals = []
+    for sandbox in sandboxes:
+        timings = sandbox.get("timings") or {}
+        if not sandbox.get("failed_setup_stage") and latency.SETUP_FINISHED in timings:
+            intervals.append((timings[latency.START_REQUESTED], timings[latency.SETUP_FINISHED]))
+    return intervals
+
+
+def get_throughput(intervals):
+    """
+    :param list intervals: get_setup_intervals output
+    :return: sandboxes set up per minute, from the first start request to the last finished setup
+    """
+    if not intervals:
+        return 0
+    span_seconds = max(finished for _, finished in intervals) - min(started for started, _ in intervals)
+    return len(intervals) * 60.0 / max(span_seconds, 1)
+
+
+def get_percentiles(values, percentiles=latency.REPORTED_PERCENTILES):
+    """
+    nearest rank percentiles of raw samples
+    :param list values:
+    :param tuple percentiles:
+    :return: list of values, one per percentile
+    """
+    ordered = sorted(values)
+    return [ordered[max(int(math.ceil(percentile / 100.0 * len(ordered))) - 1, 0)] for percentile in percentiles]
+
+
+def bootstrap_change(baseline, candidate, statistic, resamples, confidence, rng):
+    """
+    confidence interval of candidate minus baseline - both samples are resampled with replacement
+    :param list baseline:
+    :param list candidate:
+    :param statistic: callable taking a sample, returns a list of values
+    :param int resamples:
+    :param float confidence: e.g. 0.95
+    :param random.Random rng:
+    :return: list of (low, high), one per statistic value
+    """
+    changes = []
+    for _ in range(resamples):
+        changes.append([value - baseline_value for value, baseline_value in
+                        zip(statistic(rng.choices(candidate, k=len(candidate))),
+                            statistic(rng.choices(baseline, k=len(baseline))))])
+    alpha = 1 - confidence
+    low_index = int(alpha / 2 * resamples)
+    high_index = max(int(math.ceil((1 - alpha / 2) * resamples)) - 1, low_index)
+    intervals = []
+    for column in zip(*changes):
+        ordered = sorted(column)
+        intervals.append((ordered[low_index], ordered[high_index]))
+    return intervals
+
+
+def mann_whitney(baseline, candidate):
+    """
+    one sided Mann-Whitney U test with the normal approximation, tie and continuity corrected
+    :param list baseline:
+    :param list candidate:
+    :return: (probability a candidate sample is slower than a baseline one, p value of candidate being slower)
+    """
+    combined = sorted([(value, 0) for value in baseline] + [(value, 1) for value in candidate])
+    total = len(combined)
+    candidate_rank_sum = 0.0
+    tie_term = 0
+    i = 0
+    while i < total:
+        j = i
+        while j < total and combined[j][0] == combined[i][0]:
+            j += 1
+        # tied values share the mean of their ranks
+        mean_rank = (i + j + 1) / 2.0
+        candidate_rank_sum += mean_rank * sum(group for _, group in combined[i:j])
+        tie_term += (j - i) ** 3 - (j - i)
+        i = j
+    n_candidate, n_baseline = len(candidate), len(baseline)
+    u = candidate_rank_sum - n_candidate * (n_candidate + 1) / 2.0
+    variance = n_candidate * n_baseline / 12.0 * ((total + 1) - tie_term / float(total * (total - 1)))
+    if variance <= 0:
+        return 0.5, 1.0
+    z = (u - n_candidate * n_baseline / 2.0 - 0.5) / math.sqrt(variance)
+    return u / (n_candidate * n_baseline), 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def two_proportion_test(baseline_failed, baseline_total, failed, total):
+    """
+    :return: one sided p value of the candidate failure rate being higher
+    """
+    pooled = (baseline_failed + failed) / float(baseline_total + total)
+    standard_error = math.sqrt(pooled * (1 - pooled) * (1.0 / baseline_total + 1.0 / total))
+    if not standard_error:
+        return 1.0
+    z = (failed / float(total) - baseline_failed / float(baseline_total)) / standard_error
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _get_comparison(metric, baseline_value, value, test, regression, precision=3):
+    change = value - baseline_value
+    comparison = OrderedDict()
+    comparison["metric"] = metric
+    comparison["baseline"] = round(baseline_value, precision)
+    comparison["candidate"] = round(value, precision)
+    comparison["change"] = round(change, precision)
+    comparison["change_percent"] = round(100.0 * change / baseline_value, 1) if baseline_value else None
+    comparison.update(test)
+    comparison["regression"] = regression
+    return comparison
+
+
+def compare_runs(baseline_sandboxes, sandboxes, tolerance=DEFAULT_TOLERANCE, confidence=DEFAULT_CONFIDENCE,
+                 resamples=DEFAULT_RESAMPLES, min_change_seconds=DEFAULT_MIN_CHANGE_SECONDS,
+                 min_failure_rate_change=DEFAULT_MIN_FAILURE_RATE_CHANGE, seed=DEFAULT_SEED):
+    """
+    :param list baseline_sandboxes: sandbox dicts of the baseline json results report
+    :param list sandboxes: sandbox dicts of the candidate json results report
+    :param float tolerance: allowed relative latency increase / throughput decrease, 0.1 is 10%
+    :param float confidence: of the bootstrap intervals, 1 - confidence is the p value threshold
+    :param int resamples: bootstrap resamples
+    :param float min_change_seconds: latency changes below this are not regressions
+    :param float min_failure_rate_change: failure rate increases below this (0.01 is 1 point) are not regressions
+    :param int seed: bootstrap random seed, the same reports always compare the same
+    :return: list of json ready comparisons, one per metric
+    """
+    rng = random.Random(seed)
+    alpha = 1 - confidence
+    comparisons = []
+
+    # LATENCY
+    baseline_samples = get_phase_samples(baseline_sandboxes)
+    for phase, samples in get_phase_samples(sandboxes).items():
+        phase_baseline = baseline_samples[phase]
+        if len(samples) < 2 or len(phase_baseline) < 2:
+            continue
+        intervals = bootstrap_change(phase_baseline, samples, get_percentiles, resamples, confidence, rng)
+        baseline_percentiles = get_percentiles(phase_baseline)
+        for percentile, baseline_value, value, (low, high) in zip(
+                latency.REPORTED_PERCENTILES, baseline_percentiles, get_percentiles(samples), intervals):
+            threshold = max(min_change_seconds, baseline_value * tolerance)
+            test = OrderedDict([("ci", [round(low, 3), round(high, 3)])])
+            comparisons.append(_get_comparison("{} p{}".format(phase, percentile), baseline_value, value, test,
+                                               low > 0 and value - baseline_value > threshold))
+        slower_probability, p_value = mann_whitney(phase_baseline, samples)
+        baseline_median, median = baseline_percentiles[0], get_percentiles(samples, (50,))[0]
+        test = OrderedDict([("p_value", round(p_value, 4)), ("slower_probability", round(slower_probability, 3))])
+        threshold = max(min_change_seconds, baseline_median * tolerance)
+        comparisons.append(_get_comparison("{} distribution".format(phase), baseline_median, median, test,
+                                           p_value < alpha and median - baseline_median > threshold))
+
+    # FAILURE RATES
+    baseline_counts = get_failure_counts(baseline_sandboxes)
+    counts = get_failure_counts(sandboxes)
+    for name in list(baseline_counts) + [name for name in counts if name not in baseline_counts]:
+        # a stage missing from one run had no failures there
+        baseline_failed, baseline_total = baseline_counts.get(name, (0, len(baseline_sandboxes)))
+        failed, total = counts.get(name, (0, len(sandboxes)))
+        if not baseline_total or not total:
+            continue
+        baseline_rate, rate = baseline_failed / float(baseline_total), failed / float(total)
+        p_value = two_proportion_test(baseline_failed, baseline_total, failed, total)
+        test = OrderedDict([("p_value", round(p_value, 4)), ("failed", [baseline_failed, failed]),
+                            ("total", [baseline_total, total])])
+        comparisons.append(_get_comparison(name, baseline_rate, rate, test,
+                                           p_value < alpha and rate - baseline_rate > min_failure_rate_change, 4))
+
+    # THROUGHPUT - lower is worse
+    baseline_intervals = get_setup_intervals(baseline_sandboxes)
+    intervals = get_setup_intervals(sandboxes)
+    if len(baseline_intervals) >= 2 and len(intervals) >= 2:
+        baseline_value, value = get_throughput(baseline_intervals), get_throughput(intervals)
+        low, high = bootstrap_change(baseline_intervals, intervals, lambda sample: [get_throughput(sample)],
+                                     resamples, confidence, rng)[0]
+        test = OrderedDict([("ci", [round(low, 3), round(high, 3)])])
+        comparisons.append(_get_comparison("setups_per_minute", baseline_value, value, test,
+                                           high < 0 and baseline_value - value > baseline_value * tolerance))
+    return comparisons
+
+
+def format_comparison(comparison):
+    """ one line per metric for printing """
+    if "ci" in comparison:
+        test = "ci [{}, {}]".format(*comparison["ci"])
+    else:
+        test = "p {}".format(comparison["p_value"])
+    return "{:<40} baseline {:>10} candidate {:>10} ({}%)  {}{}".format(
+        comparison["metric"], comparison["baseline"], comparison["candidate"], comparison["change_percent"], test,
+        "  REGRESSION" if comparison["regression"] else "")
+
+
+def get_latest_report_paths(blueprint_id):
+    """
+    :param str blueprint_id:
+    :return: (baseline report path, candidate report path) - the run before the latest and the latest
+    """
+    with ResultsStore() as store:
+        runs = [run for run in store.get_runs(blueprint_id, last_runs=10) if run["report_path"]]
+    if len(runs) < 2:
+        raise Exception("Need two runs of '{}' with json results in the results store, found {}".format(
+            blueprint_id, len(runs)))
+    return runs[1]["report_path"], runs[0]["report_path"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare a candidate run with a baseline run, exits 1 on regression")
+    parser.add_argument("reports", nargs="*", help="baseline and candidate json results reports")
+    parser.add_argument("--blueprint", help="compare the latest two runs of this blueprint from the results store")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative latency increase / throughput decrease")
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE,
+                        help="confidence of the statistical tests")
+    parser.add_argument("--resamples", type=int, default=DEFAULT_RESAMPLES, help="bootstrap resamples")
+    parser.add_argument("--min-change-seconds", type=float, default=DEFAULT_MIN_CHANGE_SECONDS,
+                        help="latency changes below this are not regressions")
+    parser.add_argument("--min-failure-rate-change", type=float, default=DEFAULT_MIN_FAILURE_RATE_CHANGE,
+                        help="failure rate increases below this are not regressions, 0.01 is 1 point")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="bootstrap random seed")
+    parser.add_argument("--output", help="also write the comparison to this json file")
+    args = parser.parse_args()
+
+    if args.blueprint:
+        baseline_path, candidate_path = get_latest_report_paths(args.blueprint)
+    elif len(args.reports) == 2:
+        baseline_path, candidate_path = args.reports
+    else:
+        raise Exception("Pass a baseline and a candidate json results report, or --blueprint")
+
+    print("Baseline:  '{}'".format(baseline_path))
+    print("Candidate: '{}'".format(candidate_path))
+    results = compare_runs(read_json_report_sandboxes(baseline_path), read_json_report_sandboxes(candidate_path),
+                           args.tolerance, args.confidence, args.resamples, args.min_change_seconds,
+                           args.min_failure_rate_change, args.seed)
+    for result in results:
+        print(format_comparison(result))
+    regressions = [result for result in results if result["regression"]]
+
+    if args.output:
+        output = OrderedDict([("baseline", baseline_path), ("candidate", candidate_path),
+                              ("settings", OrderedDict([("tolerance", args.tolerance),
+                                                        ("confidence", args.confidence),
+                                                        ("resamples", args.resamples),
+                                                        ("min_change_seconds", args.min_change_seconds),
+                                                        ("min_failure_rate_change", args.min_failure_rate_change),
+                                                        ("seed", args.seed)])),
+                              ("comparison", results)])
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
+        print("Comparison written: '{}'".format(args.output))
+
+    if regressions:
+        print("=== {} regressions over baseline ===".format(len(regressions)))
+        sys.exit(1)
+    print("No regressions")
@@ -0,0 +1,224 @@
+"""
+Activity feed error clustering for the json report
+error events are normalized (ids, timestamps, numbers stripped) and hashed into signatures
+the report keeps one representative event per signature - sandboxes only reference it by id, time and signature
+
+python error_signatures.py json-results/<blueprint>/<time_stamp>_<blueprint>.json    (signatures, most common first)
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+from collections import OrderedDict
+
+SETUP_PHASE = "setup"
+TEARDOWN_PHASE = "teardown"
+SIGNATURE_LENGTH = 12
+SUMMARY_LIMIT = 5
+
+# most specific first - a uuid or a timestamp must not be eaten by the number pattern
+_NORMALIZE_PATTERNS = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?"), "<time>"),
+    (re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.IGNORECASE), "<id>"),
+    (re.compile(r"\b(0x[0-9a-f]+|[0-9a-f]{8,})\b", re.IGNORECASE), "<hex>"),
+    (re.compile(r"\b\d{1,3}(\.\d{1,3}){3}(:\d+)?\b"), "<ip>"),
+    (re.compile(r"\d+(\.\d+)?"), "<n>"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_message(message):
+    """
+    :param str message: event text or output
+    :return: message with the parts that differ between sandboxes replaced by placeholders
+    """
+    if not message:
+        return ""
+    normalized = str(message)
+    for pattern, placeholder in _NORMALIZE_PATTERNS:
+        normalized = pattern.sub(placeholder, normalized)
+    return normalized.strip()
+
+
+def get_error_signature(phase, event):
+    """
+    :param str phase: "setup" / "teardown"
+    :param dict event: activity feed event
+    :return: short hash of the phase, event type and normalized text and output
+    """
+    key = "\n".join([phase, event.get("event_type") or "", normalize_message(event.get("event_text")),
+                     normalize_message(event.get("output"))])
+    # interned - thousands of sandbox error references share a handful of signatures
+    return sys.intern(hashlib.sha1(key.encode("utf-8")).hexdigest()[:SIGNATURE_LENGTH])
+
+
+def _get_error_ref(event, signature):
+    """ what is left of an event on its sandbox once the payload moved to the signature """
+    ref = OrderedDict()
+    ref["id"] = event.get("id")
+    ref["time"] = event.get("time")
+    ref["signature"] = signature
+    return ref
+
+
+def get_error_refs(phase, events):
+    """
+    :param str phase: "setup" / "teardown"
+    :param list events: activity feed events, references are kept as they are
+    :return: list of event references - id, time and signature
+    """
+    return [event if "signature" in event and "event_text" not in event
+            else _get_error_ref(event, get_error_signature(phase, event)) for event in events]
+
+
+def _get_example(event):
+    return OrderedDict((key, value) for key, value in event.items() if key != "signature")
+
+
+def _add_occurrence(signatures, signature, phase, sandbox_id, event):
+    entry = signatures.get(signature)
+    if entry is None:
+        entry = OrderedDict()
+        entry["phase"] = phase
+        entry["count"] = 0
+        entry["sandbox_count"] = 0
+        entry["first_seen"] = event.get("time")
+        entry["last_seen"] = event.get("time")
+        entry["message"] = normalize_message(event.get("event_text"))
+        entry["example"] = _get_example(event)
+        entry["sandboxes"] = []
+        signatures[signature] = entry
+    entry["count"] += 1
+    if not entry["sandboxes"] or entry["sandboxes"][-1] != sandbox_id:
+        entry["sandboxes"].append(sandbox_id)
+        entry["sandbox_count"] += 1
+    # activity feed times are ISO 8601 UTC - they sort as strings
+    event_time = event.get("time")
+    if event_time and (not entry["first_seen"] or event_time < entry["first_seen"]):
+        entry["first_seen"] = event_time
+        entry["example"] = _get_example(event)
+    if event_time and (not entry["last_seen"] or event_time > entry["last_seen"]):
+        entry["last_seen"] = event_time
+
+
+def _sort_by_count(signatures):
+    return OrderedDict(sorted(signatures.items(), key=lambda item: item[1]["count"], reverse=True))
+
+
+def build_error_report(sandbox_data_list):
+    """
+    cluster the error events of all sandboxes
+    :param list sandbox_data_list: SandboxErrorData
+    :return: tuple of json ready signature dict (most common first), list of report dicts for the sandboxes
+    """
+    signatures = OrderedDict()
+    sandboxes = []
+    for sb_data in sandbox_data_list:
+        sandbox = sb_data.get_ordered_dict()
+        for phase, key in [(SETUP_PHASE, "setup_errors"), (TEARDOWN_PHASE, "teardown_errors")]:
+            if not sandbox[key]:
+                continue
+            refs = []
+            for event in sandbox[key]:
+                # events read back from a report or journal already carry their signature
+                signature = event.get("signature") or get_error_signature(phase, event)
+                _add_occurrence(signatures, signature, phase, sb_data.sandbox_id, event)
+                refs.append(_get_error_ref(event, signature))
+            sandbox[key] = refs
+        sandboxes.append(sandbox)
+    return _sort_by_count(signatures), sandboxes
+
+
+def merge_error_reports(error_reports):
+    """
+    combine "error_signatures" sections of several json reports - e.g. one per distributed worker
+    :param list error_reports: build_error_report signature dicts
+    :return: json ready signature dict, most common first
+    """
+    merged = OrderedDict()
+    for error_report in error_reports:
+        for signature, entry in error_report.items():
+            if signature not in merged:
+                merged[signature] = OrderedDict(entry)
+                merged[signature]["sandboxes"] = list(entry["sandboxes"])
+                continue
+            target = merged[signature]
+            target["count"] += entry["count"]
+            target["sandboxes"].extend(entry["sandboxes"])
+            target["sandbox_count"] = len(target["sandboxes"])
+            if entry["first_seen"] and (not target["first_seen"] or entry["first_seen"] < target["first_seen"]):
+                target["first_seen"] = entry["first_seen"]
+                target["example"] = entry["example"]
+            if entry["last_seen"] and (not target["last_seen"] or entry["last_seen"] > target["last_seen"]):
+                target["last_seen"] = entry["last_seen"]
+    return _sort_by_count(merged)
+
+
+def expand_error_refs(sandboxes, signatures):
+    """
+    put the representative payload back on each sandbox error, keeping its own id and time
+    reports written before signatures were added hold full events and are returned as they are
+    :param list sandboxes: report sandbox dicts
+    :param dict signatures: "error_signatures" section of the report
+    :return: the same sandbox dicts
+    """
+    for sandbox in sandboxes:
+        for key in ["setup_errors", "teardown_errors"]:
+            events = sandbox.get(key)
+            if not events:
+                continue
+            expanded = []
+            for event in events:
+                entry = signatures.get(event.get("signature"))
+                if entry:
+                    full_event = OrderedDict(entry["example"])
+                    full_event.update(event)
+                    event = full_event
+                expanded.append(event)
+            sandbox[key] = expanded
+    return sandboxes
+
+
+def format_error_summary(signatures, limit=SUMMARY_LIMIT, phase=None):
+    """
+    most common signatures for logging
+    :param dict signatures: build_error_report signature dict
+    :param int limit:
+    :param str phase: only signatures of this phase, all when not passed
+    :return: one line per signature
+    """
+    if phase:
+        signatures = OrderedDict((k, v) for k, v in signatures.items() if v["phase"] == phase)
+    if not signatures:
+        return "no errors"
+    lines = ["{} errors in {} signatures:".format(sum(e["count"] for e in signatures.values()), len(signatures))]
+    for signature, entry in list(signatures.items())[:limit]:
+        lines.append("  {} [{}] x{} on {} sandboxes, {} - {}: {}".format(
+            signature, entry["phase"], entry["count"], entry["sandbox_count"], entry["first_seen"],
+            entry["last_seen"], entry["message"]))
+    if len(signatures) > limit:
+        lines.append("  ... {} more".format(len(signatures) - limit))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Error signatures of a json results report")
+    parser.add_argument("json_path", help="json-results/<blueprint>/<time_stamp>_<blueprint>.json")
+    parser.add_argument("--limit", type=int, default=20, help="signatures to print")
+    parser.add_argument("--example", action="store_true", help="print the representative event of each signature")
+    args = parser.parse_args()
+
+    with open(args.json_path) as f:
+        report = json.load(f, object_pairs_hook=OrderedDict)
+    report_signatures = report.get("error_signatures") if isinstance(report, dict) else None
+    if report_signatures is None:
+        # report from before signatures - cluster the full events it holds
+        from common import SandboxErrorData
+        report_sandboxes = report if isinstance(report, list) else report["sandboxes"]
+        report_signatures, _ = build_error_report([SandboxErrorData(**{k: v for k, v in s.items() if k != "worker"})
+                                                   for s in report_sandboxes])
+    print(format_error_summary(report_signatures, args.limit))
+    if args.example:
+        for report_signature, report_entry in list(report_signatures.items())[:args.limit]:
+            print("\n{}\n{}".format(report_signature, json.dumps(report_entry["example"], indent=4)))
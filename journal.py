@@ -0,0 +1,224 @@
+"""
+Crash-safe results journal - append-only json lines next to the json results report
+every sandbox change is one line with a snapshot of its SandboxErrorData, so a write costs one sandbox, not the run
+activity feed errors get a line of their own, written once - snapshots and memory only hold references to them
+the report is compacted from the journal (latest snapshot per sandbox) when a phase ends, fails or is interrupted
+
+python journal.py json-results/<blueprint>/<time_stamp>_<blueprint>.jsonl    (rebuild the report after a crash)
+or rerun the flow with --resume to carry on from the journal
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from time import time
+
+import error_signatures
+import latency
+from common import SandboxErrorData, write_json_report, cap_error_events
+
+JOURNAL_FILE_TYPE = "jsonl"
+DEFAULT_SYNC_INTERVAL_SECONDS = 1
+DEFAULT_SYNC_BATCH_SIZE = 1000
+
+
+def get_journal_path(json_file_path):
+    """
+    :param str json_file_path: json results report
+    :return: journal path - same name, jsonl file type
+    """
+    return "{}.{}".format(os.path.splitext(json_file_path)[0], JOURNAL_FILE_TYPE)
+
+
+class ResultsJournal(object):
+    def __init__(self, journal_path, sync_interval_seconds=DEFAULT_SYNC_INTERVAL_SECONDS,
+                 sync_batch_size=DEFAULT_SYNC_BATCH_SIZE):
+        """
+        lines are flushed to the os on every write, so they survive the process dying
+        fsync is batched - at most sync_interval_seconds / sync_batch_size lines are exposed to a machine crash
+        :param str journal_path: appended to when it exists, start and stop share one journal
+        :param float sync_interval_seconds:
+        :param int sync_batch_size:
+        """
+        self.journal_path = journal_path
+        self._sync_interval_seconds = sync_interval_seconds
+        self._sync_batch_size = sync_batch_size
+        os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+        self._file = open(journal_path, "a")
+        if self._file.tell() and not _ends_with_newline(journal_path):
+            # end a line torn by a crash, so the next line is not glued to it
+            self._file.write("\n")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._synced_at = time()
+        self._polled_states = {}
+
+    def record(self, sb_data, state=None):
+        """
+        :param SandboxErrorData sb_data:
+        :param str state: sandbox state last seen, None when not polled since the last request
+        """
+        line = json.dumps({"t": round(time(), 3), "state": state, "sandbox": sb_data.get_ordered_dict()})
+        with self._lock:
+            self._polled_states[sb_data.sandbox_id] = (_intern(state), None)
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self._sync_batch_size or time() - self._synced_at >= self._sync_interval_seconds:
+                self._sync()
+
+    def record_errors(self, sb_data, phase, events):
+        """
+        journal the full error events and keep only their references on the sandbox, capped by cap_error_events
+        the report is compacted from the journal, so it still has every event
+        :param SandboxErrorData sb_data:
+        :param str phase: "setup" / "teardown"
+        :param list events: activity feed events
+        """
+        if not events:
+            return
+        line = json.dumps({"t": round(time(), 3), "sandbox_id": sb_data.sandbox_id, "phase": phase,
+                           "errors": events})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._unsynced += 1
+        refs = error_signatures.get_error_refs(phase, cap_error_events(events))
+        if phase == error_signatures.SETUP_PHASE:
+            sb_data.setup_errors = refs
+        else:
+            sb_data.teardown_errors = refs
+
+    def record_poll(self, sb_data, state, setup_stage=None):
+        """
+        polls that saw no change are not written
+        :param SandboxErrorData sb_data:
+        :param str state:
+        :param str setup_stage:
+        """
+        if self._polled_states.get(sb_data.sandbox_id) == (state, setup_stage):
+            return
+        self.record(sb_data, state)
+        self._polled_states[sb_data.sandbox_id] = (_intern(state), _intern(setup_stage))
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+
+
+def _intern(value):
+    return sys.intern(value) if value else value
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def read_journal(journal_path, expand_errors=True):
+    """
+    latest entry per sandbox, in order of first appearance
+    a line torn by a crash mid-write is skipped
+    :param str journal_path:
+    :param bool expand_errors: replace error references with the journaled events, else keep the references
+    :return: OrderedDict of sandbox id to {"t", "state", "sandbox"}
+    """
+    latest = OrderedDict()
+    errors = {}
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "errors" in entry:
+                if expand_errors:
+                    errors[(entry["sandbox_id"], entry["phase"])] = entry["errors"]
+                continue
+            latest[entry["sandbox"]["sandbox_id"]] = entry
+    for (sandbox_id, phase), events in errors.items():
+        if sandbox_id in latest:
+            latest[sandbox_id]["sandbox"]["{}_errors".format(phase)] = events
+    return latest
+
+
+def read_journal_sandboxes(journal_path, expand_errors=True):
+    """
+    :param str journal_path:
+    :param bool expand_errors: see read_journal
+    :return: list of SandboxErrorData
+    """
+    return [SandboxErrorData(**entry["sandbox"]) for entry in read_journal(journal_path, expand_errors).values()]
+
+
+def compact_journal(journal_path, json_file_path, api_summary=None, phase=None):
+    """
+    write the json results report from the journal
+    :param str journal_path:
+    :param str json_file_path:
+    :param dict api_summary: see write_json_report
+    :param str phase:
+    :return: list of SandboxErrorData in the report
+    """
+    sandbox_data_list = read_journal_sandboxes(journal_path)
+    write_json_report(json_file_path, sandbox_data_list, api_summary, phase)
+    return sandbox_data_list
+
+
+def is_teardown_started(journal_path):
+    """
+    :param str journal_path:
+    :return: True when a stop request was journaled for any sandbox
+    """
+    if not os.path.exists(journal_path):
+        return False
+    return any(latency.STOP_REQUESTED in entry["sandbox"]["timings"]
+               for entry in read_journal(journal_path, expand_errors=False).values())
+
+
+def resume_from_journal(journal, listed_sandboxes, sandbox_name, logger, is_mixed_workload=False):
+    """
+    sandboxes of an interrupted run - everything in the journal, plus live sandboxes named like the run
+    that never made it there (the process died between the start request and the journal write)
+    sandboxes found by name are journaled
+    :param ResultsJournal journal:
+    :param dict listed_sandboxes: get_sandboxes_by_id output
+    :param str sandbox_name: get_sandbox_name of the run
+    :param logging.Logger logger:
+    :param bool is_mixed_workload: sandboxes found by name are tagged with the blueprint they were listed with
+    :return: list of SandboxErrorData
+    """
+    sandbox_data_list = read_journal_sandboxes(journal.journal_path, expand_errors=False)
+    known_ids = set(sb_data.sandbox_id for sb_data in sandbox_data_list)
+    found_count = 0
+    for sandbox_id, details in listed_sandboxes.items():
+        if details.get("name") == sandbox_name and sandbox_id not in known_ids:
+            blueprint_id = details.get("blueprint_id") if is_mixed_workload else None
+            sb_data = SandboxErrorData(sandbox_id, blueprint_id=blueprint_id)
+            journal.record(sb_data, details.get("state"))
+            sandbox_data_list.append(sb_data)
+            found_count += 1
+    logger.info("Resuming {} sandboxes - {} from journal, {} found by name '{}'".format(
+        len(sandbox_data_list), len(sandbox_data_list) - found_count, found_count, sandbox_name))
+    return sandbox_data_list
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the json results report from a results journal")
+    parser.add_argument("journal_path", help="json-results/<blueprint>/<time_stamp>_<blueprint>.jsonl")
+    args = parser.parse_args()
+
+    report_path = "{}.json".format(os.path.splitext(args.journal_path)[0])
+    sandboxes = compact_journal(args.journal_path, report_path)
+    print("JSON data file written: '{}', {} sandboxes".format(report_path, len(sandboxes)))
@@ -0,0 +1,189 @@
+"""
+Latency histograms for the json report
+log-bucketed like HDR histogram - fixed 1% relative precision, constant memory, mergeable across runs / workers
+"""
+import math
+from collections import OrderedDict
+
+# TIMING EVENT KEYS ON SandboxErrorData.timings
+START_REQUESTED = "start_requested"
+START_ACKNOWLEDGED = "start_acknowledged"
+FIRST_NON_PENDING = "first_non_pending"
+SETUP_STAGES = "setup_stages"
+SETUP_FINISHED = "setup_finished"
+STOP_REQUESTED = "stop_requested"
+STOP_ACKNOWLEDGED = "stop_acknowledged"
+ENDED = "ended"
+
+RELATIVE_PRECISION = 0.01
+REPORTED_PERCENTILES = (50, 90, 99)
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        """ values are seconds, bucket i holds values in [base^i, base^(i+1)) """
+        self._log_base = math.log(1 + RELATIVE_PRECISION)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        seconds = max(seconds, 0.001)
+        bucket = int(math.floor(math.log(seconds) / self._log_base))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        """
+        :param LatencyHistogram other: may still be recorded to by another thread - its buckets are copied first
+        """
+        for bucket, count in list(other.buckets.items()):
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        :param float percent: 0 - 100
+        :return: seconds, upper edge of the bucket holding the percentile (exact for max)
+        """
+        if not self.count:
+            return None
+        target = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(math.exp((bucket + 1) * self._log_base), self.max)
+        return self.max
+
+    def get_cumulative_counts(self, upper_bounds):
+        """
+        counts at or below each bound, like prometheus histogram buckets - within the 1% bucket precision
+        :param list upper_bounds: sorted seconds
+        :return: list of counts, one per bound
+        """
+        counts = []
+        seen = 0
+        buckets = sorted(self.buckets.items())
+        index = 0
+        for upper_bound in upper_bounds:
+            while index < len(buckets) and math.exp((buckets[index][0] + 1) * self._log_base) <= upper_bound:
+                seen += buckets[index][1]
+                index += 1
+            counts.append(seen)
+        return counts
+
+    def to_dict(self):
+        """ summary for the report, buckets included so histograms can be merged later """
+        summary = OrderedDict()
+        summary["count"] = self.count
+        if not self.count:
+            return summary
+        summary["min"] = round(self.min, 3)
+        summary["mean"] = round(self.total / self.count, 3)
+        for percent in REPORTED_PERCENTILES:
+            summary["p{}".format(percent)] = round(self.percentile(percent), 3)
+        summary["max"] = round(self.max, 3)
+        summary["buckets"] = {str(k): v for k, v in sorted(self.buckets.items())}
+        return summary
+
+    @classmethod
+    def from_dict(cls, data):
+        """ rebuild from to_dict output """
+        histogram = cls()
+        for bucket, count in data.get("buckets", {}).items():
+            histogram.buckets[int(bucket)] = count
+        histogram.count = data.get("count", 0)
+        if histogram.count:
+            histogram.total = data["mean"] * histogram.count
+            histogram.min = data["min"]
+            histogram.max = data["max"]
+        return histogram
+
+
+def _record_interval(histograms, name, timings, start_key, end_key):
+    start, end = timings.get(start_key), timings.get(end_key)
+    if start is not None and end is not None:
+        histograms.setdefault(name, LatencyHistogram()).record(end - start)
+
+
+def build_latency_histograms(sandbox_data_list):
+    """
+    :param list sandbox_data_list: SandboxErrorData with timings
+    :return: dict of phase name to histogram, dict of setup stage to histogram
+    """
+    phases = OrderedDict()
+    stages = OrderedDict()
+    for sb_data in sandbox_data_list:
+        timings = sb_data.timings
+        _record_interval(phases, "start_request", timings, START_REQUESTED, START_ACKNOWLEDGED)
+        _record_interval(phases, "time_to_first_non_pending", timings, START_REQUESTED, FIRST_NON_PENDING)
+        _record_interval(phases, "setup", timings, START_REQUESTED, SETUP_FINISHED)
+        _record_interval(phases, "stop_request", timings, STOP_REQUESTED, STOP_ACKNOWLEDGED)
+        _record_interval(phases, "teardown", timings, STOP_REQUESTED, ENDED)
+
+        # a stage lasts until the next stage is seen, the last one until setup finished
+        stage_marks = timings.get(SETUP_STAGES, [])
+        stage_ends = [mark[1] for mark in stage_marks[1:]] + [timings.get(SETUP_FINISHED)]
+        for (stage, stage_start), stage_end in zip(stage_marks, stage_ends):
+            if stage_end is not None:
+                stages.setdefault(stage, LatencyHistogram()).record(stage_end - stage_start)
+    return phases, stages
+
+
+def build_latency_report(sandbox_data_list):
+    """
+    :param list sandbox_data_list:
+    :return: json ready dict with "phases" and "setup_stages" histogram summaries
+    """
+    phases, stages = build_latency_histograms(sandbox_data_list)
+    return get_latency_report(phases, stages)
+
+
+def get_latency_report(phases, stages):
+    """
+    :param dict phases: phase name to histogram
+    :param dict stages: setup stage to histogram
+    :return: json ready dict with "phases" and "setup_stages" histogram summaries
+    """
+    report = OrderedDict()
+    report["phases"] = OrderedDict((name, h.to_dict()) for name, h in phases.items())
+    report["setup_stages"] = OrderedDict((name, h.to_dict()) for name, h in stages.items())
+    return report
+
+
+def merge_latency_reports(latency_reports):
+    """
+    combine "latency" sections of several json reports - e.g. one per distributed worker
+    :param list latency_reports: build_latency_report outputs
+    :return: dict of phase name to histogram, dict of setup stage to histogram
+    """
+    phases = OrderedDict()
+    stages = OrderedDict()
+    for latency_report in latency_reports:
+        for merged, section in [(phases, "phases"), (stages, "setup_stages")]:
+            for name, summary in latency_report.get(section, {}).items():
+                merged.setdefault(name, LatencyHistogram()).merge(LatencyHistogram.from_dict(summary))
+    return phases, stages
+
+
+def format_latency_summary(histogram):
+    """
+    one line percentile summary for logging
+    :param LatencyHistogram histogram:
+    :return:
+    """
+    if not histogram or not histogram.count:
+        return "no samples"
+    return "count {}, p50 {:.1f}s, p90 {:.1f}s, p99 {:.1f}s, max {:.1f}s".format(
+        histogram.count, histogram.percentile(50), histogram.percentile(90), histogram.percentile(99),
+        histogram.max)
@@ -1,7 +1,7 @@
 import logging
 
 
-def get_logger(log_file_path):
+def get_logger(log_file_path, log_to_console=True):
     logger = logging.getLogger("sandbox_reporting_logger")
     logger.setLevel(logging.INFO)
 
@@ -16,7 +16,8 @@ def get_logger(log_file_path):
     stream_handler.setFormatter(formatter)
 
     logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    if log_to_console:
+        logger.addHandler(stream_handler)
     return logger
 
 
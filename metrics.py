@@ -0,0 +1,229 @@
+"""
+Live run metrics in the prometheus text format - GET http://<host>:<port>/metrics while a run is going
+sandbox states and launch / ready / end counts come from the polling loops, api stats from the SandboxRest hook
+
+the polling loops only store a state or bump a counter, and only while the exporter runs
+everything else - state counts, rates, histogram buckets - is worked out when the endpoint is scraped
+"""
+import threading
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import time
+
+import my_globals
+
+DEFAULT_METRICS_PORT = 9108
+# local only unless "host" says otherwise - the endpoint has no auth
+DEFAULT_METRICS_HOST = "127.0.0.1"
+METRIC_PREFIX = "sandbox_harness"
+RATE_WINDOW_SECONDS = 60
+MAX_WINDOW_EVENTS = 100000
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# SANDBOX EVENTS COUNTED BY THE POLLING LOOPS
+LAUNCHED = "launched"
+READY = "ready"
+SETUP_FAILED = "setup_failed"
+STOP_REQUESTED = "stop_requested"
+ENDED = "ended"
+TEARDOWN_FAILED = "teardown_failed"
+EVENTS = [LAUNCHED, READY, SETUP_FAILED, STOP_REQUESTED, ENDED, TEARDOWN_FAILED]
+
+# SECONDS - request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class RunMetrics(object):
+    def __init__(self):
+        """ sandbox side of the metrics - every method is a no-op until the exporter is started """
+        self.enabled = False
+        self._states = {}
+        self._event_counts = dict.fromkeys(EVENTS, 0)
+        self._event_times = {event: deque(maxlen=MAX_WINDOW_EVENTS) for event in EVENTS}
+        self._lock = threading.Lock()
+
+    def record_state(self, sandbox_id, state):
+        """
+        latest state seen for a sandbox. Ended sandboxes drop out - a soak would otherwise keep every sandbox
+        :param str sandbox_id:
+        :param str state:
+        """
+        if not self.enabled:
+            return
+        if state == my_globals.SANDBOX_ENDED_STATE:
+            self._states.pop(sandbox_id, None)
+        else:
+            self._states[sandbox_id] = state
+
+    def forget_sandbox(self, sandbox_id):
+        """ drop a sandbox the run stopped tracking before it Ended, e.g. a teardown that timed out """
+        self._states.pop(sandbox_id, None)
+
+    def record_event(self, event):
+        """
+        :param str event: one of EVENTS
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._event_counts[event] += 1
+            self._event_times[event].append(time())
+
+    def get_state_counts(self):
+        """ :return: dict of state to sandbox count """
+        counts = {}
+        # dict.copy is a single step under the GIL, safe while the polling loop writes
+        for state in self._states.copy().values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def get_event_counts(self):
+        with self._lock:
+            return dict(self._event_counts)
+
+    def get_event_rates(self):
+        """ :return: dict of event to events per minute over the last RATE_WINDOW_SECONDS """
+        window_start = time() - RATE_WINDOW_SECONDS
+        with self._lock:
+            rates = {}
+            for event, times in self._event_times.items():
+                while times and times[0] < window_start:
+                    times.popleft()
+                rates[event] = len(times) * 60.0 / RATE_WINDOW_SECONDS
+            return rates
+
+
+# ONE PER PROCESS - the polling loops record here, the exporter reads it
+run_metrics = RunMetrics()
+_exporter = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels.items()) + "}"
+
+
+def _add_metric(lines, name, metric_type, help_text, samples):
+    """
+    :param list lines: exposition text lines, appended to
+    :param str name: without prefix
+    :param str metric_type: "gauge" / "counter" / "histogram"
+    :param str help_text:
+    :param list samples: tuples of (name suffix, labels dict, value)
+    """
+    full_name = "{}_{}".format(METRIC_PREFIX, name)
+    lines.append("# HELP {} {}".format(full_name, help_text))
+    lines.append("# TYPE {} {}".format(full_name, metric_type))
+    for suffix, labels, value in samples:
+        lines.append("{}{}{} {}".format(full_name, suffix, _format_labels(labels), _format_value(value)))
+
+
+def _format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(round(value, 6))
+    return str(int(value))
+
+
+def _get_histogram_samples(endpoint, histogram):
+    samples = []
+    for upper_bound, count in zip(LATENCY_BUCKETS, histogram.get_cumulative_counts(LATENCY_BUCKETS)):
+        samples.append(("_bucket", OrderedDict([("endpoint", endpoint), ("le", str(upper_bound))]), count))
+    samples.append(("_bucket", OrderedDict([("endpoint", endpoint), ("le", "+Inf")]), histogram.count))
+    samples.append(("_sum", {"endpoint": endpoint}, histogram.total))
+    samples.append(("_count", {"endpoint": endpoint}, histogram.count))
+    return samples
+
+
+def render_metrics(metrics, sb_rest=None):
+    """
+    :param RunMetrics metrics:
+    :param SandboxRest sb_rest: api metrics are left out when None or not instrumented
+    :return: prometheus text exposition
+    """
+    lines = []
+    _add_metric(lines, "sandboxes", "gauge", "Sandboxes by last polled state, Ended sandboxes excluded",
+                [("", {"state": state}, count) for state, count in sorted(metrics.get_state_counts().items())])
+    _add_metric(lines, "sandbox_events_total", "counter", "Sandbox launches, setup / teardown outcomes and stops",
+                [("", {"event": event}, count) for event, count in metrics.get_event_counts().items()])
+    _add_metric(lines, "sandbox_events_per_minute", "gauge",
+                "Sandbox events per minute over the last {} seconds".format(RATE_WINDOW_SECONDS),
+                [("", {"event": event}, rate) for event, rate in metrics.get_event_rates().items()])
+    if sb_rest is None:
+        return "\n".join(lines) + "\n"
+
+    _add_metric(lines, "api_requests_in_flight", "gauge", "Sandbox API requests sent and not answered yet",
+                [("", {}, sb_rest.get_in_flight_count())])
+    current_rate = sb_rest.get_current_rate()
+    if current_rate is not None:
+        _add_metric(lines, "api_rate_budget_per_second", "gauge", "Adaptive client side request rate, all accounts",
+                    [("", {}, current_rate)])
+    instrumentation = sb_rest.get_instrumentation()
+    if instrumentation is None or not hasattr(instrumentation, "get_lifetime_stats"):
+        return "\n".join(lines) + "\n"
+
+    endpoint_stats = instrumentation.get_lifetime_stats()
+    status_samples = []
+    for endpoint, stats in endpoint_stats.items():
+        for status, count in sorted(stats.status_codes.items()):
+            status_samples.append(("", OrderedDict([("endpoint", endpoint), ("status", status)]), count))
+    _add_metric(lines, "api_requests_total", "counter", "Sandbox API request attempts by endpoint and status",
+                status_samples)
+    _add_metric(lines, "api_throttles_total", "counter", "Rate quota responses (429 / 503) by endpoint",
+                [("", {"endpoint": endpoint}, stats.throttles) for endpoint, stats in endpoint_stats.items()])
+    latency_samples = []
+    for endpoint, stats in endpoint_stats.items():
+        latency_samples.extend(_get_histogram_samples(endpoint, stats.latencies["total"]))
+    _add_metric(lines, "api_request_seconds", "histogram", "Sandbox API request latency by endpoint",
+                latency_samples)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics(run_metrics, self.server.sb_rest).encode("utf-8")
+        except Exception as e:
+            # a failed scrape is the scraper's problem, never the run's
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ scrapes are not logged """
+        pass
+
+
+def start_metrics_exporter(sb_rest, port=DEFAULT_METRICS_PORT, host=DEFAULT_METRICS_HOST, logger=None):
+    """
+    serve /metrics on a daemon thread - once per process, later calls only switch the api session
+    a port that is taken is logged and the run goes on without metrics
+    :param SandboxRest sb_rest:
+    :param int port:
+    :param str host:
+    :param logging.Logger logger:
+    :return: True when the exporter is running
+    """
+    global _exporter
+    if _exporter is None:
+        try:
+            _exporter = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        except OSError as e:
+            if logger:
+                logger.warning("Metrics endpoint not started on {}:{}: {}".format(host, port, str(e)))
+            return False
+        _exporter.daemon_threads = True
+        threading.Thread(target=_exporter.serve_forever, name="metrics-exporter", daemon=True).start()
+        if logger:
+            logger.info("Metrics at http://{}:{}/metrics".format(host, port))
+    _exporter.sb_rest = sb_rest
+    run_metrics.enabled = True
+    return True
@@ -0,0 +1,482 @@
+"""
+Local stand-in for the Sandbox REST API - drive the harness end to end without a CloudShell server
+every endpoint SandboxRest touches is served, sandboxes run simulated setup / teardown state machines
+
+sandbox timelines are drawn up front when a sandbox is started or stopped and state is read off the clock,
+so there are no background threads per sandbox and thousands of sandboxes are cheap
+
+python mock_server.py --port 82 --config mock_config.json
+"""
+import argparse
+import bisect
+import json
+import math
+import random
+import threading
+import typing
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import time, sleep
+from urllib.parse import urlsplit, parse_qs
+
+from sb_rest.instrumentation import get_endpoint_template
+
+SETUP_STAGES = ["Provisioning", "Connectivity", "Configuration"]
+ISO_8601_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class MockConfig(typing.NamedTuple):
+    """
+    durations are distribution specs - {"type": "constant", "seconds": 5}, {"type": "uniform", "min": 1, "max": 5},
+    {"type": "exponential", "mean": 5}, {"type": "normal", "mean": 5, "stddev": 1},
+    {"type": "lognormal", "median": 5, "sigma": 0.5}
+    """
+    response_latency: dict = {"type": "lognormal", "median": 0.02, "sigma": 0.5}
+    pending_seconds: dict = {"type": "uniform", "min": 1, "max": 5}
+    stage_seconds: dict = {"type": "lognormal", "median": 20, "sigma": 0.4}
+    teardown_seconds: dict = {"type": "lognormal", "median": 15, "sigma": 0.4}
+    execution_queue_seconds: dict = {"type": "constant", "seconds": 0}
+    execution_seconds: dict = {"type": "constant", "seconds": 5}
+    time_scale: float = 1.0
+    setup_error_rate: float = 0
+    teardown_error_rate: float = 0
+    command_error_rate: float = 0
+    http_error_rate: float = 0
+    rate_quota_per_second: float = 0
+    rate_quota_burst: int = 10
+    retry_after_seconds: float = 1
+    token_ttl_seconds: float = 0
+    activity_page_size: int = 100
+    events_per_stage: int = 3
+    console_lines_per_stage: int = 5
+    components_per_sandbox: int = 2
+    seed: typing.Optional[int] = None
+
+
+def load_mock_config(path=None):
+    """
+    :param str path: json file with any MockConfig fields, None for defaults
+    :return:
+    """
+    data = {}
+    if path:
+        with open(path) as f:
+            data = json.load(f)
+    unknown_fields = set(data) - set(MockConfig._fields)
+    if unknown_fields:
+        raise Exception("Unknown mock config fields: {}".format(sorted(unknown_fields)))
+    return MockConfig(**{field: data.get(field, default) for field, default in MockConfig._field_defaults.items()})
+
+
+def sample_seconds(spec, rng):
+    """
+    :param dict spec: distribution spec, see MockConfig
+    :param random.Random rng:
+    :return: non negative seconds
+    """
+    distribution = spec.get("type", "constant")
+    if distribution == "constant":
+        seconds = spec["seconds"]
+    elif distribution == "uniform":
+        seconds = rng.uniform(spec["min"], spec["max"])
+    elif distribution == "exponential":
+        seconds = rng.expovariate(1.0 / spec["mean"]) if spec["mean"] else 0
+    elif distribution == "normal":
+        seconds = rng.normalvariate(spec["mean"], spec["stddev"])
+    elif distribution == "lognormal":
+        seconds = rng.lognormvariate(math.log(spec["median"]), spec["sigma"]) if spec["median"] else 0
+    else:
+        raise Exception("Unknown distribution type '{}'".format(distribution))
+    return max(seconds, 0)
+
+
+def _iso_time(epoch_seconds):
+    moment = datetime.utcfromtimestamp(epoch_seconds)
+    return "{}.{:03d}Z".format(moment.strftime(ISO_8601_FORMAT), moment.microsecond // 1000)
+
+
+def _parse_iso_time(value):
+    return (datetime.strptime(value[:19], ISO_8601_FORMAT) - datetime(1970, 1, 1)).total_seconds()
+
+
+class _QuotaBucket(object):
+    def __init__(self, per_second, burst):
+        """ server side quota - non blocking, a request either gets a token or a 429 """
+        self._per_second = per_second
+        self._capacity = max(burst, 1)
+        self._tokens = float(self._capacity)
+        self._updated_at = time()
+        self._lock = threading.Lock()
+
+    def try_take(self):
+        with self._lock:
+            now = time()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._per_second)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class MockSandbox(object):
+    def __init__(self, sandbox_id, name, blueprint_id, config, rng):
+        """
+        setup timeline is drawn on start: pending, then one duration per setup stage
+        a failing sandbox goes to Error at the end of a random stage
+        :param str sandbox_id:
+        :param str name:
+        :param str blueprint_id:
+        :param MockConfig config:
+        :param random.Random rng:
+        """
+        self.id = sandbox_id
+        self.name = name
+        self.blueprint_id = blueprint_id
+        self.created_at = time()
+        self.stop_requested_at = None
+        self.ended_at = None
+        self.components = [{"id": str(uuid.uuid4()), "name": "Resource {}".format(i + 1), "component_type": "Resource"}
+                           for i in range(config.components_per_sandbox)]
+        self._config = config
+        self._rng = rng
+        self._events = []
+        self._event_times = []
+        self._console = []
+        self._console_times = []
+
+        scale = config.time_scale
+        self.setup_started_at = self.created_at + sample_seconds(config.pending_seconds, rng) * scale
+        self.stage_ends = []
+        stage_end = self.setup_started_at
+        for _ in SETUP_STAGES:
+            stage_end += sample_seconds(config.stage_seconds, rng) * scale
+            self.stage_ends.append(stage_end)
+        self.failed_stage = None
+        if rng.random() < config.setup_error_rate:
+            self.failed_stage = rng.randrange(len(SETUP_STAGES))
+            self.stage_ends = self.stage_ends[:self.failed_stage + 1]
+        self.setup_finished_at = self.stage_ends[-1]
+
+        self._add_event(self.created_at, "success", "Sandbox '{}' has started".format(name))
+        stage_start = self.setup_started_at
+        for i, stage_end in enumerate(self.stage_ends):
+            self._add_stage_output(SETUP_STAGES[i], stage_start, stage_end)
+            stage_start = stage_end
+        if self.failed_stage is not None:
+            self._add_event(self.setup_finished_at, "error", "Setup failed in stage '{}'".format(
+                SETUP_STAGES[self.failed_stage]), "Simulated setup error")
+        else:
+            self._add_event(self.setup_finished_at, "success", "Sandbox '{}' setup is complete".format(name))
+
+    def _add_event(self, at, event_type, text, output=""):
+        event = {"id": len(self._events) + 1, "event_type": event_type, "event_text": text, "output": output,
+                 "time": _iso_time(at)}
+        self._events.append(event)
+        self._event_times.append(at)
+
+    def _add_console(self, at, text):
+        self._console.append({"id": str(len(self._console) + 1), "time": _iso_time(at), "text": text})
+        self._console_times.append(at)
+
+    def _add_stage_output(self, stage, start, end):
+        """ activity events and console lines spread evenly over a stage """
+        for i in range(self._config.events_per_stage):
+            at = start + (end - start) * i / max(self._config.events_per_stage, 1)
+            self._add_event(at, "info", "{}: step {}".format(stage, i + 1))
+        for i in range(self._config.console_lines_per_stage):
+            at = start + (end - start) * i / max(self._config.console_lines_per_stage, 1)
+            self._add_console(at, "[{}] output line {}".format(stage, i + 1))
+
+    def stop(self, now):
+        """
+        draw the teardown timeline. setup still running is cut short
+        :param float now:
+        """
+        cut = bisect.bisect_right(self._event_times, now)
+        del self._events[cut:], self._event_times[cut:]
+        cut = bisect.bisect_right(self._console_times, now)
+        del self._console[cut:], self._console_times[cut:]
+        self.stop_requested_at = now
+        self.ended_at = now + sample_seconds(self._config.teardown_seconds, self._rng) * self._config.time_scale
+        self._add_stage_output("Teardown", now, self.ended_at)
+        if self._rng.random() < self._config.teardown_error_rate:
+            self._add_event(self.ended_at, "error", "Teardown failed", "Simulated teardown error")
+        self._add_event(self.ended_at, "success", "Sandbox '{}' has ended".format(self.name))
+
+    def get_state(self, now):
+        """
+        :param float now:
+        :return: (state, setup_stage)
+        """
+        if self.ended_at is not None:
+            return ("Ended", "Ended") if now >= self.ended_at else ("Teardown", "Ended")
+        if now < self.setup_started_at:
+            return "Pending", "None"
+        if now >= self.setup_finished_at:
+            if self.failed_stage is not None:
+                return "Error", SETUP_STAGES[self.failed_stage]
+            return "Ready", "Ended"
+        return "Setup", SETUP_STAGES[bisect.bisect_right(self.stage_ends, now)]
+
+    def get_details(self, now, include_stage=True):
+        state, setup_stage = self.get_state(now)
+        details = OrderedDict([("id", self.id), ("name", self.name), ("blueprint_id", self.blueprint_id),
+                               ("state", state)])
+        if include_stage:
+            details["setup_stage"] = setup_stage
+            details["components"] = self.components
+        return details
+
+    def get_activity(self, now, error_only=False, since="", from_event_id="", tail="", page_size=100):
+        visible = self._events[:bisect.bisect_right(self._event_times, now)]
+        if error_only:
+            visible = [event for event in visible if event["event_type"] == "error"]
+        if since:
+            since_seconds = _parse_iso_time(since)
+            visible = [event for event in visible if _parse_iso_time(event["time"]) >= since_seconds]
+        if from_event_id:
+            visible = [event for event in visible if event["id"] >= int(from_event_id)]
+        if tail:
+            visible = visible[-int(tail):]
+        page = visible[:page_size]
+        more_pages = len(visible) > page_size
+        return OrderedDict([("num_returned_events", len(page)),
+                            ("more_pages", more_pages),
+                            ("next_event_id", visible[page_size]["id"] if more_pages else None),
+                            ("events", page)])
+
+    def get_console(self, now, tail=0):
+        visible = self._console[:bisect.bisect_right(self._console_times, now)]
+        return {"entries": visible[-int(tail):] if tail else visible}
+
+
+class MockSandboxApi(object):
+    def __init__(self, config):
+        """
+        server state shared by all handler threads
+        :param MockConfig config:
+        """
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._sandboxes = OrderedDict()
+        self._executions = {}
+        self._tokens = {}
+        # one quota per user, like the real server - a pool of accounts gets more throughput
+        self._quotas = {}
+        self.request_counts = {}
+        self.logins_by_user = {}
+
+    def _count(self, key):
+        with self._lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def handle(self, method, path, query, headers, body):
+        """
+        :return: (status, json body or raw text, extra headers)
+        """
+        self._count("{} {}".format(method, get_endpoint_template(path)))
+        with self._lock:
+            delay = sample_seconds(self.config.response_latency, self._rng)
+            is_http_error = self._rng.random() < self.config.http_error_rate
+        sleep(delay)
+
+        if path.startswith("/mock/"):
+            return self._handle_mock(path)
+        if path == "/api/login" and method == "PUT":
+            return self._login(body.get("username", ""))
+        username = self._get_token_user(headers.get("Authorization", ""))
+        if username is None:
+            return 401, {"errorCategory": "Authentication", "message": "Login token is not valid"}, {}
+        quota = self._get_quota(username)
+        if quota and not quota.try_take():
+            return 429, "rate quota exceeded", {"Retry-After": str(self.config.retry_after_seconds)}
+        if is_http_error:
+            return 500, {"message": "Simulated server error"}, {}
+
+        segments = [segment for segment in path.split("/") if segment][2:]
+        now = time()
+        with self._lock:
+            return self._route(method, segments, query, body, now)
+
+    def _login(self, username):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = (time(), username)
+            self.logins_by_user[username] = self.logins_by_user.get(username, 0) + 1
+        return 200, '"{}"'.format(token), {}
+
+    def _get_token_user(self, authorization):
+        """ :return: user the token was issued to, None when unknown or expired """
+        token = authorization.replace("Basic ", "", 1)
+        with self._lock:
+            issued_at, username = self._tokens.get(token, (None, None))
+        if issued_at is None:
+            return None
+        if self.config.token_ttl_seconds and time() - issued_at >= self.config.token_ttl_seconds:
+            return None
+        return username
+
+    def _get_quota(self, username):
+        if not self.config.rate_quota_per_second:
+            return None
+        with self._lock:
+            if username not in self._quotas:
+                self._quotas[username] = _QuotaBucket(self.config.rate_quota_per_second, self.config.rate_quota_burst)
+            return self._quotas[username]
+
+    def _route(self, method, segments, query, body, now):
+        if segments[:1] == ["blueprints"] and len(segments) == 3 and segments[2] == "start" and method == "POST":
+            sandbox = MockSandbox(str(uuid.uuid4()), body.get("name", ""), segments[1], self.config, self._rng)
+            self._sandboxes[sandbox.id] = sandbox
+            return 200, sandbox.get_details(now), {}
+        if segments == ["sandboxes"] and method == "GET":
+            show_historic = query.get("show_historic", ["false"])[0] == "true"
+            return 200, [sandbox.get_details(now, include_stage=False) for sandbox in self._sandboxes.values()
+                         if show_historic or sandbox.get_state(now)[0] != "Ended"], {}
+        if segments[:1] == ["executions"] and len(segments) == 2 and method == "GET":
+            return self._get_execution(segments[1], now)
+        if segments[:1] != ["sandboxes"] or len(segments) < 2:
+            return 404, {"message": "Unknown endpoint"}, {}
+
+        sandbox = self._sandboxes.get(segments[1])
+        if sandbox is None:
+            return 404, {"message": "Sandbox '{}' not found".format(segments[1])}, {}
+        action = segments[2:]
+        if not action and method == "GET":
+            return 200, sandbox.get_details(now), {}
+        if action == ["stop"] and method == "POST":
+            if sandbox.stop_requested_at is not None:
+                return 400, {"message": "Sandbox '{}' is already ending".format(sandbox.id)}, {}
+            sandbox.stop(now)
+            return 200, {}, {}
+        if action == ["activity"] and method == "GET":
+            return 200, sandbox.get_activity(now, query.get("error_only", ["false"])[0] == "true",
+                                             query.get("since", [""])[0], query.get("from_event_id", [""])[0],
+                                             query.get("tail", [""])[0], self.config.activity_page_size), {}
+        if action == ["output"] and method == "GET":
+            return 200, sandbox.get_console(now, query.get("tail", [0])[0]), {}
+        if action == ["components"] and method == "GET":
+            return 200, sandbox.components, {}
+        if len(action) == 5 and action[0] == "components" and action[2] == "commands" and action[4] == "start":
+            return self._start_execution(sandbox, action[3], now)
+        return 404, {"message": "Unknown endpoint"}, {}
+
+    def _start_execution(self, sandbox, command_name, now):
+        execution_id = str(uuid.uuid4())
+        started_at = now + sample_seconds(self.config.execution_queue_seconds, self._rng) * self.config.time_scale
+        self._executions[execution_id] = {
+            "id": execution_id,
+            "command": command_name,
+            "sandbox_id": sandbox.id,
+            "started_at": started_at,
+            "ended_at": started_at + sample_seconds(self.config.execution_seconds, self._rng) * self.config.time_scale,
+            "failed": self._rng.random() < self.config.command_error_rate
+        }
+        return 200, {"executionId": execution_id, "supports_cancellation": False}, {}
+
+    def _get_execution(self, execution_id, now):
+        execution = self._executions.get(execution_id)
+        if execution is None:
+            return 404, {"message": "Execution '{}' not found".format(execution_id)}, {}
+        is_started = now >= execution["started_at"]
+        is_done = now >= execution["ended_at"]
+        status = "Running" if is_started else "Pending"
+        if is_done:
+            status = "Failed" if execution["failed"] else "Completed"
+        return 200, OrderedDict([("id", execution_id),
+                                 ("status", status),
+                                 ("supports_cancellation", False),
+                                 ("started", _iso_time(execution["started_at"]) if is_started else None),
+                                 ("ended", _iso_time(execution["ended_at"]) if is_done else None),
+                                 ("output", "{} output".format(execution["command"]) if is_done else "")]), {}
+
+    def _handle_mock(self, path):
+        """ /mock/stats - request counts, logins per user and server side timelines, for benchmarks """
+        if path != "/mock/stats":
+            return 404, {"message": "Unknown endpoint"}, {}
+        with self._lock:
+            sandboxes = {sandbox.id: {"setup_finished_at": sandbox.setup_finished_at,
+                                      "failed": sandbox.failed_stage is not None,
+                                      "stop_requested_at": sandbox.stop_requested_at,
+                                      "ended_at": sandbox.ended_at}
+                         for sandbox in self._sandboxes.values()}
+            return 200, {"request_counts": dict(self.request_counts), "logins_by_user": dict(self.logins_by_user),
+                         "sandboxes": sandboxes}, {}
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+        except ValueError:
+            body = {}
+        status, payload, extra_headers = self.server.mock_api.handle(self.command, url.path, parse_qs(url.query),
+                                                                     self.headers, body)
+        data = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockSandboxServer(object):
+    def __init__(self, config=None, host="127.0.0.1", port=82):
+        """
+        :param MockConfig config:
+        :param str host:
+        :param int port: 0 picks a free port
+        """
+        self.api = MockSandboxApi(config or MockConfig())
+        self._server = ThreadingHTTPServer((host, port), _MockRequestHandler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        self._server.server_bind()
+        self._server.server_activate()
+        self._server.mock_api = self.api
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        """ serve on a background thread """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-sandbox-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Sandbox REST API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=82, help="set the same \"port\" in config.json")
+    parser.add_argument("--config", help="json file with MockConfig fields")
+    args = parser.parse_args()
+
+    mock_server = MockSandboxServer(load_mock_config(args.config), args.host, args.port)
+    print("Mock Sandbox API listening on {}:{}".format(args.host, mock_server.port))
+    mock_server.serve_forever()
@@ -1,9 +1,14 @@
 # SANDBOX STATE VALUES
+SANDBOX_PENDING_STATE = "Pending"
 SANDBOX_READY_STATE = "Ready"
 SANDBOX_ERROR_STATE = "Error"
 SANDBOX_ENDED_STATE = "Ended"
+SANDBOX_TEARDOWN_STATE = "Teardown"
 
 JSON_RESULTS_FOLDER = "json-results"
 LOGS_FOLDER = "logs"
+HISTORY_FOLDER = "history"
+DISTRIBUTED_FOLDER = "distributed"
+BENCHMARKS_FOLDER = "benchmarks"
 
 TIMESTAMP_FORMATTING = "%d-%m-%y_%H%M%S"
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""
+Per-sandbox polling scheduler - every sandbox has its own next-poll deadline in a min-heap
+intervals adapt to setup stage progress and to setup / teardown durations seen in earlier runs
+"""
+import heapq
+import json
+import os
+from pathlib import Path
+from time import time, sleep
+
+import my_globals
+
+SETUP_PHASE = "setup"
+TEARDOWN_PHASE = "teardown"
+
+MAX_HISTORY_SAMPLES = 200
+BACKOFF_FACTOR = 1.5
+
+
+class DurationHistory(object):
+    def __init__(self, blueprint_id):
+        """
+        observed setup / teardown (and command execution) durations in seconds, persisted per blueprint across runs
+        :param str blueprint_id:
+        """
+        history_folder = os.path.join(os.getcwd(), my_globals.HISTORY_FOLDER)
+        self.path = os.path.join(history_folder, "{}_durations.json".format(blueprint_id))
+        self._samples = {SETUP_PHASE: [], TEARDOWN_PHASE: []}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self._samples.update(json.load(f))
+
+    def record(self, phase, seconds):
+        self._samples.setdefault(phase, []).append(round(seconds, 1))
+
+    def save(self):
+        """ keep only the most recent samples so the file stays small """
+        for phase, samples in self._samples.items():
+            self._samples[phase] = samples[-MAX_HISTORY_SAMPLES:]
+        Path(self.path).parent.mkdir(exist_ok=True, parents=True)
+        with open(self.path, 'w') as f:
+            json.dump(self._samples, f)
+
+    def get_expected_durations(self, phase):
+        """
+        :param str phase:
+        :return: (p10, p50, p90) seconds or None if no runs recorded yet
+        """
+        samples = sorted(self._samples.get(phase, []))
+        if not samples:
+            return None
+        return tuple(samples[min(int(len(samples) * q), len(samples) - 1)] for q in (0.1, 0.5, 0.9))
+
+
+class PollingScheduler(object):
+    def __init__(self, min_interval, max_interval, expected_durations=None):
+        """
+        :param int min_interval: seconds - used around expected completion and right after a stage change
+        :param int max_interval: seconds - a sandbox is never polled less often than this
+        :param tuple expected_durations: (p10, p50, p90) seconds from DurationHistory, None with no history
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.expected_durations = expected_durations
+        self._heap = []
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _clamp(self, seconds):
+        return min(max(seconds, self.min_interval), self.max_interval)
+
+    def get_first_poll_delay(self, estimated_minutes, expected_durations=None):
+        """
+        first poll lands at the fastest typical duration seen before, config estimate with no history
+        :param int estimated_minutes: estimated setup / teardown minutes from run config
+        :param tuple expected_durations: overrides the scheduler's - setup and teardown share a heap
+        :return:
+        """
+        expected_durations = expected_durations or self.expected_durations
+        if expected_durations:
+            return expected_durations[0]
+        return estimated_minutes * 60
+
+    def add(self, sandbox_id, started_at, first_poll_delay, expected_durations=None):
+        """
+        :param str sandbox_id:
+        :param float started_at: epoch seconds of start / stop request
+        :param float first_poll_delay: seconds after started_at
+        :param tuple expected_durations: overrides the scheduler's for this sandbox - setup and teardown share a heap
+        """
+        self._entries[sandbox_id] = {"started_at": started_at, "stage": None, "interval": self.min_interval,
+                                     "polled_at": started_at, "last_pending_at": started_at,
+                                     "expected_durations": expected_durations or self.expected_durations,
+                                     "due_at": started_at + first_poll_delay}
+        heapq.heappush(self._heap, (started_at + first_poll_delay, sandbox_id))
+
+    def _is_current(self, heap_item):
+        """ heap entries are dropped lazily - stale once the sandbox is removed or added again with a new deadline """
+        deadline, sandbox_id = heap_item
+        entry = self._entries.get(sandbox_id)
+        return entry is not None and entry["due_at"] == deadline
+
+    def remove(self, sandbox_id):
+        """ sandbox finished - heap entry is dropped lazily """
+        self._entries.pop(sandbox_id, None)
+
+    def reschedule(self, sandbox_id, stage=None):
+        """
+        pick next deadline for a sandbox that is still in progress
+        - stage changed: poll again soon, the sandbox is moving
+        - before the fastest expected duration: sleep until then
+        - inside the usual duration window: poll densely
+        - slower than usual / no history: back off geometrically up to max interval
+        :param str sandbox_id:
+        :param str stage: current setup_stage, None for teardown
+        """
+        entry = self._entries[sandbox_id]
+        entry["last_pending_at"] = entry["polled_at"]
+        now = time()
+        elapsed = now - entry["started_at"]
+        stage_changed = stage is not None and entry["stage"] is not None and stage != entry["stage"]
+        entry["stage"] = stage
+        expected_durations = entry["expected_durations"]
+
+        if stage_changed:
+            interval = self.min_interval
+        elif expected_durations and elapsed < expected_durations[0]:
+            interval = self._clamp(expected_durations[0] - elapsed)
+        elif expected_durations and elapsed < expected_durations[2]:
+            interval = self._clamp((expected_durations[2] - elapsed) / 4)
+        else:
+            interval = self._clamp(entry["interval"] * BACKOFF_FACTOR)
+        entry["interval"] = interval
+        entry["due_at"] = now + interval
+        heapq.heappush(self._heap, (now + interval, sandbox_id))
+
+    def get_duration_estimate(self, sandbox_id):
+        """
+        sandbox finished somewhere between the last poll that saw it pending and the poll that saw it done
+        taking the midpoint keeps the recorded history from drifting up with the polling interval
+        :param str sandbox_id:
+        :return: seconds
+        """
+        entry = self._entries[sandbox_id]
+        return (entry["last_pending_at"] + entry["polled_at"]) / 2 - entry["started_at"]
+
+    def wait_for_due(self, t_end, coalesce_seconds=0, max_wait=None):
+        """
+        sleep until the earliest deadline, then pop every sandbox that is due
+        :param float t_end: polling timeout epoch seconds
+        :param float coalesce_seconds: also pop sandboxes due within this window - batches bulk list polls
+        :param float max_wait: wake up after this many seconds even if nothing is due - sandboxes are still being added
+        :return: list of due sandbox ids, empty if timeout or max_wait is hit first
+        """
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        wake_at = t_end if max_wait is None else min(t_end, time() + max_wait)
+        if not self._heap:
+            sleep(max(wake_at - time(), 0) if max_wait is not None else 0)
+            return []
+
+        next_deadline = self._heap[0][0]
+        if next_deadline > wake_at:
+            sleep(max(wake_at - time(), 0))
+            return []
+        sleep(max(next_deadline - time(), 0))
+
+        now = time()
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now + coalesce_seconds:
+            heap_item = heapq.heappop(self._heap)
+            if self._is_current(heap_item):
+                sandbox_id = heap_item[1]
+                self._entries[sandbox_id]["polled_at"] = now
+                due_ids.append(sandbox_id)
+        return due_ids
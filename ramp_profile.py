@@ -0,0 +1,206 @@
+"""
+Open-loop launch scheduling for the "ramp_profile" section of run_config
+launch times are fixed up front from the load shape - a slow start request never delays the next launch
+"""
+import math
+import queue
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from common import RampProfile
+
+# RAMP SHAPES
+BURST = "burst"
+CONSTANT = "constant"
+LINEAR = "linear"
+STEP = "step"
+SPIKE = "spike"
+POISSON = "poisson"
+SOAK = "soak"
+RAMP_SHAPES = [BURST, CONSTANT, LINEAR, STEP, SPIKE, POISSON, SOAK]
+
+MAX_TIME_STEP_SECONDS = 1
+MAX_SCHEDULE_SECONDS = 7 * 24 * 60 * 60
+LATE_LAUNCH_SECONDS = 1
+DEFAULT_MAX_LAUNCH_WORKERS = 100
+
+
+def validate_ramp_profile(ramp_profile):
+    """
+    :param RampProfile ramp_profile:
+    """
+    if ramp_profile.shape not in RAMP_SHAPES:
+        raise Exception("Unknown ramp_profile shape '{}'. Use one of {}".format(ramp_profile.shape, RAMP_SHAPES))
+    if ramp_profile.shape == SOAK and ramp_profile.target_active < 1:
+        raise Exception("ramp_profile shape 'soak' needs 'target_active' of at least 1")
+    rates = [ramp_profile.rate_per_minute, ramp_profile.end_rate_per_minute, ramp_profile.step_rate_per_minute,
+             ramp_profile.spike_rate_per_minute]
+    if ramp_profile.shape != BURST and (min(rates) < 0 or not max(rates)):
+        raise Exception("ramp_profile rates can't be negative and at least one must be above 0")
+
+
+def get_rate_per_minute(ramp_profile, elapsed_seconds):
+    """
+    launch rate of the load shape at a point in time
+    :param RampProfile ramp_profile:
+    :param float elapsed_seconds: since first launch
+    :return:
+    """
+    elapsed_minutes = elapsed_seconds / 60.0
+    if ramp_profile.shape == LINEAR:
+        progress = min(elapsed_minutes / ramp_profile.ramp_minutes, 1) if ramp_profile.ramp_minutes else 1
+        rate_change = ramp_profile.end_rate_per_minute - ramp_profile.rate_per_minute
+        return ramp_profile.rate_per_minute + rate_change * progress
+    if ramp_profile.shape == STEP:
+        steps = math.floor(elapsed_minutes / ramp_profile.step_minutes) if ramp_profile.step_minutes else 0
+        return ramp_profile.rate_per_minute + ramp_profile.step_rate_per_minute * steps
+    if ramp_profile.shape == SPIKE:
+        spike_end = ramp_profile.spike_at_minute + ramp_profile.spike_minutes
+        if ramp_profile.spike_at_minute <= elapsed_minutes < spike_end:
+            return ramp_profile.spike_rate_per_minute
+    return ramp_profile.rate_per_minute
+
+
+def get_launch_offsets(ramp_profile, quantity):
+    """
+    seconds after the first launch for every launch
+    the rate curve is integrated and a launch is due each time it adds up to one more sandbox
+    poisson arrivals draw that amount from an exponential distribution instead (time-rescaling),
+    so any shape can have random arrivals around its rate curve
+    :param RampProfile ramp_profile:
+    :param int quantity:
+    :return: sorted list of offsets in seconds
+    """
+    if ramp_profile.shape == BURST:
+        return [0] * quantity
+
+    rng = random.Random(ramp_profile.seed)
+    is_poisson = ramp_profile.poisson or ramp_profile.shape == POISSON
+    offsets = []
+    elapsed = 0.0
+    accumulated = 0.0
+    needed = rng.expovariate(1) if is_poisson else 0
+    while len(offsets) < quantity:
+        if accumulated >= needed:
+            offsets.append(elapsed)
+            accumulated -= needed
+            needed = rng.expovariate(1) if is_poisson else 1
+            continue
+        if elapsed > MAX_SCHEDULE_SECONDS:
+            raise Exception("ramp_profile launches only {} of {} sandboxes within a week - rate drops to 0".format(
+                len(offsets), quantity))
+        rate = get_rate_per_minute(ramp_profile, elapsed) / 60.0
+        # step by the time the current rate needs, but never over a rate change
+        time_step = MAX_TIME_STEP_SECONDS if not rate else min((needed - accumulated) / rate, MAX_TIME_STEP_SECONDS)
+        elapsed += time_step
+        accumulated += rate * time_step
+    return [round(offset, 3) for offset in offsets]
+
+
+class LaunchScheduler(object):
+    def __init__(self, launch_func, quantity, ramp_profile, logger):
+        """
+        fires launches on their own thread pool at the profile's launch times
+        launched sandboxes are handed back to the polling loop through get_launched()
+        :param launch_func: callable taking the launch index (0 based), starts one sandbox and returns its
+        SandboxErrorData
+        :param int quantity: sandboxes to launch
+        :param RampProfile ramp_profile:
+        :param logging.Logger logger:
+        """
+        validate_ramp_profile(ramp_profile)
+        self._launch_func = launch_func
+        self._quantity = quantity
+        self._ramp_profile = ramp_profile
+        self._logger = logger
+        self._offsets = get_launch_offsets(ramp_profile, quantity)
+        launch_workers = ramp_profile.launch_workers or min(max(quantity, 1), DEFAULT_MAX_LAUNCH_WORKERS)
+        self._executor = ThreadPoolExecutor(max_workers=launch_workers)
+        self._launched = queue.Queue()
+        self._is_soak = ramp_profile.shape == SOAK
+        self._active_slots = threading.Semaphore(ramp_profile.target_active) if self._is_soak else None
+        self._completed_count = 0
+        self._failed_count = 0
+        self._late_launches = 0
+        self._max_lag = 0.0
+        self._started_at = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._started_at = time()
+        self._thread = threading.Thread(target=self._run, name="launch-scheduler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for index, offset in enumerate(self._offsets):
+            if self._is_soak:
+                # closed on the setup side only - wait for a sandbox to finish setup before the next launch
+                while not self._active_slots.acquire(timeout=1):
+                    if self._stopped.is_set():
+                        return
+            launch_at = self._started_at + offset
+            if self._stopped.wait(max(launch_at - time(), 0)):
+                return
+            lag = time() - launch_at
+            if not self._is_soak and lag > LATE_LAUNCH_SECONDS:
+                self._late_launches += 1
+            self._max_lag = max(self._max_lag, lag)
+            future = self._executor.submit(self._launch_func, index)
+            future.add_done_callback(self._launched.put)
+        self._executor.shutdown(wait=False)
+
+    def get_launched(self):
+        """
+        sandboxes whose start request came back since last call
+        a failed start request is logged and counted, the launches around it carry on
+        :return: list of SandboxErrorData
+        """
+        launched = []
+        while True:
+            try:
+                future = self._launched.get_nowait()
+            except queue.Empty:
+                return launched
+            self._completed_count += 1
+            try:
+                launched.append(future.result())
+            except Exception as e:
+                self._failed_count += 1
+                self._logger.error("Launch {} of {} failed: {}".format(self._completed_count, self._quantity, str(e)))
+                # nothing is setting up in its slot
+                self.on_setup_finished()
+
+    def get_failed_count(self):
+        """ launches whose start request failed so far """
+        return self._failed_count
+
+    def on_setup_finished(self):
+        """ soak shape - a setup slot is free, next launch may go """
+        if self._is_soak:
+            self._active_slots.release()
+
+    def is_done(self):
+        """ every launch was sent and has come back """
+        return self._completed_count >= self._quantity
+
+    def get_launch_stats(self):
+        """
+        launches are late when the launch pool is saturated - the profile was not delivered as configured
+        :return:
+        """
+        return {
+            "shape": self._ramp_profile.shape,
+            "launches": self._completed_count,
+            "failed_launches": self._failed_count,
+            "scheduled_minutes": round(self._offsets[-1] / 60, 1) if self._offsets else 0,
+            "late_launches": self._late_launches,
+            "max_lag_seconds": round(self._max_lag, 1)
+        }
+
+    def close(self):
+        """ stop launching - start requests already sent are left to finish """
+        self._stopped.set()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,309 @@
+"""
+Indexed results store - every run's json results report is also loaded into sqlite ("json-results/results.db")
+so questions across run history are answered with one indexed query instead of loading every json file
+
+python results_store.py stage-failures --last 30 [--blueprint <id>]
+python results_store.py runs --last 10 [--blueprint <id>]
+python results_store.py import                         (load json results written before the store existed)
+"""
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+from time import time
+
+import latency
+import my_globals
+from common import read_json_report_sandboxes
+
+RESULTS_DB_FILE_NAME = "results.db"
+LOCK_TIMEOUT_SECONDS = 30
+DEFAULT_LAST_RUNS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    blueprint_id TEXT NOT NULL,
+    time_stamp TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    report_path TEXT,
+    sandbox_count INTEGER DEFAULT 0,
+    failed_setups INTEGER DEFAULT 0,
+    failed_teardowns INTEGER DEFAULT 0,
+    indexed_at REAL,
+    UNIQUE (blueprint_id, time_stamp)
+);
+CREATE INDEX IF NOT EXISTS runs_blueprint ON runs (blueprint_id, started_at);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started_at);
+
+CREATE TABLE IF NOT EXISTS sandboxes (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    sandbox_id TEXT NOT NULL,
+    failed_setup_stage TEXT,
+    setup_seconds REAL,
+    teardown_seconds REAL,
+    setup_error_count INTEGER,
+    teardown_error_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS sandboxes_run ON sandboxes (run_id);
+CREATE INDEX IF NOT EXISTS sandboxes_id ON sandboxes (sandbox_id);
+CREATE INDEX IF NOT EXISTS sandboxes_failed_stage ON sandboxes (failed_setup_stage);
+
+CREATE TABLE IF NOT EXISTS stage_timings (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    sandbox_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started_at REAL,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS stage_timings_run ON stage_timings (run_id, stage);
+CREATE INDEX IF NOT EXISTS stage_timings_sandbox ON stage_timings (sandbox_id);
+
+CREATE TABLE IF NOT EXISTS error_events (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    sandbox_id TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    event_id INTEGER,
+    event_type TEXT,
+    event_text TEXT,
+    output TEXT,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS error_events_run ON error_events (run_id);
+CREATE INDEX IF NOT EXISTS error_events_sandbox ON error_events (sandbox_id);
+"""
+
+
+def get_results_db_path():
+    return os.path.join(os.getcwd(), my_globals.JSON_RESULTS_FOLDER, RESULTS_DB_FILE_NAME)
+
+
+def _get_started_at(time_stamp):
+    return (datetime.strptime(time_stamp, my_globals.TIMESTAMP_FORMATTING) - datetime(1970, 1, 1)).total_seconds()
+
+
+def _get_interval(timings, start_event, end_event):
+    if start_event in timings and end_event in timings:
+        return round(timings[end_event] - timings[start_event], 3)
+    return None
+
+
+class ResultsStore(object):
+    def __init__(self, db_path=None):
+        """
+        :param str db_path: defaults to "json-results/results.db" under the working directory
+        """
+        self.db_path = db_path or get_results_db_path()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        # workers of a distributed run may share a folder - wait for each other's writes
+        self._connection = sqlite3.connect(self.db_path, timeout=LOCK_TIMEOUT_SECONDS)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_run(self, blueprint_id, time_stamp):
+        """
+        register a run when it starts, so the latest run is known before any report is written
+        :param str blueprint_id:
+        :param str time_stamp:
+        :return: run id
+        """
+        with self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO runs (blueprint_id, time_stamp, started_at) "
+                                     "VALUES (?, ?, ?)", (blueprint_id, time_stamp, _get_started_at(time_stamp)))
+        return self._connection.execute("SELECT run_id FROM runs WHERE blueprint_id = ? AND time_stamp = ?",
+                                        (blueprint_id, time_stamp)).fetchone()[0]
+
+    def index_report(self, json_file_path, blueprint_id, time_stamp):
+        """
+        load a json results report - rows from an earlier write of the same run are replaced
+        :param str json_file_path:
+        :param str blueprint_id:
+        :param str time_stamp:
+        :return: run id
+        """
+        sandboxes = read_json_report_sandboxes(json_file_path)
+        run_id = self.add_run(blueprint_id, time_stamp)
+        sandbox_rows = []
+        stage_rows = []
+        error_rows = []
+        for sandbox in sandboxes:
+            sandbox_id = sandbox["sandbox_id"]
+            timings = sandbox.get("timings") or {}
+            setup_errors = sandbox.get("setup_errors") or []
+            teardown_errors = sandbox.get("teardown_errors") or []
+            sandbox_rows.append((run_id, sandbox_id, sandbox.get("failed_setup_stage"),
+                                 _get_interval(timings, latency.START_REQUESTED, latency.SETUP_FINISHED),
+                                 _get_interval(timings, latency.STOP_REQUESTED, latency.ENDED),
+                                 len(setup_errors), len(teardown_errors)))
+
+            # a stage lasts until the next stage is seen, the last one until setup finished
+            stage_marks = timings.get(latency.SETUP_STAGES, [])
+            stage_ends = [mark[1] for mark in stage_marks[1:]] + [timings.get(latency.SETUP_FINISHED)]
+            for (stage, stage_start), stage_end in zip(stage_marks, stage_ends):
+                seconds = round(stage_end - stage_start, 3) if stage_end is not None else None
+                stage_rows.append((run_id, sandbox_id, stage, stage_start, seconds))
+
+            for phase, events in [("setup", setup_errors), ("teardown", teardown_errors)]:
+                for event in events:
+                    error_rows.append((run_id, sandbox_id, phase, event.get("id"), event.get("event_type"),
+                                       event.get("event_text"), event.get("output"), event.get("time")))
+
+        with self._connection:
+            for table in ["sandboxes", "stage_timings", "error_events"]:
+                self._connection.execute("DELETE FROM {} WHERE run_id = ?".format(table), (run_id,))
+            self._connection.executemany("INSERT INTO sandboxes VALUES (?, ?, ?, ?, ?, ?, ?)", sandbox_rows)
+            self._connection.executemany("INSERT INTO stage_timings VALUES (?, ?, ?, ?, ?)", stage_rows)
+            self._connection.executemany("INSERT INTO error_events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", error_rows)
+            self._connection.execute(
+                "UPDATE runs SET report_path = ?, sandbox_count = ?, failed_setups = ?, failed_teardowns = ?, "
+                "indexed_at = ? WHERE run_id = ?",
+                (os.path.abspath(json_file_path), len(sandbox_rows),
+                 sum(1 for row in sandbox_rows if row[2]), sum(1 for row in sandbox_rows if row[6]),
+                 time(), run_id))
+        return run_id
+
+    def get_latest_time_stamp(self, blueprint_id):
+        """
+        :param str blueprint_id:
+        :return: time stamp of the latest run, None when there is none
+        """
+        row = self._connection.execute("SELECT time_stamp FROM runs WHERE blueprint_id = ? "
+                                       "ORDER BY started_at DESC LIMIT 1", (blueprint_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_runs(self, blueprint_id=None, last_runs=DEFAULT_LAST_RUNS):
+        """
+        :param str blueprint_id: None for all blueprints
+        :param int last_runs:
+        :return: list of run dicts, latest first
+        """
+        query = ("SELECT blueprint_id, time_stamp, sandbox_count, failed_setups, failed_teardowns, report_path "
+                 "FROM runs {} ORDER BY started_at DESC LIMIT ?".format("WHERE blueprint_id = ?" if blueprint_id else ""))
+        params = ([blueprint_id] if blueprint_id else []) + [last_runs]
+        columns = ["blueprint_id", "time_stamp", "sandbox_count", "failed_setups", "failed_teardowns", "report_path"]
+        return [dict(zip(columns, row)) for row in self._connection.execute(query, params)]
+
+    def get_stage_failure_rates(self, blueprint_id=None, last_runs=DEFAULT_LAST_RUNS):
+        """
+        failure rate per setup stage - failures in the stage over sandboxes that reached it
+        :param str blueprint_id: None for all blueprints
+        :param int last_runs:
+        :return: list of {"stage", "reached", "failed", "failure_rate"}
+        """
+        recent_runs = ("SELECT run_id FROM runs {} ORDER BY started_at DESC LIMIT ?".format(
+            "WHERE blueprint_id = ?" if blueprint_id else ""))
+        params = ([blueprint_id] if blueprint_id else []) + [last_runs]
+        # a poll may miss a short stage - the stage a sandbox failed in counts as reached too
+        query = """
+            SELECT reached.stage, reached.count, COALESCE(failed.count, 0)
+            FROM (SELECT stage, COUNT(DISTINCT sandbox_key) AS count FROM (
+                      SELECT stage, run_id || ' ' || sandbox_id AS sandbox_key FROM stage_timings
+                      WHERE run_id IN ({recent})
+                      UNION
+                      SELECT failed_setup_stage, run_id || ' ' || sandbox_id FROM sandboxes
+                      WHERE run_id IN ({recent}) AND failed_setup_stage IS NOT NULL)
+                  GROUP BY stage) AS reached
+            LEFT JOIN (SELECT failed_setup_stage AS stage, COUNT(*) AS count FROM sandboxes
+                       WHERE run_id IN ({recent}) AND failed_setup_stage IS NOT NULL
+                       GROUP BY failed_setup_stage) AS failed
+            ON reached.stage = failed.stage
+            ORDER BY COALESCE(failed.count, 0) DESC, reached.stage
+        """.format(recent=recent_runs)
+        return [{"stage": stage, "reached": reached, "failed": failed,
+                 "failure_rate": round(failed / float(reached), 4) if reached else None}
+                for stage, reached, failed in self._connection.execute(query, params * 3)]
+
+
+def register_run(blueprint_id, time_stamp):
+    """ open the store, add the run, close """
+    with ResultsStore() as store:
+        store.add_run(blueprint_id, time_stamp)
+
+
+def index_run_report(json_file_path, blueprint_id, time_stamp):
+    """ open the store, load the report, close """
+    with ResultsStore() as store:
+        store.index_report(json_file_path, blueprint_id, time_stamp)
+
+
+def get_latest_json_log_timestamp(blueprint_id):
+    """
+    time stamp of the latest run of a blueprint - from the results store, registered when the run started
+    runs from before the store are found by listing the results folder, files not named
+    <time_stamp>_<blueprint_name>.<filetype> are skipped
+    :param str blueprint_id: refers to folder inside json-results
+    :return:
+    """
+    if os.path.exists(get_results_db_path()):
+        with ResultsStore() as store:
+            latest_timestamp_str = store.get_latest_time_stamp(blueprint_id)
+        if latest_timestamp_str:
+            return latest_timestamp_str
+
+    log_folder_path = os.path.join(os.getcwd(), my_globals.JSON_RESULTS_FOLDER, blueprint_id)
+    datetime_time_stamps = []
+    for file_name in os.listdir(log_folder_path):
+        try:
+            datetime_time_stamps.append(datetime.strptime("_".join(file_name.split("_")[:-1]),
+                                                          my_globals.TIMESTAMP_FORMATTING))
+        except ValueError:
+            continue
+    if not datetime_time_stamps:
+        raise Exception("No json results found for '{}'".format(blueprint_id))
+    return datetime.strftime(max(datetime_time_stamps), my_globals.TIMESTAMP_FORMATTING)
+
+
+def import_json_results(store, json_results_folder):
+    """
+    load every "<time_stamp>_<blueprint>.json" under json-results - files that don't match are skipped
+    :param ResultsStore store:
+    :param str json_results_folder:
+    :return: number of reports loaded
+    """
+    imported = 0
+    for blueprint_id in sorted(os.listdir(json_results_folder)):
+        blueprint_folder = os.path.join(json_results_folder, blueprint_id)
+        if not os.path.isdir(blueprint_folder):
+            continue
+        suffix = "_{}.json".format(blueprint_id)
+        for file_name in sorted(os.listdir(blueprint_folder)):
+            if not file_name.endswith(suffix):
+                continue
+            time_stamp = file_name[:-len(suffix)]
+            try:
+                _get_started_at(time_stamp)
+            except ValueError:
+                continue
+            store.index_report(os.path.join(blueprint_folder, file_name), blueprint_id, time_stamp)
+            imported += 1
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query run history in the results store")
+    parser.add_argument("command", choices=["stage-failures", "runs", "import"])
+    parser.add_argument("--blueprint", help="only runs of this blueprint")
+    parser.add_argument("--last", type=int, default=DEFAULT_LAST_RUNS, help="number of latest runs to look at")
+    args = parser.parse_args()
+
+    with ResultsStore() as results_store:
+        if args.command == "import":
+            count = import_json_results(results_store, os.path.dirname(results_store.db_path))
+            print("Imported {} json results reports into '{}'".format(count, results_store.db_path))
+        elif args.command == "runs":
+            for run in results_store.get_runs(args.blueprint, args.last):
+                print("{time_stamp}  {blueprint_id:<30} sandboxes {sandbox_count:>6}  failed setups {failed_setups:>5}"
+                      "  failed teardowns {failed_teardowns:>5}".format(**run))
+        else:
+            print("Setup failures by stage, last {} runs{}".format(
+                args.last, " of '{}'".format(args.blueprint) if args.blueprint else ""))
+            for rate in results_store.get_stage_failure_rates(args.blueprint, args.last):
+                print("{stage:<30} reached {reached:>7}  failed {failed:>6}  rate {failure_rate:.2%}".format(**rate))
@@ -0,0 +1,380 @@
+"""
+asyncio engine for the full flow - launches, polls and tears down sandboxes concurrently from one event loop
+concurrency of in-flight API requests is bounded by "max_concurrency" in run_config
+"""
+import asyncio
+import json
+import os
+from pathlib import Path
+from time import time
+from timeit import default_timer
+
+import my_globals
+from common import SandboxErrorData, get_config_data, get_utc_timestamp, sandbox_name_truncater, \
+    write_json_report, RunConfig, ActiveWithErrorException, cap_error_events
+import latency
+from journal import ResultsJournal, get_journal_path, compact_journal
+from logger import get_logger
+from results_store import index_run_report
+from run_stop_sandboxes import build_log_path, _get_sandbox_data_from_json
+from sb_rest.async_sandbox_rest_api import AsyncSandboxRest
+from workload import get_launch_plan
+
+
+async def _bounded_call(semaphore, coro_func, *args, **kwargs):
+    """
+    await api coroutine while holding a semaphore slot
+    :param asyncio.Semaphore semaphore:
+    :param coro_func: AsyncSandboxRest method
+    :return:
+    """
+    async with semaphore:
+        return await coro_func(*args, **kwargs)
+
+
+async def _poll_sandbox_data(sb_rest, semaphore, sandbox_id, logger):
+    """
+    get sandbox data - rate quota responses are retried inside AsyncSandboxRest
+    :param AsyncSandboxRest sb_rest:
+    :param asyncio.Semaphore semaphore:
+    :param str sandbox_id:
+    :param logging.Logger logger:
+    :return:
+    """
+    try:
+        return await _bounded_call(semaphore, sb_rest.get_sandbox_data, sandbox_id)
+    except Exception as e:
+        exc_msg = "Issue during polling: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+
+
+async def _launch_sandbox(sb_rest, semaphore, run_config, sandbox_name, blueprint, journal):
+    """
+    :param AsyncSandboxRest sb_rest:
+    :param asyncio.Semaphore semaphore:
+    :param RunConfig run_config:
+    :param str sandbox_name:
+    :param WorkloadBlueprint blueprint: launch plan entry
+    :param ResultsJournal journal: the sandbox is journaled as soon as it exists, so later failures can't orphan it
+    :return:
+    """
+    requested_at = time()
+    sb_details = await _bounded_call(semaphore, sb_rest.start_blueprint,
+                                     blueprint_id=blueprint.blueprint_id,
+                                     sandbox_name=sandbox_name,
+                                     duration=blueprint.sandbox_duration_iso_formatted,
+                                     params=blueprint.blueprint_params)
+    sb_data = SandboxErrorData(sb_details["id"], blueprint_id=blueprint.blueprint_id if run_config.workload else None)
+    sb_data.mark_time(latency.START_REQUESTED, requested_at)
+    sb_data.mark_time(latency.START_ACKNOWLEDGED)
+    journal.record(sb_data)
+    return sb_data
+
+
+async def _stop_sandbox(sb_rest, semaphore, sb_data):
+    """
+    :param AsyncSandboxRest sb_rest:
+    :param asyncio.Semaphore semaphore:
+    :param SandboxErrorData sb_data:
+    :return:
+    """
+    sb_data.mark_time(latency.STOP_REQUESTED)
+    await _bounded_call(semaphore, sb_rest.stop_sandbox, sb_data.sandbox_id)
+    sb_data.mark_time(latency.STOP_ACKNOWLEDGED)
+
+
+async def _await_setup(sb_rest, semaphore, sb_data, run_config, t_end, journal, logger):
+    """
+    poll single sandbox until Ready / Error. Returns True if setup failed, None if polling timed out
+    :param AsyncSandboxRest sb_rest:
+    :param asyncio.Semaphore semaphore:
+    :param SandboxErrorData sb_data:
+    :param RunConfig run_config:
+    :param float t_end:
+    :param ResultsJournal journal:
+    :param logging.Logger logger:
+    :return:
+    """
+    sb_id = sb_data.sandbox_id
+    while time() < t_end:
+        sb_details = await _poll_sandbox_data(sb_rest, semaphore, sb_id, logger)
+        state = sb_details["state"]
+        if state != my_globals.SANDBOX_PENDING_STATE:
+            sb_data.mark_time(latency.FIRST_NON_PENDING)
+        if state != my_globals.SANDBOX_READY_STATE:
+            sb_data.mark_setup_stage(sb_details.get("setup_stage"), time())
+        if state in [my_globals.SANDBOX_ERROR_STATE, my_globals.SANDBOX_READY_STATE]:
+            sb_data.mark_time(latency.SETUP_FINISHED)
+        if state == my_globals.SANDBOX_ERROR_STATE:
+            await asyncio.sleep(3)
+            sb_data.failed_setup_stage = sb_details["setup_stage"]
+            sb_data.setup_errors = cap_error_events(
+                await _bounded_call(semaphore, sb_rest.get_sandbox_activity, sb_id, True))
+            journal.record(sb_data, state)
+            logger.error("Failed setup: {}, stage: {}".format(sb_id, sb_data.failed_setup_stage))
+            return True
+        if state == my_globals.SANDBOX_READY_STATE:
+            journal.record(sb_data, state)
+            logger.info("Sandbox {} Active".format(sb_id))
+            return False
+        await asyncio.sleep(run_config.polling_frequency_seconds)
+    return None
+
+
+async def _await_teardown(sb_rest, semaphore, sb_data, run_config, t_end, logger):
+    """
+    poll single sandbox until Ended, then scan activity feed for teardown errors
+    returns True if teardown failed, None if polling timed out
+    :param AsyncSandboxRest sb_rest:
+    :param asyncio.Semaphore semaphore:
+    :param SandboxErrorData sb_data:
+    :param RunConfig run_config:
+    :param float t_end:
+    :param logging.Logger logger:
+    :return:
+    """
+    sb_id = sb_data.sandbox_id
+    while time() < t_end:
+        sb_details = await _poll_sandbox_data(sb_rest, semaphore, sb_id, logger)
+        if sb_details["state"] == my_globals.SANDBOX_ENDED_STATE:
+            sb_data.mark_time(latency.ENDED)
+            await asyncio.sleep(3)
+            from_event_id = ""
+            if sb_data.setup_errors:
+                from_event_id = max(x["id"] for x in sb_data.setup_errors) + 1
+            activity_feed_errors = await _bounded_call(semaphore, sb_rest.get_sandbox_activity,
+                                                       sandbox_id=sb_id,
+                                                       error_only=True,
+                                                       from_event_id=from_event_id)
+            if activity_feed_errors:
+                sb_data.teardown_errors = cap_error_events(activity_feed_errors)
+                logger.error("Failed teardown: {}".format(sb_id))
+                return True
+            logger.info("Completed Teardown: {}".format(sb_id))
+            return False
+        await asyncio.sleep(run_config.polling_frequency_seconds)
+    return None
+
+
+async def start_sandboxes_async(sb_rest, run_config, time_stamp, logger):
+    """
+    launch all sandboxes concurrently, each sandbox is polled by its own task
+    :param AsyncSandboxRest sb_rest:
+    :param RunConfig run_config:
+    :param str time_stamp: appended to json-results file and sandbox name
+    :param logging.Logger logger:
+    :return:
+    """
+    semaphore = asyncio.Semaphore(run_config.max_concurrency)
+    sandbox_name = sandbox_name_truncater("{} - {}".format(time_stamp, run_config.blueprint_id))
+
+    # RESULTS JOURNAL - launches and finished setups are appended as they happen, the report is compacted from it
+    json_file_path = build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)
+    journal_path = get_journal_path(json_file_path)
+    journal = ResultsJournal(journal_path)
+    try:
+        started_sandboxes, results, failed_launch_count = await _launch_and_poll(
+            sb_rest, semaphore, run_config, sandbox_name, journal, logger)
+    finally:
+        # also on a failure or polling timeout - every started sandbox reaches the report, so it can be torn down
+        journal.close()
+        compact_journal(journal_path, json_file_path)
+        index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+        logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    phase_histograms, _ = latency.build_latency_histograms(started_sandboxes)
+    logger.info("Setup latency: {}".format(latency.format_latency_summary(phase_histograms.get("setup"))))
+
+    # VALIDATE RESULTS
+    failed_setups = [sb_data.sandbox_id for sb_data, failed in zip(started_sandboxes, results) if failed]
+    if failed_setups or failed_launch_count:
+        failed_count = len(failed_setups)
+        err_msg = "=== {} failed setups, {} failed launches ===\n{}".format(
+            failed_count, failed_launch_count, json.dumps(failed_setups, indent=4))
+        logger.error(err_msg)
+        raise ActiveWithErrorException("{} Failed Setups, {} Failed Launches!".format(failed_count,
+                                                                                   failed_launch_count))
+
+    logger.info("Setup flow done with no errors")
+
+
+async def _launch_and_poll(sb_rest, semaphore, run_config, sandbox_name, journal, logger):
+    """
+    launch all sandboxes concurrently, each sandbox is polled by its own task
+    a failed launch is logged and counted, the sandboxes that did start carry on
+    :return: tuple of started SandboxErrorData list, _await_setup result per sandbox, failed launch count
+    """
+    # START SANDBOXES
+    logger.info("=== Starting {} sandboxes (max concurrency {}) ===".format(run_config.sandbox_quantity,
+                                                                         run_config.max_concurrency))
+    start = default_timer()
+    launches = [_launch_sandbox(sb_rest, semaphore, run_config, sandbox_name, blueprint, journal)
+                for blueprint in get_launch_plan(run_config)]
+    started_sandboxes = []
+    failed_launch_count = 0
+    for launched in await asyncio.gather(*launches, return_exceptions=True):
+        if isinstance(launched, BaseException):
+            failed_launch_count += 1
+            logger.error("Can't start sandbox: {}".format(str(launched)))
+        else:
+            started_sandboxes.append(launched)
+
+    # LET SETUP RUN A BIT
+    logger.info("Waiting {} minutes before polling setup...".format(run_config.estimated_setup_minutes))
+    await asyncio.sleep(run_config.estimated_setup_minutes * 60)
+
+    # POLL THE SETUP
+    total_polling_minutes = run_config.setup_polling_timeout
+    t_end = time() + (60 * total_polling_minutes)
+    # a failed poll lets the other sandboxes finish first, so no task is left polling once the report is written
+    results = await asyncio.gather(*[_await_setup(sb_rest, semaphore, sb_data, run_config, t_end, journal, logger)
+                                     for sb_data in started_sandboxes], return_exceptions=True)
+    poll_errors = [result for result in results if isinstance(result, BaseException)]
+    if poll_errors:
+        raise poll_errors[0]
+    if None in results:
+        exc_msg = "Setup Polling not completed within {} minutes".format(total_polling_minutes)
+        logger.error(exc_msg)
+        raise Exception(exc_msg)
+
+    elapsed = round((default_timer() - start) / 60, 1)
+    logger.info("Sandboxes Done. Elapsed: '{}' minutes".format(elapsed))
+    return started_sandboxes, results, failed_launch_count
+
+
+async def stop_sandboxes_async(sb_rest, run_config, time_stamp, logger):
+    """
+    stop all sandboxes from json results file concurrently, each sandbox is polled by its own task
+    :param AsyncSandboxRest sb_rest:
+    :param RunConfig run_config:
+    :param str time_stamp:
+    :param logging.Logger logger:
+    :return:
+    """
+    semaphore = asyncio.Semaphore(run_config.max_concurrency)
+    json_file_path = build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)
+    sandbox_data_list = _get_sandbox_data_from_json(json_file_path)
+    try:
+        results, failed_stops = await _stop_and_poll(sb_rest, semaphore, run_config, sandbox_data_list, logger)
+    finally:
+        # also on a failure or polling timeout - stop times and teardown errors seen so far reach the report
+        write_json_report(json_file_path, sandbox_data_list)
+        index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+        logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    phase_histograms, _ = latency.build_latency_histograms(sandbox_data_list)
+    logger.info("Teardown latency: {}".format(latency.format_latency_summary(phase_histograms.get("teardown"))))
+
+    # VALIDATE RESULTS
+    failed_teardowns = [sb_data.sandbox_id for sb_data, failed in zip(sandbox_data_list, results) if failed]
+    if failed_teardowns or failed_stops:
+        failed_count = len(failed_teardowns)
+        err_msg = "=== {} failed teardowns, {} failed stops ===\n{}".format(
+            failed_count, len(failed_stops), json.dumps(failed_teardowns + failed_stops, indent=4))
+        logger.error(err_msg)
+        raise Exception("{} Failed Teardowns, {} Failed Stops!".format(failed_count, len(failed_stops)))
+
+    logger.info("Teardown flow done with no errors.")
+
+
+async def _stop_and_poll(sb_rest, semaphore, run_config, sandbox_data_list, logger):
+    """
+    stop all sandboxes concurrently, then poll each stopped sandbox in its own task
+    a failed stop is logged and left without a stop acknowledged time, the other sandboxes carry on
+    :return: tuple of _await_teardown result per sandbox (False for failed stops), failed stop sandbox ids
+    """
+    # STOP SANDBOXES
+    logger.info("=== Stopping {} Sandboxes ===".format(len(sandbox_data_list)))
+    start = default_timer()
+    stop_results = await asyncio.gather(*[_stop_sandbox(sb_rest, semaphore, sb_data)
+                                          for sb_data in sandbox_data_list], return_exceptions=True)
+    failed_stops = []
+    for sb_data, result in zip(sandbox_data_list, stop_results):
+        if isinstance(result, BaseException):
+            failed_stops.append(sb_data.sandbox_id)
+            logger.error("Can't end sandbox '{}'. Exception {}".format(sb_data.sandbox_id, str(result)))
+
+    # LET TEARDOWN RUN A BIT
+    logger.info("Waiting {} minutes before polling teardown...".format(run_config.estimated_teardown_minutes))
+    await asyncio.sleep(run_config.estimated_teardown_minutes * 60)
+
+    # POLL TEARDOWN
+    total_polling_minutes = run_config.teardown_polling_timeout
+    t_end = time() + (60 * total_polling_minutes)
+    logger.info("Beginning polling for max of {} minutes".format(total_polling_minutes))
+    failed_stop_ids = set(failed_stops)
+    stopped_sandboxes = [sb_data for sb_data in sandbox_data_list if sb_data.sandbox_id not in failed_stop_ids]
+    # a failed poll lets the other sandboxes finish first, so no task is left polling once the report is written
+    poll_results = await asyncio.gather(*[_await_teardown(sb_rest, semaphore, sb_data, run_config, t_end, logger)
+                                          for sb_data in stopped_sandboxes], return_exceptions=True)
+    poll_errors = [result for result in poll_results if isinstance(result, BaseException)]
+    if poll_errors:
+        raise poll_errors[0]
+    if None in poll_results:
+        exc_msg = "Teardown Polling not completed within {} minutes".format(total_polling_minutes)
+        logger.error(exc_msg)
+        raise Exception(exc_msg)
+
+    elapsed = round((default_timer() - start) / 60, 1)
+    logger.info("Sandboxes Done Tearing Down. Elapsed: '{}' minutes".format(elapsed))
+    teardown_results = dict(zip([sb_data.sandbox_id for sb_data in stopped_sandboxes], poll_results))
+    return [teardown_results.get(sb_data.sandbox_id, False) for sb_data in sandbox_data_list], failed_stops
+
+
+async def run_async_full_flow():
+    try:
+        api_config, run_config = get_config_data()
+    except Exception as e:
+        exc_msg = "Make sure config.json file is present. See ReadME for sample. Exception: {}".format(str(e))
+        raise Exception(exc_msg)
+
+    time_stamp = get_utc_timestamp()
+    log_file_path = build_log_path(time_stamp, run_config.blueprint_id)
+    Path(log_file_path).parent.mkdir(exist_ok=True, parents=True)
+    logger = get_logger(log_file_path)
+
+    logger.info("Starting FULL Async Flow")
+
+    sb_rest = AsyncSandboxRest(username=api_config.user,
+                               password=api_config.password,
+                               server=api_config.host,
+                               port=api_config.port,
+                               domain=api_config.domain,
+                               pool_maxsize=max(api_config.pool_maxsize, run_config.max_concurrency),
+                               keep_alive=api_config.keep_alive,
+                               requests_per_second=api_config.requests_per_second,
+                               rate_burst=api_config.rate_burst,
+                               max_requests_per_second=api_config.max_requests_per_second,
+                               max_retries=api_config.max_retries,
+                               credentials=api_config.credentials,
+                               token_cache_path=api_config.token_cache_path,
+                               token_ttl_seconds=api_config.token_ttl_minutes * 60,
+                               logger=logger)
+    try:
+        await sb_rest.login()
+    except Exception as e:
+        exc_msg = "Could not get sandbox rest session: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+
+    try:
+        # START SANDBOXES
+        try:
+            await start_sandboxes_async(sb_rest, run_config, time_stamp, logger)
+        except ActiveWithErrorException as e:
+            logger.error("Sandboxes are active with Error: {}".format(str(e)))
+
+        # LET SANDBOX BE ACTIVE FOR A BIT
+        active_sandbox_minutes = run_config.active_sandbox_minutes
+        logger.info("Sleeping {} minutes before teardown".format(active_sandbox_minutes))
+        await asyncio.sleep(active_sandbox_minutes * 60)
+
+        # END SANDBOXES
+        await stop_sandboxes_async(sb_rest, run_config, time_stamp, logger)
+    finally:
+        await sb_rest.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_async_full_flow())
@@ -0,0 +1,417 @@
+"""
+Distributed load driver - one coordinator splits "sandbox_quantity" over worker processes / hosts
+every worker runs the full start / stop flow with its own SandboxRest session and login token
+the coordinator merges per sandbox results and latency histograms into one json results report
+
+local workers:  python run_distributed.py --local-workers 4
+remote workers: python run_distributed.py --serve 127.0.0.1:9100    (on each worker host, with its own config.json)
+                python run_distributed.py --remote host1:9100 --remote host2:9100
+                both sides need the same shared secret in the DISTRIBUTED_WORKER_SECRET environment variable
+
+protocol is one json message per line over tcp - coordinator sends a "run" command, worker replies once done
+the "run" command carries the shared secret, a worker runs nothing for a message without it
+"""
+import argparse
+import hmac
+import json
+import multiprocessing
+import os
+import socket
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import sleep
+
+import error_signatures
+import latency
+import my_globals
+import workload
+from common import get_config_data, get_utc_timestamp, get_sandbox_rest, get_json_from_nested_obj, ApiConfig, \
+    RunConfig, RampProfile, SoakConfig, CommandLoadConfig, ActiveWithErrorException
+from logger import get_logger
+from workload import WorkloadBlueprint
+from results_store import index_run_report
+from run_start_sandboxes import start_sandboxes
+from run_stop_sandboxes import stop_sandboxes, build_log_path
+
+DISTRIBUTED_REPORT_NAME = "distributed"
+WORKER_SECRET_ENV_VAR = "DISTRIBUTED_WORKER_SECRET"
+
+
+def _run_config_to_dict(run_config):
+    """
+    json safe run config - nested NamedTuples would otherwise be dumped as lists
+    :param RunConfig run_config:
+    :return:
+    """
+    data = run_config._asdict()
+    data["ramp_profile"] = run_config.ramp_profile._asdict()
+    data["soak"] = run_config.soak._asdict()
+    data["workload"] = [blueprint._asdict() for blueprint in run_config.workload]
+    data["command_load"] = run_config.command_load._asdict()
+    return data
+
+
+def _run_config_from_dict(data):
+    """
+    :param dict data: _run_config_to_dict output
+    :return:
+    """
+    data = dict(data)
+    data["ramp_profile"] = RampProfile(**data["ramp_profile"])
+    data["soak"] = SoakConfig(**data["soak"])
+    data["workload"] = tuple(WorkloadBlueprint(**blueprint) for blueprint in data.get("workload", []))
+    command_load = CommandLoadConfig(**data.get("command_load", {}))
+    data["command_load"] = command_load._replace(commands=tuple(command_load.commands))
+    return RunConfig(**data)
+
+
+def get_worker_secret():
+    """
+    shared secret of coordinator and worker hosts - a worker host runs flows with its own api credentials
+    for anyone who can reach its port, so every run command must carry it
+    :return: str
+    """
+    secret = os.environ.get(WORKER_SECRET_ENV_VAR, "")
+    if not secret:
+        raise Exception("Set the same shared secret in the {} environment variable on the coordinator and on "
+                        "every worker host".format(WORKER_SECRET_ENV_VAR))
+    return secret
+
+
+def _is_authorized(message, secret):
+    """ constant time compare, so the secret can't be guessed from reply timing """
+    return hmac.compare_digest(str(message.get("secret", "")).encode("utf-8"), secret.encode("utf-8"))
+
+
+def _send_message(stream, message):
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def _read_message(stream):
+    line = stream.readline()
+    if not line:
+        raise Exception("Connection closed before a message was received")
+    return json.loads(line)
+
+
+def split_work(run_config, worker_count, blueprint_ids=None):
+    """
+    blueprints are dealt out to workers round robin, each blueprint's quantity is split over its workers
+    :param RunConfig run_config:
+    :param int worker_count:
+    :param list blueprint_ids: defaults to the run config blueprint
+    :return: list of RunConfig, one per worker. workers left without sandboxes get None
+    """
+    if run_config.workload:
+        if blueprint_ids:
+            raise Exception("--blueprint can't be combined with a mixed workload - list the blueprints in 'workload'")
+        return _split_workload(run_config, worker_count)
+    blueprint_ids = blueprint_ids or [run_config.blueprint_id]
+    if worker_count < len(blueprint_ids):
+        raise Exception("{} workers can't run {} blueprints - need at least one worker per blueprint".format(
+            worker_count, len(blueprint_ids)))
+
+    worker_blueprints = [blueprint_ids[i % len(blueprint_ids)] for i in range(worker_count)]
+    assignments = []
+    for i, blueprint_id in enumerate(worker_blueprints):
+        blueprint_workers = [j for j, bp in enumerate(worker_blueprints) if bp == blueprint_id]
+        share_index = blueprint_workers.index(i)
+        quantity = run_config.sandbox_quantity // len(blueprint_workers)
+        if share_index < run_config.sandbox_quantity % len(blueprint_workers):
+            quantity += 1
+        assignments.append(run_config._replace(blueprint_id=blueprint_id, sandbox_quantity=quantity)
+                           if quantity else None)
+    return assignments
+
+
+def _split_workload(run_config, worker_count):
+    """
+    every worker runs the whole mix - each blueprint's quantity is split over all workers
+    :param RunConfig run_config: with a workload
+    :param int worker_count:
+    :return: list of RunConfig, one per worker. workers left without sandboxes get None
+    """
+    assignments = []
+    for i in range(worker_count):
+        worker_workload = []
+        for j, blueprint in enumerate(run_config.workload):
+            # remainders are dealt from a different worker per blueprint, so small blueprints don't pile up on one
+            quantity = blueprint.sandbox_quantity // worker_count
+            if (i - j) % worker_count < blueprint.sandbox_quantity % worker_count:
+                quantity += 1
+            if quantity:
+                worker_workload.append(blueprint._replace(sandbox_quantity=quantity))
+        quantity = sum(blueprint.sandbox_quantity for blueprint in worker_workload)
+        assignments.append(run_config._replace(sandbox_quantity=quantity, workload=tuple(worker_workload))
+                           if quantity else None)
+    return assignments
+
+
+def run_worker(worker_name, run_config, time_stamp, workers=0, api_config=None):
+    """
+    full flow for one worker - runs in a worker process or on a worker host
+    works in its own folder so json results / logs / history don't collide with other workers
+    :param str worker_name:
+    :param RunConfig run_config: this worker's share
+    :param str time_stamp: shared by the whole distributed run
+    :param int workers: thread pool size for api calls inside this worker
+    :param ApiConfig api_config: None to read the worker's own config.json
+    :return: json ready dict with the worker's report
+    """
+    if api_config is None:
+        api_config, _ = get_config_data()
+    original_dir = os.getcwd()
+    work_dir = os.path.join(original_dir, my_globals.DISTRIBUTED_FOLDER, time_stamp, worker_name)
+    Path(work_dir).mkdir(exist_ok=True, parents=True)
+    os.chdir(work_dir)
+    logger = None
+    try:
+        log_file_path = build_log_path(time_stamp, run_config.blueprint_id)
+        Path(log_file_path).parent.mkdir(exist_ok=True, parents=True)
+        logger = get_logger(log_file_path)
+        logger.info("Worker {} - {} sandboxes of '{}'".format(worker_name, run_config.sandbox_quantity,
+                                                            run_config.blueprint_id))
+
+        errors = []
+        sb_rest = get_sandbox_rest(api_config, logger, workers)
+        try:
+            try:
+                start_sandboxes(sb_rest, run_config, time_stamp, logger, workers)
+            except ActiveWithErrorException as e:
+                errors.append(str(e))
+            logger.info("Sleeping {} minutes before teardown".format(run_config.active_sandbox_minutes))
+            sleep(run_config.active_sandbox_minutes * 60)
+            try:
+                stop_sandboxes(sb_rest, run_config, time_stamp, logger, workers)
+            except Exception as e:
+                errors.append(str(e))
+        finally:
+            sb_rest.close()
+
+        with open(build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)) as f:
+            report = json.load(f, object_pairs_hook=OrderedDict)
+        return {
+            "worker": worker_name,
+            "blueprint_id": run_config.blueprint_id,
+            "sandbox_quantity": run_config.sandbox_quantity,
+            "errors": errors,
+            "report": report
+        }
+    finally:
+        if logger:
+            # worker hosts serve run after run in one process - don't stack log handlers
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+        os.chdir(original_dir)
+
+
+def _run_remote_worker(address, worker_name, run_config, time_stamp, workers, secret):
+    """
+    :param str address: "<host>:<port>" of a worker started with --serve
+    :param str worker_name:
+    :param RunConfig run_config:
+    :param str time_stamp:
+    :param int workers:
+    :param str secret: see get_worker_secret
+    :return: run_worker output from the remote host
+    """
+    host, port = address.rsplit(":", 1)
+    with socket.create_connection((host, int(port))) as sock:
+        stream = sock.makefile("rw")
+        _send_message(stream, {"command": "run",
+                               "secret": secret,
+                               "worker": worker_name,
+                               "run_config": _run_config_to_dict(run_config),
+                               "time_stamp": time_stamp,
+                               "workers": workers})
+        reply = _read_message(stream)
+    if reply["status"] != "done":
+        raise Exception("Remote worker {} failed: {}".format(address, reply.get("error")))
+    return reply["result"]
+
+
+def serve_worker(listen_address, workers=0):
+    """
+    worker host - run one flow per coordinator connection, api credentials come from the local config.json
+    only run commands carrying the shared secret are run
+    :param str listen_address: "<host>:<port>" - 127.0.0.1 unless coordinators on other machines must reach it
+    :param int workers: default thread pool size when the coordinator does not send one
+    """
+    secret = get_worker_secret()
+    host, port = listen_address.rsplit(":", 1)
+    server = socket.create_server((host, int(port)))
+    print("Worker listening on {}".format(listen_address))
+    while True:
+        connection, coordinator_address = server.accept()
+        with connection:
+            stream = connection.makefile("rw")
+            try:
+                message = _read_message(stream)
+                if not _is_authorized(message, secret):
+                    print("Rejected run request from {}: wrong or missing secret".format(coordinator_address[0]))
+                    raise Exception("Unauthorized - shared secret does not match")
+                print("Run requested by {}: {}".format(coordinator_address[0], message.get("worker")))
+                result = run_worker(message["worker"], _run_config_from_dict(message["run_config"]),
+                                    message["time_stamp"], message.get("workers", workers))
+                reply = {"status": "done", "result": result}
+            except Exception as e:
+                reply = {"status": "error", "error": str(e)}
+            try:
+                _send_message(stream, reply)
+            except OSError as e:
+                print("Could not reply to coordinator: {}".format(str(e)))
+
+
+def run_coordinator(api_config, run_config, time_stamp, logger, local_workers=0, remote_workers=None, workers=0,
+                    blueprint_ids=None):
+    """
+    :param ApiConfig api_config: passed to local workers, remote workers use their own
+    :param RunConfig run_config:
+    :param str time_stamp:
+    :param logging.Logger logger:
+    :param int local_workers: worker processes on this machine
+    :param list remote_workers: "<host>:<port>" addresses of worker hosts
+    :param int workers: thread pool size for api calls inside each worker
+    :param list blueprint_ids: run several blueprints side by side, defaults to the run config blueprint
+    :return: path of the merged json report
+    """
+    remote_workers = remote_workers or []
+    secret = get_worker_secret() if remote_workers else None
+    worker_names = ["local_{}".format(i + 1) for i in range(local_workers)]
+    worker_names += ["remote_{}".format(i + 1) for i in range(len(remote_workers))]
+    if not worker_names:
+        raise Exception("No workers - use --local-workers and / or --remote")
+    assignments = split_work(run_config, len(worker_names), blueprint_ids)
+
+    logger.info("=== Distributing {} sandboxes per blueprint over {} workers ===".format(run_config.sandbox_quantity,
+                                                                                      len(worker_names)))
+    futures = []
+    # spawned, not forked - workers must not inherit the coordinator's log handlers / sessions
+    process_pool = None
+    if local_workers:
+        process_pool = ProcessPoolExecutor(max_workers=local_workers, mp_context=multiprocessing.get_context("spawn"))
+    thread_pool = ThreadPoolExecutor(max_workers=len(remote_workers)) if remote_workers else None
+    try:
+        for i, (worker_name, assignment) in enumerate(zip(worker_names, assignments)):
+            if assignment is None:
+                continue
+            logger.info("Worker {}: {} sandboxes of '{}'".format(worker_name, assignment.sandbox_quantity,
+                                                                 assignment.blueprint_id))
+            if i < local_workers:
+                # every local worker process serves its own /metrics, on the ports after the configured one
+                worker_api_config = api_config._replace(metrics_port=api_config.metrics_port + i + 1) \
+                    if api_config.metrics else api_config
+                future = process_pool.submit(run_worker, worker_name, assignment, time_stamp, workers,
+                                             worker_api_config)
+            else:
+                future = thread_pool.submit(_run_remote_worker, remote_workers[i - local_workers], worker_name,
+                                            assignment, time_stamp, workers, secret)
+            futures.append((worker_name, assignment, future))
+
+        results = []
+        for worker_name, assignment, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Worker {} failed: {}".format(worker_name, str(e)))
+                result = {"worker": worker_name, "blueprint_id": assignment.blueprint_id,
+                          "sandbox_quantity": assignment.sandbox_quantity, "errors": [str(e)], "report": None}
+            results.append(result)
+    finally:
+        if process_pool:
+            process_pool.shutdown()
+        if thread_pool:
+            thread_pool.shutdown()
+
+    report_name = run_config.blueprint_id if not blueprint_ids or len(blueprint_ids) == 1 else DISTRIBUTED_REPORT_NAME
+    json_file_path = build_log_path(time_stamp, report_name, is_json_log=True)
+    report = build_distributed_report(results)
+    Path(json_file_path).parent.mkdir(exist_ok=True, parents=True)
+    with open(json_file_path, 'w') as f:
+        f.write(get_json_from_nested_obj(report))
+    index_run_report(json_file_path, report_name, time_stamp)
+    logger.info("Merged JSON data file written: '{}'".format(json_file_path))
+
+    phases, _ = latency.merge_latency_reports([result["report"]["latency"] for result in results
+                                               if result["report"]])
+    logger.info("Setup latency, all workers: {}".format(latency.format_latency_summary(phases.get("setup"))))
+    logger.info("Teardown latency, all workers: {}".format(latency.format_latency_summary(phases.get("teardown"))))
+
+    # VALIDATE RESULTS
+    failed_workers = [result["worker"] for result in results if result["errors"]]
+    if failed_workers:
+        err_msg = "=== {} workers with errors ===\n{}".format(
+            len(failed_workers), json.dumps({r["worker"]: r["errors"] for r in results if r["errors"]}, indent=4))
+        logger.error(err_msg)
+        raise Exception("{} Workers With Errors!".format(len(failed_workers)))
+
+    logger.info("Distributed flow done with no errors")
+    return json_file_path
+
+
+def build_distributed_report(results):
+    """
+    one json results report from all worker reports - sandboxes are tagged with their worker,
+    latency histograms are merged bucket by bucket so percentiles stay exact to the bucket precision,
+    error signatures by summing their counts
+    :param list results: run_worker outputs
+    :return:
+    """
+    sandboxes = []
+    workers = []
+    for result in results:
+        worker_report = result["report"] or {}
+        for sandbox in worker_report.get("sandboxes", []):
+            sandbox["worker"] = result["worker"]
+            sandboxes.append(sandbox)
+        worker_summary = OrderedDict()
+        worker_summary["worker"] = result["worker"]
+        worker_summary["blueprint_id"] = result["blueprint_id"]
+        worker_summary["sandbox_quantity"] = result["sandbox_quantity"]
+        worker_summary["errors"] = result["errors"]
+        worker_summary["latency"] = worker_report.get("latency")
+        worker_summary["api_calls"] = worker_report.get("api_calls")
+        workers.append(worker_summary)
+
+    phases, stages = latency.merge_latency_reports([w["latency"] for w in workers if w["latency"]])
+    report = OrderedDict()
+    report["sandboxes"] = sandboxes
+    report["latency"] = latency.get_latency_report(phases, stages)
+    blueprints = workload.merge_blueprint_reports(
+        [result["report"].get("blueprints") or {} for result in results if result["report"]])
+    if blueprints:
+        report["blueprints"] = blueprints
+    report["error_signatures"] = error_signatures.merge_error_reports(
+        [result["report"].get("error_signatures") or {} for result in results if result["report"]])
+    report["workers"] = workers
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the full flow over worker processes / hosts")
+    parser.add_argument("--local-workers", type=int, default=0, help="worker processes on this machine")
+    parser.add_argument("--remote", action="append", default=[], help="<host>:<port> of a worker host, repeatable")
+    parser.add_argument("--blueprint", action="append", default=[],
+                        help="blueprint to run, repeatable - each gets 'sandbox_quantity'. default from config")
+    parser.add_argument("--serve", help="run as worker host listening on <host>:<port>, e.g. 127.0.0.1:9100")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls in each worker")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_worker(args.serve, args.workers)
+    else:
+        try:
+            api_config, run_config = get_config_data()
+        except Exception as e:
+            exc_msg = "Make sure config.json file is present. See ReadME for sample. Exception: {}".format(str(e))
+            raise Exception(exc_msg)
+
+        time_stamp = get_utc_timestamp()
+        log_file_path = build_log_path(time_stamp, DISTRIBUTED_REPORT_NAME)
+        Path(log_file_path).parent.mkdir(exist_ok=True, parents=True)
+        logger = get_logger(log_file_path)
+        run_coordinator(api_config, run_config, time_stamp, logger, args.local_workers, args.remote, args.workers,
+                        args.blueprint)
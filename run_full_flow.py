@@ -1,15 +1,29 @@
+import argparse
 import os
-from common import get_config_data, get_utc_timestamp, ActiveWithErrorException
+from common import get_config_data, get_utc_timestamp, ActiveWithErrorException, get_sandbox_rest
 from run_start_sandboxes import start_sandboxes
-from run_stop_sandboxes import stop_sandboxes
+from run_stop_sandboxes import stop_sandboxes, build_log_path
+from journal import get_journal_path, is_teardown_started
+from results_store import get_latest_json_log_timestamp
+from run_soak import run_soak
+from command_load import run_command_load
 from time import sleep
 from logger import get_logger
-from sb_rest.sandbox_rest_api import SandboxRest
 import my_globals
 from pathlib import Path
 
 
-def run_full_flow():
+def run_full_flow(workers=0, soak=False, resume=False):
+    """
+    :param int workers: fan api calls out over a thread pool of this size. 0 runs serially
+    :param bool soak: unattended soak instead of one start / stop batch - see run_soak.py
+    :param bool resume: carry on the latest run from its results journal, setup or teardown. not for soak
+    :return:
+    """
+    if soak and resume:
+        # a soak has no setup / teardown phase to pick up - it would start over on the old run's report
+        raise Exception("--resume can't be used with --soak, start a new soak instead")
+
     try:
         api_config, run_config = get_config_data()
     except Exception as e:
@@ -17,7 +31,7 @@ def run_full_flow():
         raise Exception(exc_msg)
 
     blueprint_name = run_config.blueprint_id
-    time_stamp = get_utc_timestamp()
+    time_stamp = get_latest_json_log_timestamp(run_config.blueprint_id) if resume else get_utc_timestamp()
     current_dir = os.getcwd()
     logs_folder_path = os.path.join(current_dir, my_globals.LOGS_FOLDER, run_config.blueprint_id)
 
@@ -31,36 +45,53 @@ def run_full_flow():
 
     # GET API SESSION
     try:
-        sb_rest = SandboxRest(username=api_config.user,
-                              password=api_config.password,
-                              server=api_config.host,
-                              port=api_config.port,
-                              domain=api_config.domain)
+        sb_rest = get_sandbox_rest(api_config, logger, workers)
     except Exception as e:
         exc_msg = "Could not get sandbox rest session: {}".format(str(e))
         logger.exception(exc_msg)
         raise Exception(exc_msg)
 
-    # START SANDBOXES
-    try:
-        start_sandboxes(sb_rest, run_config, time_stamp, logger)
-    except ActiveWithErrorException as e:
-        exc_msg = "Sandboxes are active with Error: {}".format(str(e))
-        logger.error(exc_msg)
-    except Exception as e:
-        exc_msg = "Unexpected exception during setup flow: {}".format(str(e))
-        logger.exception(exc_msg)
-        raise Exception(exc_msg)
+    if soak:
+        logger.info("Soak mode")
+        run_soak(sb_rest, run_config, time_stamp, logger, workers)
+        return
+
+    # RESUMED TEARDOWN - setup is over, go straight back to tearing down
+    teardown_started = False
+    if resume:
+        journal_path = get_journal_path(build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True))
+        teardown_started = is_teardown_started(journal_path)
+        logger.info("Resuming run {} in {}".format(time_stamp, "teardown" if teardown_started else "setup"))
+
+    if not teardown_started:
+        # START SANDBOXES
+        try:
+            start_sandboxes(sb_rest, run_config, time_stamp, logger, workers, resume)
+        except ActiveWithErrorException as e:
+            exc_msg = "Sandboxes are active with Error: {}".format(str(e))
+            logger.error(exc_msg)
+        except Exception as e:
+            exc_msg = "Unexpected exception during setup flow: {}".format(str(e))
+            logger.exception(exc_msg)
+            raise Exception(exc_msg)
+
+        # COMMAND EXECUTION LOAD - optional, in the sandboxes that came up Ready
+        # a failed load is logged, the sandboxes still get torn down
+        if run_config.command_load.commands:
+            try:
+                run_command_load(sb_rest, run_config, time_stamp, logger, workers)
+            except Exception as e:
+                logger.exception("Unexpected exception during command load: {}".format(str(e)))
 
-    # LET SANDBOX BE ACTIVE FOR A BIT
-    # active_sandbox_minutes = run_config.active_sandbox_minutes
-    # logger.info("Sleeping {} minutes before teardown".format(active_sandbox_minutes))
-    # sleep(active_sandbox_minutes * 60)
-    input("\n===== Sandboxes are active. Press enter to start teardowns =====\n")
+        # LET SANDBOX BE ACTIVE FOR A BIT
+        # active_sandbox_minutes = run_config.active_sandbox_minutes
+        # logger.info("Sleeping {} minutes before teardown".format(active_sandbox_minutes))
+        # sleep(active_sandbox_minutes * 60)
+        input("\n===== Sandboxes are active. Press enter to start teardowns =====\n")
 
     # END SANDBOXES
     try:
-        stop_sandboxes(sb_rest, run_config, time_stamp, logger)
+        stop_sandboxes(sb_rest, run_config, time_stamp, logger, workers, resume)
     except Exception as e:
         exc_msg = "Error during teardown flow: {}".format(str(e))
         logger.exception(exc_msg)
@@ -68,4 +99,11 @@ def run_full_flow():
 
 
 if __name__ == "__main__":
-    run_full_flow()
+    parser = argparse.ArgumentParser(description="Start sandboxes, then tear them down")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls. 0 runs serially")
+    parser.add_argument("--soak", action="store_true", help="hold a steady population of sandboxes, see 'soak' config")
+    parser.add_argument("--resume", action="store_true", help="carry on the latest run from its results journal")
+    args = parser.parse_args()
+    if args.soak and args.resume:
+        parser.error("--resume can't be used with --soak, start a new soak instead")
+    run_full_flow(args.workers, args.soak, args.resume)
@@ -0,0 +1,394 @@
+"""
+Steady state soak - hold a population of "target_active" sandboxes for "duration_minutes"
+a sandbox is stopped once it has been Ready for "dwell_minutes" and a replacement is launched right away,
+so setups and teardowns overlap like real usage and sustained throughput can be measured
+setup polls, dwell timers, stops and teardown polls all run off one PollingScheduler heap
+"""
+import argparse
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+from timeit import default_timer
+
+import error_signatures
+import latency
+import metrics
+import my_globals
+from activity_tail import ActivityTailer
+from common import get_config_data, get_utc_timestamp, sandbox_name_truncater, RunConfig, get_sandbox_rest, \
+    map_api_calls, get_sandboxes_by_id
+from journal import ResultsJournal, get_journal_path, compact_journal
+from logger import get_logger
+from polling_scheduler import PollingScheduler, DurationHistory, SETUP_PHASE, TEARDOWN_PHASE
+from results_store import index_run_report
+from run_start_sandboxes import _launch_sandbox, _get_setup_status
+from run_stop_sandboxes import _stop_sandbox, _get_teardown_status, build_log_path
+from sb_rest.sandbox_rest_api import SandboxRest
+from workload import get_launch_plan, get_workload
+
+ACTIVE_PHASE = "active"
+CYCLE_PHASE = "cycle"
+
+
+class RollingStats(object):
+    def __init__(self, window_seconds):
+        """
+        finished setups / teardowns / full cycles over a sliding window
+        :param float window_seconds:
+        """
+        self._window_seconds = window_seconds
+        self._started_at = time()
+        self._samples = deque()
+        self.totals = {SETUP_PHASE: 0, TEARDOWN_PHASE: 0, CYCLE_PHASE: 0}
+
+    def record(self, phase, seconds):
+        """
+        :param str phase: setup / teardown / cycle
+        :param float seconds: how long it took
+        """
+        self._samples.append((time(), phase, seconds))
+        self.totals[phase] += 1
+
+    def get_window(self):
+        """
+        :return: dict of phase to (completions per minute, LatencyHistogram) over the window
+        """
+        now = time()
+        while self._samples and self._samples[0][0] < now - self._window_seconds:
+            self._samples.popleft()
+        window_minutes = max(min(self._window_seconds, now - self._started_at), 1) / 60.0
+        histograms = {phase: latency.LatencyHistogram() for phase in self.totals}
+        for _, phase, seconds in self._samples:
+            histograms[phase].record(seconds)
+        return {phase: (histogram.count / window_minutes, histogram) for phase, histogram in histograms.items()}
+
+
+def _skip_failed_call(func, logger, message):
+    """
+    a soak runs for hours - one failed api call is logged and the sandbox retried on its next turn
+    :param func: single arg api call
+    :param logging.Logger logger:
+    :param str message: prefix of the error log
+    :return: func wrapper returning None on failure
+    """
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            logger.error("{}: {}".format(message, str(e)))
+            return None
+    return call
+
+
+def run_soak(sb_rest, run_config, time_stamp, logger, workers=0):
+    """
+    :param SandboxRest sb_rest:
+    :param RunConfig run_config:
+    :param str time_stamp: appended to json-results file and sandbox name
+    :param logging.Logger logger:
+    :param int workers: fan api calls out over a thread pool of this size. 0 runs serially
+    :return:
+    """
+    executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+    try:
+        _run_soak(sb_rest, run_config, time_stamp, logger, executor)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _run_soak(sb_rest, run_config, time_stamp, logger, executor):
+    sandbox_name = sandbox_name_truncater("{} - {}".format(time_stamp, run_config.blueprint_id))
+
+    # RESULTS JOURNAL - every launch, stop and state change is appended as it happens, the report is compacted
+    # from it once at the end
+    json_file_path = build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)
+    journal_path = get_journal_path(json_file_path)
+    journal = ResultsJournal(journal_path)
+    try:
+        failed_setups, failed_teardowns = _hold_population(sb_rest, run_config, sandbox_name, logger, executor,
+                                                           journal)
+    finally:
+        # also on a failure or second ctrl+c - sandboxes still in flight reach the report, so they can be torn down
+        journal.close()
+        instrumentation = sb_rest.get_instrumentation()
+        api_summary = instrumentation.get_summary(reset=True) if instrumentation else None
+        compact_journal(journal_path, json_file_path, api_summary, "soak")
+        index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+        logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    # VALIDATE RESULTS
+    if failed_setups or failed_teardowns:
+        err_msg = "=== {} failed setups, {} failed teardowns ===\n{}".format(
+            len(failed_setups), len(failed_teardowns), json.dumps(failed_setups + failed_teardowns, indent=4))
+        logger.error(err_msg)
+        raise Exception("{} Failed Setups, {} Failed Teardowns!".format(len(failed_setups), len(failed_teardowns)))
+
+    logger.info("Soak flow done with no errors")
+
+
+def _hold_population(sb_rest, run_config, sandbox_name, logger, executor, journal):
+    """
+    launch, dwell, stop and replace sandboxes until the soak duration is over and the last one Ended
+    :param ResultsJournal journal: every launch, stop and state change is recorded here as it happens
+    :return: tuple of failed setup sandbox ids, failed teardown sandbox ids
+    """
+    soak_config = run_config.soak
+    target_active = soak_config.target_active or run_config.sandbox_quantity
+    dwell_minutes = soak_config.dwell_minutes
+    if dwell_minutes is None:
+        dwell_minutes = run_config.active_sandbox_minutes
+
+    # serial mode keeps the original request spacing, worker mode relies on the SandboxRest rate budget
+    launch_spacing = 0 if executor else 1
+    poll_spacing = 0 if executor or run_config.bulk_polling else 2
+
+    # ONE HEAP FOR EVERY PHASE - expected durations are passed per sandbox
+    duration_history = DurationHistory(run_config.blueprint_id)
+    setup_durations = duration_history.get_expected_durations(SETUP_PHASE)
+    teardown_durations = duration_history.get_expected_durations(TEARDOWN_PHASE)
+    scheduler = PollingScheduler(run_config.min_polling_seconds, run_config.polling_frequency_seconds)
+    setup_first_poll_delay = scheduler.get_first_poll_delay(run_config.estimated_setup_minutes, setup_durations)
+    teardown_first_poll_delay = scheduler.get_first_poll_delay(run_config.estimated_teardown_minutes,
+                                                               teardown_durations)
+    coalesce_seconds = run_config.min_polling_seconds if run_config.bulk_polling else 0
+    tailer = ActivityTailer(sb_rest, logger, run_config.console_tail_lines) if run_config.live_tail else None
+
+    # SANDBOX ID -> SandboxErrorData / lifecycle phase. sandboxes leave both maps once Ended, the journal keeps them
+    sb_map = {}
+    phases = {}
+
+    # MIXED WORKLOAD - launches cycle through the launch plan, so the blueprint mix holds for the whole soak
+    launch_plan = get_launch_plan(run_config) or list(get_workload(run_config))
+    launch_count = 0
+    failed_setups = []
+    failed_teardowns = []
+    stats = RollingStats(soak_config.stats_window_minutes * 60)
+
+    logger.info("=== Soak: holding {} sandboxes for {} minutes, {} minutes active each ===".format(
+        target_active, soak_config.duration_minutes, dwell_minutes))
+    start = default_timer()
+    soak_end = time() + soak_config.duration_minutes * 60
+    next_stats_at = time() + soak_config.stats_interval_seconds
+    winding_down = False
+
+    while True:
+        # WIND DOWN - no more replacements, active sandboxes are stopped now
+        if not winding_down and time() >= soak_end:
+            winding_down = True
+            logger.info("Soak duration reached - stopping remaining sandboxes")
+            for sb_id, phase in phases.items():
+                if phase == ACTIVE_PHASE:
+                    scheduler.add(sb_id, time(), 0)
+        if winding_down and not sb_map:
+            break
+
+        # REFILL POPULATION
+        population = len([phase for phase in phases.values() if phase != TEARDOWN_PHASE])
+        if not winding_down and population < target_active:
+            launch = _skip_failed_call(lambda blueprint: _launch_sandbox(sb_rest, run_config, sandbox_name, blueprint),
+                                       logger, "Can't start sandbox")
+            blueprints = [launch_plan[(launch_count + i) % len(launch_plan)] for i in range(target_active - population)]
+            launch_count += len(blueprints)
+            for sb_data in map_api_calls(launch, blueprints, executor, launch_spacing):
+                if sb_data is None:
+                    continue
+                journal.record(sb_data)
+                sb_map[sb_data.sandbox_id] = sb_data
+                phases[sb_data.sandbox_id] = SETUP_PHASE
+                metrics.run_metrics.record_event(metrics.LAUNCHED)
+                metrics.run_metrics.record_state(sb_data.sandbox_id, my_globals.SANDBOX_PENDING_STATE)
+                scheduler.add(sb_data.sandbox_id, sb_data.timings[latency.START_REQUESTED], setup_first_poll_delay,
+                              setup_durations)
+
+        # ROLLING STATS
+        if time() >= next_stats_at:
+            next_stats_at = time() + soak_config.stats_interval_seconds
+            _log_rolling_stats(stats, phases, soak_config.stats_window_minutes, len(failed_setups),
+                               len(failed_teardowns), logger)
+
+        try:
+            wake_at = next_stats_at if winding_down else min(next_stats_at, soak_end)
+            # capped wait so failed launches are retried even with nothing in flight
+            due_ids = scheduler.wait_for_due(wake_at, coalesce_seconds, run_config.polling_frequency_seconds)
+        except KeyboardInterrupt:
+            if winding_down:
+                raise
+            logger.warning("Soak interrupted - stopping remaining sandboxes. Interrupt again to abort")
+            soak_end = time()
+            continue
+        if not due_ids:
+            continue
+
+        setup_ids = [sb_id for sb_id in due_ids if phases[sb_id] == SETUP_PHASE]
+        stop_ids = [sb_id for sb_id in due_ids if phases[sb_id] == ACTIVE_PHASE]
+        teardown_ids = [sb_id for sb_id in due_ids if phases[sb_id] == TEARDOWN_PHASE]
+        listed_sandboxes = {}
+        if run_config.bulk_polling and (setup_ids or teardown_ids):
+            listed_sandboxes = get_sandboxes_by_id(sb_rest, logger)
+
+        # POLL SETUPS
+        poll_setup = _skip_failed_call(lambda sb_id: _get_setup_status(sb_rest, sb_id, logger,
+                                                                       listed_sandboxes.get(sb_id), tailer),
+                                       logger, "Setup poll failed")
+        for sb_id, status in zip(setup_ids, map_api_calls(poll_setup, setup_ids, executor, poll_spacing)):
+            if status is None:
+                scheduler.reschedule(sb_id)
+                continue
+            sb_details, activity_feed_errors, polled_at = status
+            sb_data = sb_map[sb_id]
+            state = sb_details["state"]
+            metrics.run_metrics.record_state(sb_id, state)
+            if state != my_globals.SANDBOX_PENDING_STATE:
+                sb_data.mark_time(latency.FIRST_NON_PENDING, polled_at)
+            if state != my_globals.SANDBOX_READY_STATE:
+                sb_data.mark_setup_stage(sb_details.get("setup_stage"), polled_at)
+
+            if state in [my_globals.SANDBOX_ERROR_STATE, my_globals.SANDBOX_READY_STATE]:
+                sb_data.mark_time(latency.SETUP_FINISHED, polled_at)
+                setup_seconds = sb_data.timings[latency.SETUP_FINISHED] - sb_data.timings[latency.START_REQUESTED]
+                stats.record(SETUP_PHASE, setup_seconds)
+            if state == my_globals.SANDBOX_ERROR_STATE:
+                sb_data.failed_setup_stage = sb_details["setup_stage"]
+                journal.record_errors(sb_data, error_signatures.SETUP_PHASE, activity_feed_errors)
+                journal.record(sb_data, state)
+                failed_setups.append(sb_id)
+                metrics.run_metrics.record_event(metrics.SETUP_FAILED)
+                logger.error("Failed setup: {}, stage: {}".format(sb_id, sb_data.failed_setup_stage))
+                stop_ids.append(sb_id)
+            elif state == my_globals.SANDBOX_READY_STATE:
+                logger.info("Sandbox {} Active".format(sb_id))
+                if activity_feed_errors:
+                    logger.warning("Sandbox {} Active with {} setup errors".format(sb_id, len(activity_feed_errors)))
+                    journal.record_errors(sb_data, error_signatures.SETUP_PHASE, activity_feed_errors)
+                journal.record(sb_data, state)
+                metrics.run_metrics.record_event(metrics.READY)
+                duration_history.record(SETUP_PHASE, scheduler.get_duration_estimate(sb_id))
+                phases[sb_id] = ACTIVE_PHASE
+                if winding_down:
+                    stop_ids.append(sb_id)
+                else:
+                    # DWELL - due again when it is time to stop it
+                    scheduler.add(sb_id, polled_at, dwell_minutes * 60)
+            elif polled_at - sb_data.timings[latency.START_REQUESTED] > run_config.setup_polling_timeout * 60:
+                journal.record(sb_data, state)
+                failed_setups.append(sb_id)
+                metrics.run_metrics.record_event(metrics.SETUP_FAILED)
+                logger.error("Setup of {} not completed within {} minutes - stopping it".format(
+                    sb_id, run_config.setup_polling_timeout))
+                stop_ids.append(sb_id)
+            else:
+                journal.record_poll(sb_data, state, sb_details.get("setup_stage"))
+                scheduler.reschedule(sb_id, sb_details.get("setup_stage"))
+
+        # STOP SANDBOXES DONE DWELLING, FAILED OR WINDING DOWN
+        stop = _skip_failed_call(lambda sb_id: _stop_sandbox(sb_rest, sb_id, logger), logger, "Stop failed")
+        for sb_id, stop_times in zip(stop_ids, map_api_calls(stop, stop_ids, executor, launch_spacing)):
+            if stop_times is None:
+                phases[sb_id] = ACTIVE_PHASE
+                scheduler.add(sb_id, time(), run_config.polling_frequency_seconds)
+                continue
+            requested_at, acknowledged_at = stop_times
+            sb_map[sb_id].mark_time(latency.STOP_REQUESTED, requested_at)
+            sb_map[sb_id].mark_time(latency.STOP_ACKNOWLEDGED, acknowledged_at)
+            journal.record(sb_map[sb_id])
+            metrics.run_metrics.record_event(metrics.STOP_REQUESTED)
+            metrics.run_metrics.record_state(sb_id, my_globals.SANDBOX_TEARDOWN_STATE)
+            phases[sb_id] = TEARDOWN_PHASE
+            scheduler.add(sb_id, requested_at, teardown_first_poll_delay, teardown_durations)
+
+        # POLL TEARDOWNS
+        teardown_sandboxes = [sb_map[sb_id] for sb_id in teardown_ids]
+        poll_teardown = _skip_failed_call(lambda sb_data: _get_teardown_status(
+            sb_rest, sb_data, logger, listed_sandboxes.get(sb_data.sandbox_id), tailer), logger, "Teardown poll failed")
+        statuses = map_api_calls(poll_teardown, teardown_sandboxes, executor, poll_spacing)
+        for sb_data, status in zip(teardown_sandboxes, statuses):
+            sb_id = sb_data.sandbox_id
+            if status is None:
+                scheduler.reschedule(sb_id)
+                continue
+            sb_details, activity_feed_errors, polled_at = status
+            metrics.run_metrics.record_state(sb_id, sb_details["state"])
+            is_ended = sb_details["state"] == my_globals.SANDBOX_ENDED_STATE
+            timed_out = polled_at - sb_data.timings[latency.STOP_REQUESTED] > run_config.teardown_polling_timeout * 60
+            if not is_ended and not timed_out:
+                journal.record_poll(sb_data, sb_details["state"])
+                scheduler.reschedule(sb_id)
+                continue
+
+            if is_ended:
+                sb_data.mark_time(latency.ENDED, polled_at)
+                stats.record(TEARDOWN_PHASE, polled_at - sb_data.timings[latency.STOP_REQUESTED])
+                stats.record(CYCLE_PHASE, polled_at - sb_data.timings[latency.START_REQUESTED])
+                duration_history.record(TEARDOWN_PHASE, scheduler.get_duration_estimate(sb_id))
+                metrics.run_metrics.record_event(metrics.ENDED)
+            if activity_feed_errors or timed_out:
+                journal.record_errors(sb_data, error_signatures.TEARDOWN_PHASE, activity_feed_errors)
+                failed_teardowns.append(sb_id)
+                metrics.run_metrics.record_event(metrics.TEARDOWN_FAILED)
+                metrics.run_metrics.forget_sandbox(sb_id)
+                logger.error("Failed teardown: {}{}".format(sb_id, "" if is_ended else ", not Ended in time"))
+            else:
+                logger.info("Completed Teardown: {}".format(sb_id))
+            journal.record(sb_data, sb_details["state"])
+            del sb_map[sb_id]
+            del phases[sb_id]
+            scheduler.remove(sb_id)
+
+    duration_history.save()
+
+    elapsed_minutes = (default_timer() - start) / 60
+    _log_rolling_stats(stats, phases, soak_config.stats_window_minutes, len(failed_setups), len(failed_teardowns),
+                       logger)
+    logger.info("Soak Done. Elapsed: '{}' minutes, {} sandboxes cycled, {:.2f} sandboxes / minute".format(
+        round(elapsed_minutes, 1), stats.totals[CYCLE_PHASE], stats.totals[CYCLE_PHASE] / max(elapsed_minutes, 1)))
+    logger.info("Connection pool stats: {}".format(sb_rest.get_connection_stats()))
+    return failed_setups, failed_teardowns
+
+
+def _log_rolling_stats(stats, phases, window_minutes, failed_setup_count, failed_teardown_count, logger):
+    """
+    :param RollingStats stats:
+    :param dict phases: sandbox id to current phase
+    :param float window_minutes:
+    :param int failed_setup_count:
+    :param int failed_teardown_count:
+    :param logging.Logger logger:
+    :return:
+    """
+    phase_list = list(phases.values())
+    window = stats.get_window()
+    logger.info("Soak: {} in setup, {} active, {} in teardown. failed setups {}, failed teardowns {}".format(
+        phase_list.count(SETUP_PHASE), phase_list.count(ACTIVE_PHASE), phase_list.count(TEARDOWN_PHASE),
+        failed_setup_count, failed_teardown_count))
+    for phase in [SETUP_PHASE, TEARDOWN_PHASE, CYCLE_PHASE]:
+        per_minute, histogram = window[phase]
+        logger.info("    last {} minutes {}: {:.2f} / minute, {}".format(
+            window_minutes, phase, per_minute, latency.format_latency_summary(histogram)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hold a steady population of active sandboxes")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls. 0 runs serially")
+    args = parser.parse_args()
+
+    try:
+        api_config, run_config = get_config_data()
+    except Exception as e:
+        exc_msg = "Make sure config.json file is present. See ReadME for sample. Exception: {}".format(str(e))
+        raise Exception(exc_msg)
+
+    time_stamp = get_utc_timestamp()
+    log_file_path = build_log_path(time_stamp, run_config.blueprint_id)
+    Path(log_file_path).parent.mkdir(exist_ok=True, parents=True)
+    logger = get_logger(log_file_path)
+
+    try:
+        sb_rest = get_sandbox_rest(api_config, logger, args.workers)
+    except Exception as e:
+        exc_msg = "Could not get sandbox rest session: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+    run_soak(sb_rest, run_config, time_stamp, logger, args.workers)
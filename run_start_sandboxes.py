@@ -2,126 +2,357 @@ from sb_rest.sandbox_rest_api import SandboxRest
 from timeit import default_timer
 from time import time, sleep
 import json
-from common import SandboxErrorData, get_config_data, get_utc_timestamp, sandbox_name_truncater, \
-    get_json_from_nested_obj, RunConfig, ActiveWithErrorException
+from common import SandboxErrorData, get_config_data, get_utc_timestamp, get_sandbox_name, RunConfig, \
+    ActiveWithErrorException, get_sandbox_rest, map_api_calls, get_sandboxes_by_id, get_state_bytes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
 from logger import get_logger
 import my_globals
 import os
 from pathlib import Path
+from activity_tail import ActivityTailer
+from polling_scheduler import PollingScheduler, DurationHistory, SETUP_PHASE
+from ramp_profile import LaunchScheduler, BURST
+from journal import ResultsJournal, get_journal_path, compact_journal, resume_from_journal
+from results_store import register_run, index_run_report, get_latest_json_log_timestamp
+import latency
+import metrics
+import error_signatures
+from workload import get_workload, get_launch_plan, format_blueprint_summary
 
 
-def start_sandboxes(sb_rest, run_config, time_stamp, logger):
+def _launch_sandbox(sb_rest, run_config, sandbox_name, blueprint=None):
+    """
+    :param SandboxRest sb_rest:
+    :param RunConfig run_config:
+    :param str sandbox_name:
+    :param WorkloadBlueprint blueprint: launch plan entry, the run config blueprint when not passed
+    :return:
+    """
+    blueprint = blueprint or get_workload(run_config)[0]
+    requested_at = time()
+    sb_details = sb_rest.start_blueprint(blueprint_id=blueprint.blueprint_id,
+                                         sandbox_name=sandbox_name,
+                                         duration=blueprint.sandbox_duration_iso_formatted,
+                                         params=blueprint.blueprint_params)
+    sb_data = SandboxErrorData(sb_details["id"], blueprint_id=blueprint.blueprint_id if run_config.workload else None)
+    sb_data.mark_time(latency.START_REQUESTED, requested_at)
+    sb_data.mark_time(latency.START_ACKNOWLEDGED)
+    return sb_data
+
+
+def _launch_burst(launch_func, launch_plan, executor, spacing_seconds):
+    """
+    send every launch up front - fanned out over thread pool if given, else serially with a sleep after each call
+    each launch comes back as soon as it completes, a failed one as its exception, so one failed start request
+    can't hide the sandboxes started around it
+    :param launch_func: callable taking a launch plan entry, returns SandboxErrorData
+    :param list launch_plan:
+    :param concurrent.futures.ThreadPoolExecutor executor:
+    :param int spacing_seconds: buffer between serial api requests
+    :return: iterator of SandboxErrorData or Exception, in completion order
+    """
+    if not executor:
+        for blueprint in launch_plan:
+            try:
+                yield launch_func(blueprint)
+            except Exception as e:
+                yield e
+            sleep(spacing_seconds)
+        return
+    futures = [executor.submit(launch_func, blueprint) for blueprint in launch_plan]
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except Exception as e:
+            yield e
+
+
+def _get_setup_status(sb_rest, sandbox_id, logger, listed_details=None, tailer=None):
+    """
+    poll sandbox once, pull activity feed errors if setup failed
+    in live tail mode errors of sandboxes that end Ready are returned too - non-fatal, they go to the report
+    does not touch SandboxErrorData so it is safe to run in worker threads
+    :param SandboxRest sb_rest:
+    :param str sandbox_id:
+    :param logging.Logger logger:
+    :param dict listed_details: entry from bulk sandbox list. per-id GET is skipped when it has what we need
+    :param ActivityTailer tailer: live tail mode - errors are collected on every poll instead of scanned at the end
+    :return: tuple of sandbox details, activity feed errors (None while setup runs), epoch time of poll
+    """
+    # failed stage is only needed on Error - list entries may not carry "setup_stage"
+    if listed_details and (listed_details["state"] != my_globals.SANDBOX_ERROR_STATE or
+                           "setup_stage" in listed_details):
+        sb_details = listed_details
+    else:
+        sb_details = _get_sandbox_data(sb_rest, sandbox_id, logger)
+    polled_at = time()
+
+    state = sb_details["state"]
+    activity_feed_errors = None
+    if tailer:
+        if state in [my_globals.SANDBOX_ERROR_STATE, my_globals.SANDBOX_READY_STATE]:
+            activity_feed_errors = tailer.finish(sandbox_id, sb_details.get("setup_stage"))
+        else:
+            tailer.tail(sandbox_id, sb_details.get("setup_stage"))
+    elif state == my_globals.SANDBOX_ERROR_STATE:
+        sleep(3)
+        activity_feed_errors = list(sb_rest.read_new_activity(sandbox_id, error_only=True))
+    return sb_details, activity_feed_errors, polled_at
+
+
+def _get_sandbox_data(sb_rest, sandbox_id, logger):
+    """
+    :param SandboxRest sb_rest:
+    :param str sandbox_id:
+    :param logging.Logger logger:
+    :return:
+    """
+    # rate quota responses are retried inside SandboxRest
+    try:
+        return sb_rest.get_sandbox_data(sandbox_id)
+    except Exception as e:
+        exc_msg = "Issue during polling: {}".format(str(e))
+        logger.exception(exc_msg)
+        raise Exception(exc_msg)
+
+
+def start_sandboxes(sb_rest, run_config, time_stamp, logger, workers=0, resume=False):
     """
 
     :param SandboxRest sb_rest:
     :param RunConfig run_config:
     :param str time_stamp: appended to json-results file and sandbox name
     :param logging.Logger logger:
+    :param int workers: fan api calls out over a thread pool of this size. 0 runs serially
+    :param bool resume: carry on an interrupted run with this time stamp from its results journal
     :return:
     """
+    executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+    try:
+        _start_sandboxes(sb_rest, run_config, time_stamp, logger, executor, resume)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _start_sandboxes(sb_rest, run_config, time_stamp, logger, executor, resume):
+    sandbox_name = get_sandbox_name(time_stamp, run_config.blueprint_id)
+
+    # serial mode keeps the original request spacing, worker mode relies on the SandboxRest rate budget
+    launch_spacing = 0 if executor else 1
+    poll_spacing = 0 if executor or run_config.bulk_polling else 2  # add some buffer to the api requests
+
+    # RESULTS JOURNAL - every launch and state change is appended as it happens, the report is compacted from it
+    current_dir = os.getcwd()
+    log_folder_path = os.path.join(current_dir, my_globals.JSON_RESULTS_FOLDER, run_config.blueprint_id)
+    json_file_name = "{}_{}.json".format(time_stamp, run_config.blueprint_id)
+    json_file_path = os.path.join(log_folder_path, json_file_name)
+    journal_path = get_journal_path(json_file_path)
+    journal = ResultsJournal(journal_path)
+    register_run(run_config.blueprint_id, time_stamp)
+    resumed_sandboxes = None
+    if resume:
+        resumed_sandboxes = resume_from_journal(journal, get_sandboxes_by_id(sb_rest, logger), sandbox_name, logger,
+                                                bool(run_config.workload))
+    try:
+        finished_setups, failed_setups, failed_launch_count = _launch_and_poll(
+            sb_rest, run_config, sandbox_name, logger, executor, journal, launch_spacing, poll_spacing,
+            resumed_sandboxes)
+    except BaseException:
+        # polling timeout, api failure or ctrl+c - started sandbox ids must still reach the report for teardown
+        journal.close()
+        compact_journal(journal_path, json_file_path)
+        index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+        logger.error("Setup did not finish. Partial JSON data file written: '{}'".format(json_file_path))
+        raise
+    journal.close()
+
+    phase_histograms, _ = latency.build_latency_histograms(finished_setups)
+    logger.info("Setup latency: {}".format(latency.format_latency_summary(phase_histograms.get("setup"))))
+    if run_config.workload:
+        logger.info("Setup latency per blueprint:\n{}".format(format_blueprint_summary(finished_setups, "setup")))
 
-    sandbox_name = "{} - {}".format(time_stamp, run_config.blueprint_id)
-    sandbox_name = sandbox_name_truncater(sandbox_name)
+    # STORE SETUP DATA TO JSON FILE
+    instrumentation = sb_rest.get_instrumentation()
+    api_summary = instrumentation.get_summary(reset=True) if instrumentation else None
+    report_sandboxes = compact_journal(journal_path, json_file_path, api_summary, SETUP_PHASE)
+    index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+
+    logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    # VALIDATE RESULTS
+    if failed_setups or failed_launch_count:
+        if failed_setups:
+            # the report has the full error events, sandboxes in memory only their references
+            signatures, _ = error_signatures.build_error_report(report_sandboxes)
+            logger.error("Setup {}".format(error_signatures.format_error_summary(signatures)))
+        failed_count = len(failed_setups)
+        err_msg = "=== {} failed setups, {} failed launches ===\n{}".format(
+            failed_count, failed_launch_count, json.dumps(failed_setups, indent=4))
+        logger.error(err_msg)
+        raise ActiveWithErrorException("{} Failed Setups, {} Failed Launches!".format(failed_count,
+                                                                                   failed_launch_count))
+
+    logger.info("Setup flow done with no errors")
+
+
+def _launch_and_poll(sb_rest, run_config, sandbox_name, logger, executor, journal, launch_spacing, poll_spacing,
+                     resumed_sandboxes=None):
+    """
+    launch and poll setup until every sandbox is Ready or in Error
+    :param ResultsJournal journal: every launch and state change is recorded here as it happens
+    :param list resumed_sandboxes: SandboxErrorData of an interrupted run - only the missing quantity is launched
+    :return: tuple of finished SandboxErrorData list, failed sandbox ids, failed launch count
+    """
+    # RESUMED SANDBOXES - finished setups are kept, the rest go back to polling
+    resumed_sandboxes = resumed_sandboxes or []
+    finished_setups = [sb_data for sb_data in resumed_sandboxes if latency.SETUP_FINISHED in sb_data.timings]
+    failed_setups = [sb_data.sandbox_id for sb_data in finished_setups if sb_data.failed_setup_stage]
+    started_sandboxes = [sb_data for sb_data in resumed_sandboxes if latency.SETUP_FINISHED not in sb_data.timings]
+    launch_plan = get_launch_plan(run_config, resumed_sandboxes)
+    launch_quantity = len(launch_plan)
 
     # START SANDBOXES
-    logger.info("=== Starting {} sandboxes ===".format(run_config.sandbox_quantity))
+    # burst launches everything before polling, other ramp shapes launch on their own schedule while polling runs
+    ramp_profile = run_config.ramp_profile
+    logger.info("=== Starting {} sandboxes, ramp shape '{}' ===".format(launch_quantity, ramp_profile.shape))
     start = default_timer()
-    started_sandboxes = []
-    for i in range(run_config.sandbox_quantity):
-        sb_details = sb_rest.start_blueprint(blueprint_id=run_config.blueprint_id,
-                                             sandbox_name=sandbox_name,
-                                             duration=run_config.sandbox_duration_iso_formatted,
-                                             params=run_config.blueprint_params)
-        curr_sb_id = sb_details["id"]
-        sb_data = SandboxErrorData(curr_sb_id)
-        started_sandboxes.append(sb_data)
-        sleep(1)
-
-    # LET SETUP RUN A BIT
-    logger.info("Waiting {} minutes before polling setup...".format(run_config.estimated_setup_minutes))
-    sleep(run_config.estimated_setup_minutes * 60)
+    launcher = None
+    failed_launch_count = 0
+    if ramp_profile.shape == BURST:
+        # every launch is recorded before a failed one is counted - the report can tear down all started sandboxes
+        for launched in _launch_burst(lambda blueprint: _launch_sandbox(sb_rest, run_config, sandbox_name, blueprint),
+                                      launch_plan, executor, launch_spacing):
+            if isinstance(launched, Exception):
+                failed_launch_count += 1
+                logger.error("Can't start sandbox: {}".format(str(launched)))
+                continue
+            journal.record(launched)
+            metrics.run_metrics.record_event(metrics.LAUNCHED)
+            metrics.run_metrics.record_state(launched.sandbox_id, my_globals.SANDBOX_PENDING_STATE)
+            started_sandboxes.append(launched)
+    elif launch_quantity:
+        launcher = LaunchScheduler(lambda index: _launch_sandbox(sb_rest, run_config, sandbox_name, launch_plan[index]),
+                                   launch_quantity, ramp_profile, logger)
+        launcher.start()
+
+    # SCHEDULE FIRST POLL PER SANDBOX
+    # timed from each sandbox's own launch, using setup durations seen in earlier runs when there are any
+    duration_history = DurationHistory(run_config.blueprint_id)
+    scheduler = PollingScheduler(run_config.min_polling_seconds, run_config.polling_frequency_seconds,
+                                 duration_history.get_expected_durations(SETUP_PHASE))
+    first_poll_delay = scheduler.get_first_poll_delay(run_config.estimated_setup_minutes)
+    logger.info("Polling setup of each sandbox {} seconds after launch...".format(int(first_poll_delay)))
 
     # BUILD SANDBOX DATA MAP WITH ID AS KEY
     # REMOVE ITEM FROM MAP WHEN SETUP FINISHES
+    # polling timeout counts from the latest launch
     sb_map = {}
-    for sb_data in started_sandboxes:
-        sb_map[sb_data.sandbox_id] = sb_data
+    total_polling_minutes = run_config.setup_polling_timeout
+    t_end = time() + first_poll_delay + (60 * total_polling_minutes)
+
+    def add_launched(launched_sandboxes):
+        for launched in launched_sandboxes:
+            sb_map[launched.sandbox_id] = launched
+            # sandboxes resumed by name have no journaled start request
+            requested_at = launched.timings.get(latency.START_REQUESTED, time())
+            scheduler.add(launched.sandbox_id, requested_at, first_poll_delay)
+        if launched_sandboxes:
+            return max(t_end, time() + first_poll_delay + (60 * total_polling_minutes))
+        return t_end
+
+    t_end = add_launched(started_sandboxes)
 
     # POLL THE SETUP
-    finished_setups = []
-    failed_setups = []
-    total_polling_minutes = run_config.setup_polling_timeout
-    t_end = time() + (60 * total_polling_minutes)
-    while time() < t_end:
-        for curr_sb_id, sb_data in list(sb_map.items()):
-            try:
-                sb_details = sb_rest.get_sandbox_data(curr_sb_id)
-            except Exception as e:
-                if "rate quota" in str(e):
-                    logger.error("api rate quota exceeded. Waiting a minute and re-polling...")
-                    sleep(60)
-                    sb_details = sb_rest.get_sandbox_data(curr_sb_id)
-                else:
-                    exc_msg = "Issue during polling: {}".format(str(e))
-                    logger.exception(exc_msg)
-                    raise (exc_msg)
+    # statuses are fetched in workers, SandboxErrorData is only updated here on the calling thread
+    coalesce_seconds = run_config.min_polling_seconds if run_config.bulk_polling else 0
+    tailer = ActivityTailer(sb_rest, logger, run_config.console_tail_lines) if run_config.live_tail else None
+    while sb_map or (launcher and not launcher.is_done()):
+        max_wait = None
+        if launcher and not launcher.is_done():
+            # wake up regularly to pick up sandboxes launched since the last poll
+            launched_sandboxes = launcher.get_launched()
+            for launched in launched_sandboxes:
+                journal.record(launched)
+                metrics.run_metrics.record_event(metrics.LAUNCHED)
+                metrics.run_metrics.record_state(launched.sandbox_id, my_globals.SANDBOX_PENDING_STATE)
+            t_end = add_launched(launched_sandboxes)
+            max_wait = run_config.min_polling_seconds
+        sandbox_ids = scheduler.wait_for_due(t_end, coalesce_seconds, max_wait)
+        if not sandbox_ids:
+            if time() < t_end:
+                continue
+            # POLLING TIMEOUT
+            exc_msg = "Setup Polling not completed within {} minutes".format(total_polling_minutes)
+            logger.error(exc_msg)
+            raise Exception(exc_msg)
 
+        listed_sandboxes = get_sandboxes_by_id(sb_rest, logger) if run_config.bulk_polling else {}
+        statuses = map_api_calls(lambda sb_id: _get_setup_status(sb_rest, sb_id, logger, listed_sandboxes.get(sb_id),
+                                                                 tailer),
+                                 sandbox_ids, executor, poll_spacing)
+        for curr_sb_id, (sb_details, activity_feed_errors, polled_at) in zip(sandbox_ids, statuses):
+            sb_data = sb_map[curr_sb_id]
             state = sb_details["state"]
+            metrics.run_metrics.record_state(curr_sb_id, state)
+            if state != my_globals.SANDBOX_PENDING_STATE:
+                sb_data.mark_time(latency.FIRST_NON_PENDING, polled_at)
+            if state != my_globals.SANDBOX_READY_STATE:
+                sb_data.mark_setup_stage(sb_details.get("setup_stage"), polled_at)
+            if state in [my_globals.SANDBOX_ERROR_STATE, my_globals.SANDBOX_READY_STATE]:
+                sb_data.mark_time(latency.SETUP_FINISHED, polled_at)
+
             if state == my_globals.SANDBOX_ERROR_STATE:
-                sleep(3)
                 sb_data.failed_setup_stage = sb_details["setup_stage"]
-                activity_feed_errors = sb_rest.get_sandbox_activity(curr_sb_id, True)
-                sb_data.setup_errors = activity_feed_errors
+                journal.record_errors(sb_data, error_signatures.SETUP_PHASE, activity_feed_errors)
+                journal.record(sb_data, state)
                 finished_setups.append(sb_data)
                 failed_setups.append(curr_sb_id)
+                metrics.run_metrics.record_event(metrics.SETUP_FAILED)
                 del sb_map[curr_sb_id]
+                scheduler.remove(curr_sb_id)
+                if launcher:
+                    launcher.on_setup_finished()
                 logger.error("Failed setup: {}, stage: {}".format(curr_sb_id, sb_data.failed_setup_stage))
                 continue
             if state == my_globals.SANDBOX_READY_STATE:
                 logger.info("Sandbox {} Active".format(curr_sb_id))
+                if activity_feed_errors:
+                    logger.warning("Sandbox {} Active with {} setup errors".format(curr_sb_id,
+                                                                                  len(activity_feed_errors)))
+                    journal.record_errors(sb_data, error_signatures.SETUP_PHASE, activity_feed_errors)
+                journal.record(sb_data, state)
+                metrics.run_metrics.record_event(metrics.READY)
                 finished_setups.append(sb_data)
                 del sb_map[curr_sb_id]
-            sleep(2)  # add some buffer to the api requests
-
-        if not sb_map:
-            break
+                duration_history.record(SETUP_PHASE, scheduler.get_duration_estimate(curr_sb_id))
+                scheduler.remove(curr_sb_id)
+                if launcher:
+                    launcher.on_setup_finished()
+                continue
+            journal.record_poll(sb_data, state, sb_details.get("setup_stage"))
+            scheduler.reschedule(curr_sb_id, sb_details.get("setup_stage"))
 
-        # POLLING DELAY
-        sleep(run_config.polling_frequency_seconds)
-    else:
-        # POLLING TIMEOUT
-        exc_msg = "Teardown Polling not completed within {} minutes".format(total_polling_minutes)
-        logger.error(exc_msg)
-        raise Exception(exc_msg)
+    duration_history.save()
 
-    elapsed = int(default_timer() - start)
-    elapsed = int(elapsed / 60)
+    elapsed = round((default_timer() - start) / 60, 1)
     logger.info("Sandboxes Done. Elapsed: '{}' minutes".format(elapsed))
-
-    # STORE SETUP DATA TO JSON FILE
-    current_dir = os.getcwd()
-    log_folder_path = os.path.join(current_dir, my_globals.JSON_RESULTS_FOLDER, run_config.blueprint_id)
-    Path(log_folder_path).mkdir(exist_ok=True, parents=True)  # make folder if it doesn't exist
-
-    json_file_name = "{}_{}.json".format(time_stamp, run_config.blueprint_id)
-    json_file_path = os.path.join(log_folder_path, json_file_name)
-    with open(json_file_path, 'w') as f:
-        sb_data_json = get_json_from_nested_obj(finished_setups)
-        f.write(sb_data_json)
-
-    logger.info("JSON data file written: '{}'".format(json_file_path))
-
-    # VALIDATE RESULTS
-    if failed_setups:
-        failed_count = len(failed_setups)
-        err_msg = "=== {} failed setups ===\n{}".format(failed_count, json.dumps(failed_setups, indent=4))
-        logger.error(err_msg)
-        raise ActiveWithErrorException("{} Failed Setups!".format(failed_count))
-
-    logger.info("Setup flow done with no errors")
+    logger.info("Connection pool stats: {}".format(sb_rest.get_connection_stats()))
+    logger.info("Sandbox state in memory: {} bytes per sandbox".format(
+        get_state_bytes(finished_setups) // max(len(finished_setups), 1)))
+    if launcher:
+        logger.info("Launch schedule stats: {}".format(launcher.get_launch_stats()))
+        failed_launch_count = launcher.get_failed_count()
+    return finished_setups, failed_setups, failed_launch_count
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start sandboxes and poll setup")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls. 0 runs serially")
+    parser.add_argument("--resume", action="store_true", help="carry on the latest run from its results journal")
+    args = parser.parse_args()
+
     try:
         api_config, run_config = get_config_data()
     except Exception as e:
@@ -129,7 +360,7 @@ if __name__ == "__main__":
         raise Exception(exc_msg)
 
     blueprint_name = run_config.blueprint_id
-    time_stamp = get_utc_timestamp()
+    time_stamp = get_latest_json_log_timestamp(run_config.blueprint_id) if args.resume else get_utc_timestamp()
 
     current_dir = os.getcwd()
     logs_folder_path = os.path.join(current_dir, my_globals.LOGS_FOLDER, run_config.blueprint_id)
@@ -140,13 +371,9 @@ if __name__ == "__main__":
     logger = get_logger(log_file_path)
 
     try:
-        sb_rest = SandboxRest(username=api_config.user,
-                              password=api_config.password,
-                              server=api_config.host,
-                              port=api_config.port,
-                              domain=api_config.domain)
+        sb_rest = get_sandbox_rest(api_config, logger, args.workers)
     except Exception as e:
         exc_msg = "Could not get sandbox rest session: {}".format(str(e))
         logger.exception(exc_msg)
         raise Exception(exc_msg)
-    start_sandboxes(sb_rest, run_config, time_stamp, logger)
+    start_sandboxes(sb_rest, run_config, time_stamp, logger, args.workers, args.resume)
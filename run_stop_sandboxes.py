@@ -2,29 +2,22 @@ from sb_rest.sandbox_rest_api import SandboxRest
 from timeit import default_timer
 from time import time, sleep
 import json
-from common import SandboxErrorData, get_config_data, get_json_from_nested_obj, RunConfig
+from common import SandboxErrorData, get_config_data, RunConfig, get_sandbox_rest, map_api_calls, \
+    get_sandboxes_by_id, read_json_report_sandboxes, get_sandbox_name, get_state_bytes
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 from logger import get_logger
 import my_globals
 import os
-from datetime import datetime
-
-
-def _get_latest_json_log_timestamp(blueprint_id):
-    """
-    find latest dated log in results folder
-    sample results file name - <time_stamp>_<blueprint_name>.<filetype>
-    :param str blueprint_id: refers to folder inside json-results
-    :return:
-    """
-    current_dir = os.getcwd()
-    log_folder_path = os.path.join(current_dir, my_globals.JSON_RESULTS_FOLDER, blueprint_id)
-    log_files = os.listdir(log_folder_path)
-    time_stamp_strings = ["_".join(x.split("_")[:-1]) for x in log_files]
-    datetime_time_stamps = [datetime.strptime(ts, my_globals.TIMESTAMP_FORMATTING) for ts in time_stamp_strings]
-    datetime_time_stamps.sort()
-    latest_timestamp = datetime_time_stamps.pop()
-    latest_timestamp_str = datetime.strftime(latest_timestamp, my_globals.TIMESTAMP_FORMATTING)
-    return latest_timestamp_str
+from activity_tail import ActivityTailer
+from polling_scheduler import PollingScheduler, DurationHistory, TEARDOWN_PHASE
+import latency
+import metrics
+import error_signatures
+from workload import format_blueprint_summary
+from journal import ResultsJournal, get_journal_path, compact_journal, resume_from_journal, \
+    read_journal_sandboxes
+from results_store import index_run_report, get_latest_json_log_timestamp
 
 
 def build_log_path(time_stamp, blueprint_id, is_json_log=False):
@@ -49,159 +42,300 @@ def build_log_path(time_stamp, blueprint_id, is_json_log=False):
 
 
 def _get_sandbox_data_from_json(path):
-    with open(path) as config_file:
-        data = json.load(config_file)
+    data = read_json_report_sandboxes(path)
     obj_wrapped_data = [SandboxErrorData(sandbox_id=x["sandbox_id"],
                                          failed_setup_stage=x["failed_setup_stage"],
-                                         setup_errors=x["setup_errors"])
+                                         setup_errors=x["setup_errors"],
+                                         timings=x.get("timings"),
+                                         blueprint_id=x.get("blueprint_id"))
                         for x in data]
     return obj_wrapped_data
 
 
-def stop_sandboxes(sb_rest, run_config, time_stamp, logger):
+def _stop_sandbox(sb_rest, sandbox_id, logger):
+    """
+    send stop request, retry once
+    :param SandboxRest sb_rest:
+    :param str sandbox_id:
+    :param logging.Logger logger:
+    :return: tuple of epoch times of stop request and acknowledgement
+    """
+    requested_at = time()
+    try:
+        sb_rest.stop_sandbox(sandbox_id)
+    except Exception as e:
+        exc_msg = "Can't end sandbox '{}'.Retrying. Exception {}".format(sandbox_id, str(e))
+        logger.error(exc_msg)
+        sleep(5)
+        try:
+            sb_rest.stop_sandbox(sandbox_id)
+        except Exception as e:
+            exc_msg = "Can't end sandbox '{}'. Raising Exception {}".format(sandbox_id, str(e))
+            logger.exception(exc_msg)
+            raise Exception(exc_msg)
+    return requested_at, time()
+
+
+def _get_teardown_status(sb_rest, sb_data, logger, listed_details=None, tailer=None):
+    """
+    poll sandbox once, pull teardown errors from activity feed once sandbox has Ended
+    only reads SandboxErrorData so it is safe to run in worker threads
+    :param SandboxRest sb_rest:
+    :param SandboxErrorData sb_data:
+    :param logging.Logger logger:
+    :param dict listed_details: entry from bulk sandbox list. ended sandboxes drop off the list and fall back to GET
+    :param ActivityTailer tailer: live tail mode - errors are collected on every poll instead of scanned at the end
+    :return: tuple of sandbox details, activity feed errors (None unless Ended), epoch time of poll
+    """
+    curr_sb_id = sb_data.sandbox_id
+    if listed_details:
+        sb_details = listed_details
+    else:
+        # rate quota responses are retried inside SandboxRest
+        try:
+            sb_details = sb_rest.get_sandbox_data(curr_sb_id)
+        except Exception as e:
+            exc_msg = "Issue during polling: {}".format(str(e))
+            logger.exception(exc_msg)
+            raise Exception(exc_msg)
+    polled_at = time()
+
+    # teardown errors are read from past the last setup error - in the same session the cursor is there already,
+    # when stop runs standalone the setup errors from the json results file mark it
+    if sb_data.setup_errors:
+        last_setup_error_id = max(x["id"] for x in sb_data.setup_errors)
+        sb_rest.seed_activity_cursor(curr_sb_id, last_setup_error_id + 1, error_only=True)
+
+    is_ended = sb_details["state"] == my_globals.SANDBOX_ENDED_STATE
+    if tailer:
+        if is_ended:
+            return sb_details, tailer.finish(curr_sb_id), polled_at
+        tailer.tail(curr_sb_id)
+        return sb_details, None, polled_at
+    if not is_ended:
+        return sb_details, None, polled_at
+
+    sleep(3)
+    activity_feed_errors = list(sb_rest.read_new_activity(curr_sb_id, error_only=True))
+    return sb_details, activity_feed_errors, polled_at
+
+
+def stop_sandboxes(sb_rest, run_config, time_stamp, logger, workers=0, resume=False):
     """
     :param SandboxRest sb_rest:
     :param RunConfig run_config:
     :param str time_stamp:
     :param logging.Logger logger:
+    :param int workers: fan api calls out over a thread pool of this size. 0 runs serially
+    :param bool resume: carry on an interrupted teardown from the results journal
     :return:
     """
+    executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+    try:
+        _stop_sandboxes(sb_rest, run_config, time_stamp, logger, executor, resume)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _stop_sandboxes(sb_rest, run_config, time_stamp, logger, executor, resume):
     json_file_path = build_log_path(time_stamp, run_config.blueprint_id, is_json_log=True)
-    sandbox_data_list = _get_sandbox_data_from_json(json_file_path)
+    journal_path = get_journal_path(json_file_path)
+    is_new_journal = not os.path.exists(journal_path)
+    # the journal holds error events out of line - sandboxes read from it only carry references
+    if is_new_journal:
+        sandbox_data_list = _get_sandbox_data_from_json(json_file_path)
+    elif not resume:
+        sandbox_data_list = read_journal_sandboxes(journal_path, expand_errors=False)
+    else:
+        sandbox_data_list = []
+
+    # serial mode keeps the original request spacing, worker mode relies on the SandboxRest rate budget
+    stop_spacing = 0 if executor else 1
+    poll_spacing = 0 if executor or run_config.bulk_polling else 2  # add some buffer to the api requests
+
+    # RESULTS JOURNAL - continues the setup journal. reports from before the journal are copied in first
+    journal = ResultsJournal(journal_path)
+    if is_new_journal:
+        for sb_data in sandbox_data_list:
+            journal.record_errors(sb_data, error_signatures.SETUP_PHASE, sb_data.setup_errors)
+            journal.record(sb_data)
+
+    # RESUME - sandboxes already tearing down or gone from the live list are polled, not stopped again
+    stopping_ids = set()
+    if resume:
+        listed_sandboxes = get_sandboxes_by_id(sb_rest, logger)
+        sandbox_data_list = resume_from_journal(journal, listed_sandboxes,
+                                                get_sandbox_name(time_stamp, run_config.blueprint_id), logger,
+                                                bool(run_config.workload))
+        stopping_ids = set(sb_data.sandbox_id for sb_data in sandbox_data_list
+                           if sb_data.sandbox_id not in listed_sandboxes or
+                           listed_sandboxes[sb_data.sandbox_id]["state"] == my_globals.SANDBOX_TEARDOWN_STATE)
+    try:
+        finished_teardowns, failed_teardowns = _stop_and_poll(sb_rest, run_config, sandbox_data_list, logger,
+                                                              executor, journal, stop_spacing, poll_spacing,
+                                                              stopping_ids)
+    except BaseException:
+        # polling timeout, api failure or ctrl+c - keep what is known about every sandbox
+        journal.close()
+        compact_journal(journal_path, json_file_path)
+        index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+        logger.error("Teardown did not finish. Partial JSON data file written: '{}'".format(json_file_path))
+        raise
+    journal.close()
+
+    phase_histograms, _ = latency.build_latency_histograms(finished_teardowns)
+    logger.info("Teardown latency: {}".format(latency.format_latency_summary(phase_histograms.get("teardown"))))
+    if run_config.workload:
+        logger.info("Teardown latency per blueprint:\n{}".format(format_blueprint_summary(finished_teardowns,
+                                                                                         "teardown")))
+
+    instrumentation = sb_rest.get_instrumentation()
+    api_summary = instrumentation.get_summary(reset=True) if instrumentation else None
+    report_sandboxes = compact_journal(journal_path, json_file_path, api_summary, TEARDOWN_PHASE)
+    index_run_report(json_file_path, run_config.blueprint_id, time_stamp)
+
+    logger.info("JSON data file written: '{}'".format(json_file_path))
+
+    # VALIDATE RESULTS
+    if failed_teardowns:
+        # the report has the full error events, sandboxes in memory only their references
+        signatures, _ = error_signatures.build_error_report(report_sandboxes)
+        logger.error("Teardown {}".format(error_signatures.format_error_summary(
+            signatures, phase=error_signatures.TEARDOWN_PHASE)))
+        failed_count = len(failed_teardowns)
+        err_msg = "=== {} failed teardowns ===\n{}".format(failed_count, json.dumps(failed_teardowns, indent=4))
+        logger.error(err_msg)
+        raise Exception("{} Failed Teardowns!".format(failed_count))
+
+    logger.info("Teardown flow done with no errors.")
+
+
+def _stop_and_poll(sb_rest, run_config, sandbox_data_list, logger, executor, journal, stop_spacing, poll_spacing,
+                   stopping_ids=None):
+    """
+    stop every sandbox and poll teardown until all have Ended
+    sandboxes that already Ended are kept as they are, acknowledged stops are only polled - a resumed teardown
+    :param ResultsJournal journal: every stop and state change is recorded here as it happens
+    :param set stopping_ids: sandboxes known to be tearing down without a journaled stop
+    :return: tuple of finished SandboxErrorData list, failed sandbox ids
+    """
+    stopping_ids = stopping_ids or set()
+    finished_teardowns = [sb_data for sb_data in sandbox_data_list if latency.ENDED in sb_data.timings]
+    failed_teardowns = [sb_data.sandbox_id for sb_data in finished_teardowns if sb_data.teardown_errors]
+    polled_sandboxes = [sb_data for sb_data in sandbox_data_list if latency.ENDED not in sb_data.timings]
+    stopped_sandboxes = [sb_data for sb_data in polled_sandboxes
+                         if latency.STOP_ACKNOWLEDGED not in sb_data.timings and sb_data.sandbox_id not in stopping_ids]
 
     # BUILD SANDBOX DATA MAP WITH SANDBOX ID AS KEY
     # REMOVE ITEM FROM MAP WHEN SETUP FINISHES
     sb_map = {}
-    for sb_data in sandbox_data_list:
+    for sb_data in polled_sandboxes:
         sb_map[sb_data.sandbox_id] = sb_data
 
-    sandbox_count = len(sandbox_data_list)
+    sandbox_count = len(stopped_sandboxes)
 
     # STOP SANDBOXES
     logger.info("=== Stopping {} Sandboxes ===".format(sandbox_count))
     start = default_timer()
-    for curr_sb_data in sandbox_data_list:
-        try:
-            sb_rest.stop_sandbox(curr_sb_data.sandbox_id)
-        except Exception as e:
-            exc_msg = "Can't end sandbox '{}'.Retrying. Exception {}".format(curr_sb_data.sandbox_id,
-                                                                             str(e))
-            logger.error(exc_msg)
-            sleep(5)
-            try:
-                sb_rest.stop_sandbox(curr_sb_data.sandbox_id)
-            except Exception as e:
-                exc_msg = "Can't end sandbox '{}'. Raising Exception {}".format(curr_sb_data.sandbox_id,
-                                                                                str(e))
-                logger.exception(exc_msg)
-                raise Exception(exc_msg)
-        sleep(1)
-
-    # LET TEARDOWN RUN A BIT
-    logger.info("Waiting {} minutes before polling teardown...".format(run_config.estimated_teardown_minutes))
-    sleep(run_config.estimated_teardown_minutes * 60)
+    # consumed below - each stop is journaled as soon as it is acknowledged
+    stop_times = map_api_calls(lambda sb_data: _stop_sandbox(sb_rest, sb_data.sandbox_id, logger),
+                               stopped_sandboxes, executor, stop_spacing)
+
+    # SCHEDULE FIRST POLL PER SANDBOX
+    # timed from each sandbox's own stop request, using teardown durations seen in earlier runs when there are any
+    duration_history = DurationHistory(run_config.blueprint_id)
+    scheduler = PollingScheduler(run_config.min_polling_seconds, run_config.polling_frequency_seconds,
+                                 duration_history.get_expected_durations(TEARDOWN_PHASE))
+    first_poll_delay = scheduler.get_first_poll_delay(run_config.estimated_teardown_minutes)
+    logger.info("Polling teardown of each sandbox {} seconds after stop...".format(int(first_poll_delay)))
+    for sb_data, (requested_at, acknowledged_at) in zip(stopped_sandboxes, stop_times):
+        sb_data.mark_time(latency.STOP_REQUESTED, requested_at)
+        sb_data.mark_time(latency.STOP_ACKNOWLEDGED, acknowledged_at)
+        journal.record(sb_data)
+        metrics.run_metrics.record_event(metrics.STOP_REQUESTED)
+        metrics.run_metrics.record_state(sb_data.sandbox_id, my_globals.SANDBOX_TEARDOWN_STATE)
+        scheduler.add(sb_data.sandbox_id, requested_at, first_poll_delay)
+    stopped_ids = set(sb_data.sandbox_id for sb_data in stopped_sandboxes)
+    for sb_data in polled_sandboxes:
+        if sb_data.sandbox_id not in stopped_ids:
+            scheduler.add(sb_data.sandbox_id, sb_data.timings.get(latency.STOP_REQUESTED, time()), first_poll_delay)
 
     # POLL TEARDOWN
-    finished_teardowns = []
-    failed_teardowns = []
+    # statuses are fetched in workers, SandboxErrorData is only updated here on the calling thread
     total_polling_minutes = run_config.teardown_polling_timeout
-    t_end = time() + (60 * total_polling_minutes)
+    t_end = time() + first_poll_delay + (60 * total_polling_minutes)
+    coalesce_seconds = run_config.min_polling_seconds if run_config.bulk_polling else 0
+    tailer = ActivityTailer(sb_rest, logger, run_config.console_tail_lines) if run_config.live_tail else None
     logger.info("Beginning polling for max of {} minutes".format(total_polling_minutes))
-    while time() < t_end:
-        for curr_sb_id in list(sb_map.keys()):
-            sb_data = sb_map[curr_sb_id]
-            try:
-                sb_details = sb_rest.get_sandbox_data(curr_sb_id)
-            except Exception as e:
-                if "rate quota" in str(e):
-                    logger.error("api rate quota exceeded. Waiting and re-polling...")
-                    sleep(10)
-                    sb_details = sb_rest.get_sandbox_data(curr_sb_id)
-                else:
-                    exc_msg = "Issue during polling: {}".format(str(e))
-                    logger.exception(exc_msg)
-                    raise (exc_msg)
-
-            state = sb_details["state"]
-            if state == my_globals.SANDBOX_ENDED_STATE:
-                setup_errors = sb_data.setup_errors
-                if setup_errors:
-                    sleep(3)
-
-                    # can search activity feed either by latest event id or "since" current timestamp
-                    sorted_errors = sorted(setup_errors, key=lambda x: x["id"])
-                    last_setup_error_id = sorted_errors.pop()["id"]
-                    # curr_ts = get_utc_iso_8601_timestamp()
-                    activity_feed_errors = sb_rest.get_sandbox_activity(sandbox_id=curr_sb_id,
-                                                                        error_only=True,
-                                                                        from_event_id=last_setup_error_id + 1)
-                else:
-                    sleep(3)
-                    activity_feed_errors = sb_rest.get_sandbox_activity(sandbox_id=curr_sb_id,
-                                                                        error_only=True)
+    while sb_map:
+        polled_sandboxes = [sb_map[sb_id] for sb_id in scheduler.wait_for_due(t_end, coalesce_seconds)]
+        if not polled_sandboxes:
+            # POLLING TIMEOUT
+            exc_msg = "Teardown Polling not completed within {} minutes".format(total_polling_minutes)
+            logger.error(exc_msg)
+            raise Exception(exc_msg)
+
+        listed_sandboxes = get_sandboxes_by_id(sb_rest, logger) if run_config.bulk_polling else {}
+        statuses = map_api_calls(lambda sb_data: _get_teardown_status(sb_rest, sb_data, logger,
+                                                                      listed_sandboxes.get(sb_data.sandbox_id),
+                                                                      tailer),
+                                 polled_sandboxes, executor, poll_spacing)
+        for sb_data, (sb_details, activity_feed_errors, polled_at) in zip(polled_sandboxes, statuses):
+            curr_sb_id = sb_data.sandbox_id
+            metrics.run_metrics.record_state(curr_sb_id, sb_details["state"])
+            if sb_details["state"] == my_globals.SANDBOX_ENDED_STATE:
+                sb_data.mark_time(latency.ENDED, polled_at)
+                metrics.run_metrics.record_event(metrics.ENDED)
                 if activity_feed_errors:
                     failed_teardowns.append(curr_sb_id)
-                    sb_data.teardown_errors = activity_feed_errors
+                    metrics.run_metrics.record_event(metrics.TEARDOWN_FAILED)
+                    journal.record_errors(sb_data, error_signatures.TEARDOWN_PHASE, activity_feed_errors)
                     logger.error("Failed teardown: {}".format(curr_sb_id))
                 else:
                     logger.info("Completed Teardown: {}".format(curr_sb_id))
+                journal.record(sb_data, sb_details["state"])
                 finished_teardowns.append(sb_data)
                 del sb_map[curr_sb_id]
-            sleep(2)  # add some buffer to the api requests
-        if not sb_map:
-            break
+                duration_history.record(TEARDOWN_PHASE, scheduler.get_duration_estimate(curr_sb_id))
+                scheduler.remove(curr_sb_id)
+                continue
+            journal.record_poll(sb_data, sb_details["state"])
+            scheduler.reschedule(curr_sb_id)
 
-        # POLLING DELAY
-        sleep(run_config.polling_frequency_seconds)
-    else:
-        # POLLING TIMEOUT
-        exc_msg = "Teardown Polling not completed within {} minutes".format(total_polling_minutes)
-        logger.error(exc_msg)
-        raise Exception(exc_msg)
+    duration_history.save()
 
-    elapsed = int(default_timer() - start)
-    elapsed = int(elapsed / 60)
+    elapsed = round((default_timer() - start) / 60, 1)
     logger.info("Sandboxes Done Tearing Down. Elapsed: '{}' minutes".format(elapsed))
-
-    with open(json_file_path, 'w') as f:
-        sb_data_json = get_json_from_nested_obj(finished_teardowns)
-        f.write(sb_data_json)
-
-    logger.info("JSON data file written: '{}'".format(json_file_path))
-
-    # VALIDATE RESULTS
-    if failed_teardowns:
-        failed_count = len(failed_teardowns)
-        err_msg = "=== {} failed teardowns ===\n{}".format(failed_count, json.dumps(failed_teardowns, indent=4))
-        logger.error(err_msg)
-        raise Exception("{} Failed Teardowns!".format(failed_count))
-
-    logger.info("Teardown flow done with no errors.")
+    logger.info("Connection pool stats: {}".format(sb_rest.get_connection_stats()))
+    logger.info("Sandbox state in memory: {} bytes per sandbox".format(
+        get_state_bytes(finished_teardowns) // max(len(finished_teardowns), 1)))
+    return finished_teardowns, failed_teardowns
 
 
 if __name__ == "__main__":
     """
     When Triggering stop independently, latest timestamp is used, unless you provide override
     """
+    parser = argparse.ArgumentParser(description="Stop sandboxes from latest json results and poll teardown")
+    parser.add_argument("--workers", type=int, default=0, help="thread pool size for api calls. 0 runs serially")
+    parser.add_argument("--resume", action="store_true", help="carry on an interrupted teardown from the journal")
+    args = parser.parse_args()
+
     try:
         api_config, run_config = get_config_data()
     except Exception as e:
         exc_msg = "Make sure config.json file is present. See ReadME for sample. Exception: {}".format(str(e))
         raise Exception(exc_msg)
 
-    latest_json_time_stamp = _get_latest_json_log_timestamp(run_config.blueprint_id)
+    latest_json_time_stamp = get_latest_json_log_timestamp(run_config.blueprint_id)
     log_path = build_log_path(latest_json_time_stamp, run_config.blueprint_id)
     logger = get_logger(log_path)
     try:
-        sb_rest = SandboxRest(username=api_config.user,
-                              password=api_config.password,
-                              server=api_config.host,
-                              port=api_config.port,
-                              domain=api_config.domain,
-                              logger=logger)
+        sb_rest = get_sandbox_rest(api_config, logger, args.workers)
     except Exception as e:
         exc_msg = "Could not get sandbox rest session: {}".format(str(e))
         logger.exception(exc_msg)
         raise Exception(exc_msg)
 
-    stop_sandboxes(sb_rest, run_config, latest_json_time_stamp, logger)
+    stop_sandboxes(sb_rest, run_config, latest_json_time_stamp, logger, args.workers, args.resume)
@@ -0,0 +1,308 @@
+"""
+asyncio sibling of SandboxRest - same endpoints, awaitable methods, one pooled aiohttp session
+Sandbox API can be explored further at <sandbox_api_server>:82/api/v2/explore
+"""
+
+import aiohttp  # pip install aiohttp
+import asyncio
+import json
+from sb_rest.sandbox_rest_api import DEFAULT_POOL_MAXSIZE
+from sb_rest.rate_limiter import TokenBucket, RateQuotaException, is_rate_quota_response, parse_retry_after, \
+    get_backoff_seconds, DEFAULT_MAX_RETRIES
+from sb_rest.auth import Credential, TokenCache, AsyncAccountSession, AccountPool, get_auth_headers, \
+    DEFAULT_TOKEN_TTL_SECONDS, UNAUTHORIZED_STATUS_CODE
+
+
+class AsyncSandboxRest(object):
+    def __init__(self, server, username, password, domain="Global", port="82", api_version="v2", logger=None,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, keep_alive=True, requests_per_second=0, rate_burst=1,
+                 max_requests_per_second=0, max_retries=DEFAULT_MAX_RETRIES, credentials=None, token_cache_path="",
+                 token_ttl_seconds=DEFAULT_TOKEN_TTL_SECONDS):
+        """
+        session is not opened until login() is awaited - use "async with AsyncSandboxRest(...) as sb_rest:"
+        :param str server:
+        :param str username:
+        :param str password:
+        :param str domain:
+        :param str port: api and login port
+        :param str api_version:
+        :param logging.Logger logger:
+        :param int pool_maxsize: max connections kept open per host
+        :param bool keep_alive: set False to close connection after each request
+        :param float requests_per_second: rate budget per account for all tasks using this instance, 0 for unlimited
+        :param int rate_burst:
+        :param float max_requests_per_second: ceiling the rate budget may grow to while the server is not throttling
+        :param int max_retries: retries of a rate quota response before RateQuotaException is raised
+        :param list credentials: more Credential accounts - requests go round robin over all accounts
+        :param str token_cache_path: json file to reuse tokens across processes, empty logs in once per process
+        :param float token_ttl_seconds: how long a cached token is trusted
+        """
+        self._login_url = "http://{server}:{port}/api/login".format(server=server, port=port)
+        self._base_url = "http://{server}:{port}/api/{api_version}".format(server=server,
+                                                                           port=port,
+                                                                           api_version=api_version)
+        self._logger = logger
+        self._pool_maxsize = pool_maxsize
+        self._keep_alive = keep_alive
+        self._session = None
+        self._max_retries = max_retries
+
+        # ACCOUNTS - each with its own token and rate budget, so per-user quotas add up
+        token_cache = TokenCache(token_cache_path, token_ttl_seconds) if token_cache_path else None
+        accounts = []
+        for credential in [Credential(username, password, domain)] + list(credentials or []):
+            rate_limiter = None
+            if requests_per_second:
+                rate_limiter = TokenBucket(requests_per_second, rate_burst, max_requests_per_second)
+            accounts.append(AsyncAccountSession(credential, self._login, self._login_url, token_cache,
+                                                rate_limiter=rate_limiter))
+        self._accounts = AccountPool(accounts)
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def login(self):
+        """
+        open the pooled session, log every account in (or take its token from the token cache)
+        """
+        connector = aiohttp.TCPConnector(limit=self._pool_maxsize,
+                                         limit_per_host=self._pool_maxsize,
+                                         force_close=not self._keep_alive)
+        self._session = aiohttp.ClientSession(connector=connector)
+        try:
+            for account in self._accounts.accounts:
+                await account.get_token()
+        except Exception:
+            await self.close()
+            raise
+
+    async def _login(self, credential):
+        """
+        login request of one account
+        :param Credential credential:
+        :return: token
+        """
+        login_data = {
+            "username": credential.username,
+            "password": credential.password,
+            "domain": credential.domain
+        }
+        login_headers = {"Content-Type": "application/json"}
+        async with self._session.put(url=self._login_url, data=json.dumps(login_data),
+                                     headers=login_headers) as login_res:
+            login_text = await login_res.text()
+            if login_res.status in [200, 202]:
+                return login_text[1:-1]
+            raise Exception("Sandbox API authentication Failed for user '{}'. code '{}', {}".format(
+                credential.username, login_res.status, login_text))
+
+    def get_login_count(self):
+        """
+        logins sent by this instance - tokens taken from the token cache don't count
+        :return:
+        """
+        return self._accounts.get_login_count()
+
+    async def close(self):
+        """ release pooled connections """
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _request_json(self, method, url, body=None):
+        """
+        send request as the next account of the pool - a 401 logs that account in again once and resends
+        if passed returns json, else raises Exception
+        :param str method:
+        :param str url:
+        :param dict body:
+        :return:
+        """
+        account = self._accounts.next()
+        token = await account.get_token()
+        status, text = await self._request_as(account, token, method, url, body)
+        if status == UNAUTHORIZED_STATUS_CODE:
+            if self._logger:
+                self._logger.info("api token of '{}' rejected on {} {}, logging in again".format(
+                    account.credential.username, method, url))
+            status, text = await self._request_as(account, await account.refresh(token), method, url, body)
+        if 200 <= status < 300:
+            return json.loads(text)
+        raise Exception("Failed Sandbox API request: code '{}', {}".format(str(status), text))
+
+    async def _request_as(self, account, token, method, url, body=None):
+        """
+        send request on the account's rate budget, retry rate quota responses with jittered exponential backoff
+        :param AsyncAccountSession account:
+        :param str token:
+        :param str method:
+        :param str url:
+        :param dict body:
+        :return: tuple of status code, response text
+        """
+        rate_limiter = account.rate_limiter
+        headers = get_auth_headers(token)
+        data = json.dumps(body) if body is not None else None
+        for attempt in range(self._max_retries + 1):
+            if rate_limiter:
+                await asyncio.sleep(rate_limiter.reserve())
+            async with self._session.request(method, url, data=data, headers=headers) as response:
+                text = await response.text()
+                status = response.status
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            if not is_rate_quota_response(status, lambda: text):
+                if rate_limiter:
+                    rate_limiter.on_success()
+                return status, text
+
+            if rate_limiter:
+                rate_limiter.on_throttle(retry_after)
+            if attempt == self._max_retries:
+                break
+            backoff = get_backoff_seconds(attempt, retry_after)
+            if self._logger:
+                self._logger.warning("api rate quota exceeded on {} {}. Retry {} in {:.1f} seconds".format(
+                    method, url, attempt + 1, backoff))
+            await asyncio.sleep(backoff)
+        raise RateQuotaException("Sandbox API rate quota still exceeded after {} retries: code '{}', {}".format(
+            self._max_retries, status, text))
+
+    async def start_blueprint(self, blueprint_id, sandbox_name="Rest Api Sandbox", duration="PT0H20M", params=None):
+        """
+        start sandbox from blueprint, will return sandbox info with "id", "blueprint_id", sandbox components list etc.
+        :param str blueprint_id:
+        :param str sandbox_name:
+        :param str duration: Duration format must be a valid 'ISO 8601'. (e.g 'PT23H' or 'PT4H2M')
+        :param list params: should be list of [{"name": "value"}] dicts
+        :return:
+        """
+        request_url = self._base_url + "/blueprints/{blueprint_id}/start".format(blueprint_id=blueprint_id)
+        body = {
+            "name": sandbox_name,
+            "duration": duration,
+            "params": params if params else []
+        }
+        return await self._request_json("POST", request_url, body)
+
+    async def stop_sandbox(self, sandbox_id):
+        """
+        stop current sandbox
+        :param str sandbox_id:
+        :return:
+        """
+        request_url = self._base_url + "/sandboxes/{sandbox_id}/stop".format(sandbox_id=sandbox_id)
+        return await self._request_json("POST", request_url)
+
+    async def get_sandbox_data(self, sandbox_id):
+        """
+        get sandbox info. "id", "blueprint_id", "state", "setup_stage" etc.
+        :param str sandbox_id:
+        :return:
+        """
+        request_url = self._base_url + "/sandboxes/{sandbox_id}".format(sandbox_id=sandbox_id)
+        return await self._request_json("GET", request_url)
+
+    async def get_sandbox_components(self, sandbox_id):
+        """
+        :param str sandbox_id:
+        :return:
+        """
+        request_url = self._base_url + "/sandboxes/{sandbox_id}/components".format(sandbox_id=sandbox_id)
+        return await self._request_json("GET", request_url)
+
+    async def start_component_command(self, sandbox_id, component_id, command_name, params=None, print_output=False):
+        """
+        start command of component in sandbox. returns json with "executionId", "supports_cancellation" keys
+        :param str sandbox_id:
+        :param str component_id:
+        :param str command_name:
+        :param [] params: a list of command arguments in the form [{"name":"string", "value":"string"}, {...}]
+        :param bool print_output:
+        :return:
+        """
+        body = {
+            "params": params if params else [],
+            "printOutput": print_output
+        }
+        start_url = self._base_url + '/sandboxes/{}/components/{}/commands/{}/start'.format(sandbox_id,
+                                                                                           component_id,
+                                                                                           command_name)
+        return await self._request_json("POST", start_url, body)
+
+    async def get_execution_data(self, execution_id):
+        """
+        returns json with keys "id", "status", "supports_cancellation", "started", "ended", "output"
+        :param str execution_id:
+        :return:
+        """
+        execution_url = self._base_url + '/executions/{execution_id}'.format(execution_id=execution_id)
+        return await self._request_json("GET", execution_url)
+
+    async def iter_sandbox_activity(self, sandbox_id, error_only=False, since="", from_event_id=""):
+        """
+        lazily yield activity feed events across all pages, following "next_event_id"
+        see SandboxRest.get_sandbox_activity_page for response structure
+        :param sandbox_id:
+        :param bool error_only:
+        :param str since: Events starting time in "ISO 8601" Standard. (e.g '2000-12-31T23:59:60Z')
+        :param str from_event_id: Entry id of first output entry to return
+        :return:
+        """
+        while True:
+            data = await self._get_activity_page(sandbox_id, error_only, since, from_event_id)
+            for event in data["events"]:
+                yield event
+            next_event_id = data.get("next_event_id")
+            if str(data.get("more_pages")).lower() != "true" or not next_event_id or next_event_id == from_event_id:
+                return
+            from_event_id = next_event_id
+
+    async def _get_activity_page(self, sandbox_id, error_only=False, since="", from_event_id="", tail=""):
+        activity_url = self._base_url + '/sandboxes/{}/activity'.format(sandbox_id)
+        activity_url += "?error_only={}".format("true" if error_only else "false")
+        if since:
+            activity_url += "&since={}".format(since)
+        if from_event_id:
+            activity_url += "&from_event_id={}".format(from_event_id)
+        if tail:
+            activity_url += "&tail={}".format(tail)
+        return await self._request_json("GET", activity_url)
+
+    async def get_sandbox_activity(self, sandbox_id, error_only=False, since="", from_event_id="", tail=""):
+        """
+        get activity feed events as a list - all pages, or the last "tail" events
+        :param sandbox_id:
+        :param bool error_only:
+        :param str since: Events starting time in "ISO 8601" Standard. (e.g '2000-12-31T23:59:60Z')
+        :param str from_event_id: Entry id of first output entry to return
+        :param str tail: Get last X events
+        :return:
+        """
+        if tail:
+            data = await self._get_activity_page(sandbox_id, error_only, since, from_event_id, tail)
+            return data["events"]
+        return [event async for event in self.iter_sandbox_activity(sandbox_id, error_only, since, from_event_id)]
+
+    async def get_sandboxes(self, show_historic=False):
+        # historic sandboxes are completed sandboxes
+        url = self._base_url + "/sandboxes" + "?show_historic={}".format("true" if show_historic else "false")
+        return await self._request_json("GET", url)
+
+    async def get_console_output(self, sandbox_id: str, tail=0):
+        """
+        get console entries from sandbox. list of dicts
+        [{"id":"asdf", "time": "12:00", "text": "bla, bla, bla"}, ...]
+        """
+        url = f"{self._base_url}/sandboxes/{sandbox_id}/output"
+        if tail:
+            url += f"?tail={tail}"
+        data = await self._request_json("GET", url)
+        entries = data.get("entries")
+        if entries is None:
+            raise Exception("API Response has no 'entries'. Response: {}".format(data))
+        return entries
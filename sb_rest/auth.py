@@ -0,0 +1,208 @@
+"""
+Login tokens for SandboxRest / AsyncSandboxRest
+- tokens are cached in a local json file with an expiry, so a new process reuses the last login instead of a new one
+- a 401 triggers one re-login per account however many callers saw it (single-flight), then the callers retry
+- several accounts can be pooled - requests go round robin so per-user api quotas add up
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+import typing
+from time import time
+
+DEFAULT_TOKEN_TTL_SECONDS = 3600
+UNAUTHORIZED_STATUS_CODE = 401
+
+
+class Credential(typing.NamedTuple):
+    """ one api account """
+    username: str
+    password: str
+    domain: str = "Global"
+
+
+class TokenCache(object):
+    def __init__(self, path, ttl_seconds=DEFAULT_TOKEN_TTL_SECONDS):
+        """
+        tokens by server and account, the file is only readable by its owner - tokens are credentials
+        the server does not say when a token expires, ttl_seconds is an estimate - a 401 before then still re-logs in
+        :param str path: json file, shared by every process of the harness on this machine
+        :param float ttl_seconds:
+        """
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(login_url, credential):
+        return "{} {}/{}".format(login_url, credential.domain, credential.username)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            # torn by a crash mid-write of an older version, a login rebuilds it
+            return {}
+
+    def get(self, key):
+        """
+        :param str key: get_key output
+        :return: token, None when missing or expired
+        """
+        with self._lock:
+            entry = self._read().get(key)
+        if not entry or entry["expires_at"] <= time():
+            return None
+        return entry["token"]
+
+    def put(self, key, token):
+        """
+        other processes may write the file too - expired entries are dropped, the rest is kept
+        written to a temp file and renamed, so readers never see half a file
+        """
+        with self._lock:
+            now = time()
+            entries = {k: v for k, v in self._read().items() if v["expires_at"] > now}
+            entries[key] = {"token": token, "expires_at": now + self.ttl_seconds}
+            self._write(entries)
+
+    def discard(self, key, token):
+        """ drop a token the server rejected, unless another process already replaced it """
+        with self._lock:
+            entries = self._read()
+            if entries.get(key, {}).get("token") != token:
+                return
+            del entries[key]
+            self._write(entries)
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+
+def get_auth_headers(token):
+    return {
+        'Authorization': 'Basic {0}'.format(token),
+        'Content-Type': 'application/json'
+    }
+
+
+class AccountSession(object):
+    def __init__(self, credential, login_func, login_url, token_cache=None, token="", rate_limiter=None):
+        """
+        auth headers of one account, logged in lazily
+        :param Credential credential:
+        :param login_func: callable taking a Credential, returns a new token - the api login request
+        :param str login_url: cache key part, tokens of one server are not sent to another
+        :param TokenCache token_cache: None to log in once per process
+        :param str token: known good token to start with, skips the first login
+        :param rate_limiter: this account's TokenBucket, None when unlimited
+        """
+        self.credential = credential
+        self.rate_limiter = rate_limiter
+        self.login_count = 0
+        self._login_func = login_func
+        self._token_cache = token_cache
+        self._cache_key = TokenCache.get_key(login_url, credential)
+        self._token = token or None
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        """ current token - reads the token cache or logs in on first use """
+        if self._token:
+            return self._token
+        with self._lock:
+            if not self._load_cached():
+                self._store(self._login_func(self.credential))
+            return self._token
+
+    def refresh(self, rejected_token):
+        """
+        single-flight re-login - callers that saw a 401 with the same token wait for one login and share it
+        :param str rejected_token: token the 401 came back for
+        :return: the token to retry with
+        """
+        with self._lock:
+            if not self._load_newer(rejected_token):
+                self._store(self._login_func(self.credential))
+            return self._token
+
+    def _load_cached(self):
+        """ caller holds the lock. True when a token is at hand without logging in """
+        if not self._token and self._token_cache:
+            self._token = self._token_cache.get(self._cache_key)
+        return bool(self._token)
+
+    def _load_newer(self, rejected_token):
+        """ caller holds the lock. True when another caller or process already logged in again """
+        if self._token and self._token != rejected_token:
+            return True
+        self._token = None
+        if self._token_cache:
+            self._token_cache.discard(self._cache_key, rejected_token)
+        return self._load_cached()
+
+    def _store(self, token):
+        self._token = token
+        self.login_count += 1
+        if self._token_cache:
+            self._token_cache.put(self._cache_key, token)
+
+
+class AsyncAccountSession(AccountSession):
+    """ asyncio flavour - login_func is a coroutine function, waiting callers yield to the event loop """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_lock = asyncio.Lock()
+
+    async def get_token(self):
+        if self._token:
+            return self._token
+        async with self._async_lock:
+            if not self._load_cached():
+                self._store(await self._login_func(self.credential))
+            return self._token
+
+    async def refresh(self, rejected_token):
+        async with self._async_lock:
+            if not self._load_newer(rejected_token):
+                self._store(await self._login_func(self.credential))
+            return self._token
+
+
+class AccountPool(object):
+    def __init__(self, accounts):
+        """
+        requests are dealt out to accounts round robin
+        :param list accounts: AccountSession / AsyncAccountSession, at least one
+        """
+        if not accounts:
+            raise Exception("At least one api account is needed")
+        self.accounts = accounts
+        self._cycle = itertools.cycle(accounts)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def next(self):
+        """
+        :return: AccountSession / AsyncAccountSession for the next request
+        """
+        if len(self.accounts) == 1:
+            return self.accounts[0]
+        with self._lock:
+            return next(self._cycle)
+
+    def get_login_count(self):
+        return sum(account.login_count for account in self.accounts)
@@ -0,0 +1,131 @@
+"""
+Client side instrumentation hook for SandboxRest
+every request is reported to the hook as an ApiCallRecord - the hook decides what to aggregate
+
+hook contract, any object with:
+    record(call) - called once per api call from the calling thread, must be cheap and thread safe
+    get_summary(reset=False) - json ready dict of what was aggregated, written into the json results report
+"""
+import socket
+import threading
+import typing
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# PATH SEGMENT AFTER THESE COLLECTIONS IS AN ID - replaced by a placeholder in the endpoint template
+ID_SEGMENT_PLACEHOLDERS = {
+    "sandboxes": "{id}",
+    "blueprints": "{id}",
+    "executions": "{id}",
+    "components": "{component_id}",
+    "commands": "{command}"
+}
+
+
+class ApiCallRecord(typing.NamedTuple):
+    """ latencies are seconds. dns / connect are None when a pooled connection was reused """
+    method: str
+    endpoint: str
+    status: int
+    bytes_sent: int
+    bytes_received: int
+    dns: typing.Optional[float]
+    connect: typing.Optional[float]
+    ttfb: float
+    total: float
+    wait: float
+    retries: int
+    throttled: bool = False
+
+
+def get_endpoint_template(url):
+    """
+    "http://host:82/api/v2/sandboxes/<uuid>/activity?error_only=true" -> "/sandboxes/{id}/activity"
+    :param str url:
+    :return:
+    """
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    if segments and segments[0] == "api":
+        segments = segments[1:]
+    if segments and segments[0].startswith("v") and segments[0][1:].isdigit():
+        segments = segments[1:]
+
+    template = []
+    for i, segment in enumerate(segments):
+        if i and segments[i - 1] in ID_SEGMENT_PLACEHOLDERS:
+            template.append(ID_SEGMENT_PLACEHOLDERS[segments[i - 1]])
+        else:
+            template.append(segment)
+    return "/" + "/".join(template)
+
+
+# DNS / CONNECT TIMINGS OF THE LAST CONNECTION OPENED ON THIS THREAD
+# connections are opened by the thread sending the request, so _send can pick them up after the call
+_connection_timings = threading.local()
+
+
+def reset_connection_timings():
+    _connection_timings.dns = None
+    _connection_timings.connect = None
+
+
+def get_connection_timings():
+    """
+    :return: (dns, connect) seconds of a connection opened since last reset, (None, None) if the pool reused one
+    """
+    return getattr(_connection_timings, "dns", None), getattr(_connection_timings, "connect", None)
+
+
+class _TimedConnectionMixin(object):
+    def _new_conn(self):
+        """
+        resolve the host ourselves so name lookup and tcp connect are timed separately
+        urllib3 then connects to the resolved address - hostname stays as-is for Host header / TLS
+        """
+        dns_host = self._dns_host
+        started = perf_counter()
+        try:
+            address = socket.getaddrinfo(dns_host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            # let urllib3 raise its usual name resolution error
+            address = dns_host
+        resolved = perf_counter()
+
+        self._dns_host = address
+        try:
+            sock = super(_TimedConnectionMixin, self)._new_conn()
+        finally:
+            self._dns_host = dns_host
+        _connection_timings.dns = resolved - started
+        _connection_timings.connect = perf_counter() - resolved
+        return sock
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+def install_timed_connections(adapter):
+    """
+    make a requests HTTPAdapter open connections that report dns / connect timings
+    :param requests.adapters.HTTPAdapter adapter:
+    """
+    adapter.poolmanager.pool_classes_by_scheme = {
+        "http": TimedHTTPConnectionPool,
+        "https": TimedHTTPSConnectionPool
+    }
@@ -0,0 +1,143 @@
+"""
+Request rate budget shared by every caller of a SandboxRest / AsyncSandboxRest instance
+- token bucket sets the pace
+- AIMD adapts the pace to the server quota (additive increase on success, multiplicative decrease on throttle)
+- throttled requests are retried with jittered exponential backoff, honoring Retry-After
+"""
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep
+
+RATE_QUOTA_STATUS_CODES = (429, 503)
+RATE_QUOTA_TEXT = "rate quota"
+# the quota text is only looked for in error responses - successful bodies (activity feed, console) may quote it
+MIN_ERROR_STATUS_CODE = 400
+
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+
+
+class RateQuotaException(Exception):
+    """ Sandbox API still throttling after all retries """
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, requests_per_second, burst=1, max_requests_per_second=0, min_requests_per_second=0.1,
+                 additive_increase=0.5, decrease_factor=0.5):
+        """
+        token bucket that refills at "rate", holds at most "burst" tokens
+        callers reserve a token and are told how long to wait for it, so the same bucket serves threads and asyncio
+        :param float requests_per_second: starting rate
+        :param int burst:
+        :param float max_requests_per_second: ceiling for additive increase. 0 caps at the starting rate
+        :param float min_requests_per_second: floor for multiplicative decrease
+        :param float additive_increase: rate grows by about this many req/s for every second of un-throttled traffic
+        :param float decrease_factor: rate is multiplied by this on a throttle
+        """
+        self.rate = float(requests_per_second)
+        self.max_rate = float(max_requests_per_second) if max_requests_per_second else self.rate
+        self.min_rate = min(float(min_requests_per_second), self.rate)
+        self.capacity = max(float(burst), 1.0)
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.throttle_count = 0
+        self._tokens = self.capacity
+        self._last_refill = monotonic()
+        self._last_decrease = 0.0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def reserve(self):
+        """
+        take a token, possibly on credit
+        :return: seconds the caller must wait before sending
+        """
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait_seconds = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait_seconds, self._blocked_until - now)
+
+    def acquire(self):
+        """
+        blocking wait for a token - for sync callers
+        :return: seconds spent waiting
+        """
+        wait_seconds = self.reserve()
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+        return wait_seconds
+
+    def on_success(self):
+        """ additive increase - roughly +additive_increase req/s per second of traffic at current rate """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        """
+        multiplicative decrease, at most once per current request interval so a burst of
+        concurrent throttles counts as one congestion signal
+        :param float retry_after: seconds from Retry-After header - nobody sends until it passes
+        """
+        with self._lock:
+            now = monotonic()
+            self.throttle_count += 1
+            if now - self._last_decrease >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._last_decrease = now
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+
+def is_rate_quota_response(status_code, get_text):
+    """
+    :param int status_code:
+    :param get_text: callable returning the response body, only called for error responses
+    :return:
+    """
+    if status_code in RATE_QUOTA_STATUS_CODES:
+        return True
+    return status_code >= MIN_ERROR_STATUS_CODE and RATE_QUOTA_TEXT in (get_text() or "").lower()
+
+
+def parse_retry_after(header_value):
+    """
+    Retry-After is either delay seconds or an HTTP date
+    :param str header_value:
+    :return: seconds to wait or None
+    """
+    if not header_value:
+        return None
+    try:
+        return max(float(header_value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def get_backoff_seconds(attempt, retry_after=None):
+    """
+    full-jitter exponential backoff, never shorter than Retry-After
+    :param int attempt: 0 based retry attempt
+    :param float retry_after:
+    :return:
+    """
+    backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after:
+        return retry_after + backoff * 0.1
+    return backoff
@@ -3,53 +3,277 @@ Sandbox API can be explored further at <sandbox_api_server>:82/api/v2/explore
 """
 
 import requests  # pip install requests
+from requests.adapters import HTTPAdapter
 import json
+import threading
+from time import sleep, perf_counter
+from sb_rest.rate_limiter import TokenBucket, RateQuotaException, is_rate_quota_response, parse_retry_after, \
+    get_backoff_seconds, DEFAULT_MAX_RETRIES
+from sb_rest.instrumentation import ApiCallRecord, get_endpoint_template, install_timed_connections, \
+    reset_connection_timings, get_connection_timings
+from sb_rest.auth import Credential, TokenCache, AccountSession, AccountPool, get_auth_headers, \
+    DEFAULT_TOKEN_TTL_SECONDS, UNAUTHORIZED_STATUS_CODE
+
+# CONNECTION POOL DEFAULTS - pool_maxsize is the connection limit per host
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
 
 
 class SandboxRest(object):
-    def __init__(self, server, username, password, domain="Global", token="", port="82", api_version="v2", logger=None):
+    def __init__(self, server, username, password, domain="Global", token="", port="82", api_version="v2", logger=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False,
+                 keep_alive=True, requests_per_second=0, rate_burst=1, max_requests_per_second=0,
+                 max_retries=DEFAULT_MAX_RETRIES, instrumentation=None, credentials=None, token_cache_path="",
+                 token_ttl_seconds=DEFAULT_TOKEN_TTL_SECONDS):
         """
-        run login command on init, attach session token to headers for subsequent requests
+        log every account in on init (or take its token from the token cache), attach token to each request
+        all requests go through one pooled session so TCP connections are reused between calls
         :param str server:
         :param str username:
         :param str password:
         :param str domain:
+        :param str token: known good token of username, skips its login
+        :param str port: api and login port
         :param str api_version:
         :param logging.Logger logger:
+        :param int pool_connections: number of host pools to cache
+        :param int pool_maxsize: max connections kept open per host
+        :param bool pool_block: block when pool is exhausted instead of opening throwaway connections
+        :param bool keep_alive: set False to close connection after each request (for comparison runs)
+        :param float requests_per_second: rate budget per account for all callers of this instance, 0 for unlimited
+        :param int rate_burst: requests allowed back to back before the rate budget kicks in
+        :param float max_requests_per_second: ceiling the rate budget may grow to while the server is not throttling
+        :param int max_retries: retries of a rate quota response before RateQuotaException is raised
+        :param instrumentation: hook that gets an ApiCallRecord per request, see sb_rest.instrumentation
+        :param list credentials: more Credential accounts - requests go round robin over all accounts
+        :param str token_cache_path: json file to reuse tokens across processes, empty logs in once per process
+        :param float token_ttl_seconds: how long a cached token is trusted
         """
         self._base_url = "http://{server}:{port}/api/{api_version}".format(server=server,
                                                                            port=port,
                                                                            api_version=api_version)
-        self._auth_headers = self._get_auth_headers(server, username, password, domain)
+        self._login_url = "http://{server}:{port}/api/login".format(server=server, port=port)
         self._logger = logger
+        self._instrumentation = instrumentation
+        self._session = self._build_session(pool_connections, pool_maxsize, pool_block, keep_alive,
+                                            timed_connections=instrumentation is not None)
+        self._max_retries = max_retries
+        self._activity_cursors = {}
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+        # ACCOUNTS - each with its own token and rate budget, so per-user quotas add up
+        token_cache = TokenCache(token_cache_path, token_ttl_seconds) if token_cache_path else None
+        accounts = []
+        for index, credential in enumerate([Credential(username, password, domain)] + list(credentials or [])):
+            rate_limiter = None
+            if requests_per_second:
+                rate_limiter = TokenBucket(requests_per_second, rate_burst, max_requests_per_second)
+            accounts.append(AccountSession(credential, self._login, self._login_url, token_cache,
+                                           token if index == 0 else "", rate_limiter))
+        self._accounts = AccountPool(accounts)
+        for account in accounts:
+            account.get_token()
 
     @staticmethod
-    def _get_auth_headers(server, user_name, password, domain):
+    def _build_session(pool_connections, pool_maxsize, pool_block, keep_alive, timed_connections=False):
+        """
+        build a requests session with a sized connection pool mounted for http and https
+        :param bool timed_connections: new connections report dns / connect timings for instrumentation
+        :return:
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        if timed_connections:
+            install_timed_connections(adapter)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def get_connection_stats(self):
+        """
+        count connections opened vs. requests sent across the session pools
+        reused connections = requests sent - new connections
+        :return: dict with "requests", "new_connections", "reused_connections"
+        """
+        requests_sent = 0
+        new_connections = 0
+        adapters = {id(a): a for a in self._session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                new_connections += pool.num_connections
+        return {
+            "requests": requests_sent,
+            "new_connections": new_connections,
+            "reused_connections": max(requests_sent - new_connections, 0)
+        }
+
+    def get_instrumentation(self):
+        """
+        instrumentation hook passed on init, None when not instrumented
+        :return:
         """
-        Get token from login response, then place token into auth headers on class
+        return self._instrumentation
+
+    def close(self):
+        """ release pooled connections """
+        self._session.close()
+
+    def _login(self, credential):
+        """
+        login request of one account
+        :param Credential credential:
+        :return: token
         """
         login_data = {
-            "username": user_name,
-            "password": password,
-            "domain": domain
+            "username": credential.username,
+            "password": credential.password,
+            "domain": credential.domain
         }
-        login_url = "http://{server}:82/api/login".format(server=server)
         login_headers = {"Content-Type": "application/json"}
-        login_res = requests.put(url=login_url,
-                                 data=json.dumps(login_data),
-                                 headers=login_headers)
+        login_res = self._session.put(url=self._login_url,
+                                      data=json.dumps(login_data),
+                                      headers=login_headers)
         if login_res.status_code in [200, 202]:
-            login_token = login_res.text[1:-1]
-        else:
-            print("login response code: " + str(login_res.status_code))
-            print("login response" + login_res.text)
-            raise Exception("Sandbox API authentication Failed")
+            return login_res.text[1:-1]
+        print("login response code: " + str(login_res.status_code))
+        print("login response" + login_res.text)
+        raise Exception("Sandbox API authentication Failed for user '{}'".format(credential.username))
 
-        auth_headers = {
-            'Authorization': 'Basic {0}'.format(login_token),
-            'Content-Type': 'application/json'
-        }
-        return auth_headers
+    def _send(self, method, url, **kwargs):
+        """
+        every api request goes through here - the next account of the pool sends it
+        a 401 means the token expired or was revoked - the account logs in again once, whoever else saw the 401,
+        and the request is sent again
+        safe to call from multiple threads
+        :param str method:
+        :param str url:
+        :return:
+        """
+        account = self._accounts.next()
+        token = account.get_token()
+        response = self._send_as(account, token, method, url, **kwargs)
+        if response.status_code == UNAUTHORIZED_STATUS_CODE:
+            self._log("api token of '{}' rejected on {} {}, logging in again".format(account.credential.username,
+                                                                                    method, url))
+            response = self._send_as(account, account.refresh(token), method, url, **kwargs)
+        return response
+
+    def _send_as(self, account, token, method, url, **kwargs):
+        """
+        waits on the account's rate budget, then sends on the pooled session
+        rate quota responses feed back into the budget and are retried with jittered exponential backoff
+        :param AccountSession account:
+        :param str token:
+        :param str method:
+        :param str url:
+        :return:
+        """
+        rate_limiter = account.rate_limiter
+        headers = get_auth_headers(token)
+        wait = 0
+        for attempt in range(self._max_retries + 1):
+            if rate_limiter:
+                wait_started = perf_counter()
+                rate_limiter.acquire()
+                wait += perf_counter() - wait_started
+            if self._instrumentation:
+                reset_connection_timings()
+            sent_at = perf_counter()
+            with self._in_flight_lock:
+                self._in_flight += 1
+            try:
+                response = self._session.request(method, url, headers=headers, **kwargs)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+            is_throttled = is_rate_quota_response(response.status_code, lambda: response.text)
+            if self._instrumentation:
+                try:
+                    self._record_call(method, url, response, perf_counter() - sent_at, wait, attempt, is_throttled)
+                except Exception as e:
+                    # stats are best effort - the request itself went through
+                    if self._logger:
+                        self._logger.warning("api instrumentation failed on {} {}: {}".format(method, url, str(e)))
+            if not is_throttled:
+                if rate_limiter:
+                    rate_limiter.on_success()
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if rate_limiter:
+                rate_limiter.on_throttle(retry_after)
+            if attempt == self._max_retries:
+                break
+            backoff = get_backoff_seconds(attempt, retry_after)
+            if self._logger:
+                self._logger.warning("api rate quota exceeded on {} {}. Retry {} in {:.1f} seconds".format(
+                    method, url, attempt + 1, backoff))
+            sleep(backoff)
+            wait += backoff
+        raise RateQuotaException("Sandbox API rate quota still exceeded after {} retries: code '{}', {}".format(
+            self._max_retries, response.status_code, response.text))
+
+    def _record_call(self, method, url, response, total, wait, retries, throttled=False):
+        """
+        hand one request over to the instrumentation hook
+        ttfb is requests' send-to-headers time minus connection setup, total includes reading the body
+        :param str method:
+        :param str url:
+        :param requests.Response response:
+        :param float total: seconds of this attempt
+        :param float wait: seconds spent client side on rate budget and backoff so far - harness, not server
+        :param int retries: rate quota retries before this attempt
+        :param bool throttled: the server answered with a rate quota response
+        """
+        dns, connect = get_connection_timings()
+        ttfb = max(response.elapsed.total_seconds() - (dns or 0) - (connect or 0), 0)
+        body = response.request.body or b""
+        if isinstance(body, str):
+            body = body.encode()
+        self._instrumentation.record(ApiCallRecord(method=method,
+                                                   endpoint=get_endpoint_template(url),
+                                                   status=response.status_code,
+                                                   bytes_sent=len(body),
+                                                   bytes_received=len(response.content),
+                                                   dns=dns,
+                                                   connect=connect,
+                                                   ttfb=ttfb,
+                                                   total=total,
+                                                   wait=wait,
+                                                   retries=retries,
+                                                   throttled=throttled))
+
+    def get_current_rate(self):
+        """
+        current adaptive requests per second of all accounts together, None when no rate budget is set
+        :return:
+        """
+        rates = [account.rate_limiter.rate for account in self._accounts.accounts if account.rate_limiter]
+        return sum(rates) if rates else None
+
+    def get_in_flight_count(self):
+        """
+        requests sent and not answered yet, across all threads
+        :return:
+        """
+        return self._in_flight
+
+    def get_login_count(self):
+        """
+        logins sent by this instance - tokens taken from the token cache don't count
+        :return:
+        """
+        return self._accounts.get_login_count()
 
     @staticmethod
     def _handle_res_json(response):
@@ -90,7 +314,7 @@ class SandboxRest(object):
             "duration": duration,
             "params": params
         }
-        response = requests.post(url=request_url, data=json.dumps(body), headers=self._auth_headers)
+        response = self._send("POST", request_url, data=json.dumps(body))
         return self._handle_res_json(response)
 
     def stop_sandbox(self, sandbox_id):
@@ -100,7 +324,7 @@ class SandboxRest(object):
         :return:
         """
         request_url = self._base_url + "/sandboxes/{sandbox_id}/stop".format(sandbox_id=sandbox_id)
-        response = requests.post(url=request_url, headers=self._auth_headers)
+        response = self._send("POST", request_url)
         return self._handle_res_json(response)
 
     def get_sandbox_data(self, sandbox_id):
@@ -112,7 +336,7 @@ class SandboxRest(object):
         """
         request_url = self._base_url + "/sandboxes/{sandbox_id}".format(sandbox_id=sandbox_id)
 
-        response = requests.get(url=request_url, headers=self._auth_headers)
+        response = self._send("GET", request_url)
         return self._handle_res_json(response)
 
     def get_sandbox_components(self, sandbox_id):
@@ -123,7 +347,7 @@ class SandboxRest(object):
         :return:
         """
         request_url = self._base_url + "/sandboxes/{sandbox_id}/components".format(sandbox_id=sandbox_id)
-        response = requests.get(url=request_url, headers=self._auth_headers)
+        response = self._send("GET", request_url)
         return self._handle_res_json(response)
 
     def start_component_command(self, sandbox_id, component_id, command_name, params=[], print_output=False):
@@ -146,7 +370,7 @@ class SandboxRest(object):
             component_id=component_id,
             command_name=command_name)
 
-        response = requests.post(url=start_url, data=json.dumps(body), headers=self._auth_headers)
+        response = self._send("POST", start_url, data=json.dumps(body))
         return self._handle_res_json(response)
 
     def get_execution_data(self, execution_id):
@@ -157,12 +381,12 @@ class SandboxRest(object):
         """
         execution_url = self._base_url + '/executions/{execution_id}'.format(execution_id=execution_id)
 
-        response = requests.get(url=execution_url, headers=self._auth_headers)
+        response = self._send("GET", execution_url)
         return self._handle_res_json(response)
 
-    def get_sandbox_activity(self, sandbox_id, error_only=False, since="", from_event_id="", tail=""):
+    def get_sandbox_activity_page(self, sandbox_id, error_only=False, since="", from_event_id="", tail=""):
         """
-        get the activity feed data in json format. Example response:
+        get one page of the activity feed data in json format. Example response:
         {
           "num_returned_events": 500,
           "more_pages": "true",
@@ -202,17 +426,75 @@ class SandboxRest(object):
         if self._logger:
             self._logger.debug("sending url: {}".format(activity_url))
 
-        response = requests.get(url=activity_url, headers=self._auth_headers)
-        data = self._handle_res_json(response)
-        events = data["events"]
-        return events
+        response = self._send("GET", activity_url)
+        return self._handle_res_json(response)
+
+    def iter_sandbox_activity(self, sandbox_id, error_only=False, since="", from_event_id=""):
+        """
+        lazily yield activity feed events across all pages, following "next_event_id"
+        only one page is held in memory at a time
+        :param sandbox_id:
+        :param bool error_only:
+        :param str since: Events starting time in "ISO 8601" Standard. (e.g '2000-12-31T23:59:60Z')
+        :param str from_event_id: Entry id of first output entry to return
+        :return:
+        """
+        while True:
+            data = self.get_sandbox_activity_page(sandbox_id, error_only, since, from_event_id)
+            for event in data["events"]:
+                yield event
+            next_event_id = data.get("next_event_id")
+            if not _is_true(data.get("more_pages")) or not next_event_id or next_event_id == from_event_id:
+                return
+            from_event_id = next_event_id
+
+    def get_sandbox_activity(self, sandbox_id, error_only=False, since="", from_event_id="", tail=""):
+        """
+        get activity feed events as a list - all pages, or the last "tail" events
+        see get_sandbox_activity_page for event structure
+        :param sandbox_id:
+        :param bool error_only:
+        :param str since: Events starting time in "ISO 8601" Standard. (e.g '2000-12-31T23:59:60Z')
+        :param str from_event_id: Entry id of first output entry to return
+        :param str tail: Get last X events
+        :return:
+        """
+        if tail:
+            return self.get_sandbox_activity_page(sandbox_id, error_only, since, from_event_id, tail)["events"]
+        return list(self.iter_sandbox_activity(sandbox_id, error_only, since, from_event_id))
+
+    def read_new_activity(self, sandbox_id, error_only=False):
+        """
+        yield only events newer than the last call for this sandbox / feed
+        a high-water-mark cursor per sandbox is advanced as events are consumed
+        :param str sandbox_id:
+        :param bool error_only:
+        :return:
+        """
+        cursor_key = (sandbox_id, error_only)
+        for event in self.iter_sandbox_activity(sandbox_id, error_only,
+                                                from_event_id=self._activity_cursors.get(cursor_key, "")):
+            self._activity_cursors[cursor_key] = event["id"] + 1
+            yield event
+
+    def seed_activity_cursor(self, sandbox_id, from_event_id, error_only=False):
+        """
+        read a sandbox feed from "from_event_id" on - the cursor only moves forward, so nothing is read twice
+        used to skip events persisted by an earlier phase or process
+        :param str sandbox_id:
+        :param int from_event_id:
+        :param bool error_only:
+        """
+        cursor_key = (sandbox_id, error_only)
+        if self._activity_cursors.get(cursor_key, 0) < from_event_id:
+            self._activity_cursors[cursor_key] = from_event_id
 
     def get_sandboxes(self, show_historic=False):
         # historic sandboxes are completed sandboxes
         show_historic = "true" if show_historic else "false"
 
         url = self._base_url + "/sandboxes" + "?show_historic={}".format(show_historic)
-        response = requests.get(url=url, headers=self._auth_headers)
+        response = self._send("GET", url)
         data = self._handle_res_json(response)
         return data
 
@@ -228,14 +510,19 @@ class SandboxRest(object):
         if tail:
             url += f"?tail={tail}"
 
-        response = requests.get(url=url, headers=self._auth_headers)
+        response = self._send("GET", url)
         data = self._handle_res_json(response)
         entries = data.get("entries")
-        if not entries:
-            raise Exception("API Response has no 'entries'. Response: ".format(data))
+        if entries is None:
+            raise Exception("API Response has no 'entries'. Response: {}".format(data))
         return entries
 
 
+def _is_true(value):
+    """ api returns booleans as json bools or "true" / "false" strings """
+    return str(value).lower() == "true"
+
+
 if __name__ == "__main__":
     server = "localhost"
     cs_user = "admin"
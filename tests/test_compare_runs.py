@@ -0,0 +1,79 @@
+import random
+import unittest
+
+from compare_runs import mann_whitney, two_proportion_test, bootstrap_change, get_percentiles
+
+
+class MannWhitneyTest(unittest.TestCase):
+    def test_same_sample_is_not_slower(self):
+        sample = [float(i) for i in range(1, 51)]
+        slower_probability, p = mann_whitney(sample, list(sample))
+        self.assertAlmostEqual(slower_probability, 0.5)
+        self.assertGreater(p, 0.4)
+
+    def test_shifted_candidate_is_slower(self):
+        baseline = [float(i) for i in range(1, 51)]
+        candidate = [value + 100 for value in baseline]
+        slower_probability, p = mann_whitney(baseline, candidate)
+        self.assertEqual(slower_probability, 1.0)
+        self.assertLess(p, 0.001)
+
+    def test_faster_candidate_is_not_slower(self):
+        baseline = [float(i) for i in range(101, 151)]
+        candidate = [float(i) for i in range(1, 51)]
+        slower_probability, p = mann_whitney(baseline, candidate)
+        self.assertEqual(slower_probability, 0.0)
+        self.assertGreater(p, 0.999)
+
+    def test_all_values_tied(self):
+        # zero variance once ties are corrected - no evidence either way
+        self.assertEqual(mann_whitney([5.0] * 10, [5.0] * 10), (0.5, 1.0))
+
+    def test_known_p_value(self):
+        # candidate is the larger one in 22 of 25 pairs, normal approximation with continuity correction
+        slower_probability, p = mann_whitney([1, 2, 3, 4, 5], [3.5, 4.5, 6, 7, 8])
+        self.assertAlmostEqual(slower_probability, 22 / 25.0)
+        self.assertAlmostEqual(p, 0.0301, places=3)
+
+
+class TwoProportionTest(unittest.TestCase):
+    def test_same_rate(self):
+        self.assertAlmostEqual(two_proportion_test(10, 100, 10, 100), 0.5)
+
+    def test_higher_failure_rate(self):
+        self.assertLess(two_proportion_test(5, 200, 30, 200), 0.001)
+
+    def test_lower_failure_rate(self):
+        self.assertGreater(two_proportion_test(30, 200, 5, 200), 0.999)
+
+    def test_no_failures_at_all(self):
+        self.assertEqual(two_proportion_test(0, 50, 0, 50), 1.0)
+
+
+class BootstrapChangeTest(unittest.TestCase):
+    def test_constant_samples_have_no_spread(self):
+        intervals = bootstrap_change([2.0] * 20, [5.0] * 20, get_percentiles, 200, 0.95, random.Random(0))
+        self.assertEqual(intervals, [(3.0, 3.0)] * 3)
+
+    def test_interval_covers_the_shift(self):
+        rng = random.Random(1)
+        baseline = [rng.uniform(10, 20) for _ in range(200)]
+        candidate = [value + 5 for value in baseline]
+        intervals = bootstrap_change(baseline, candidate, lambda sample: [sum(sample) / len(sample)], 500, 0.95,
+                                     random.Random(0))
+        self.assertEqual(len(intervals), 1)
+        low, high = intervals[0]
+        self.assertLess(low, 5)
+        self.assertGreater(high, 5)
+        self.assertGreater(low, 0)
+
+    def test_seeded_rng_repeats(self):
+        baseline = [float(i) for i in range(30)]
+        candidate = [float(i) * 1.5 for i in range(30)]
+        first = bootstrap_change(baseline, candidate, get_percentiles, 100, 0.9, random.Random(7))
+        second = bootstrap_change(baseline, candidate, get_percentiles, 100, 0.9, random.Random(7))
+        self.assertEqual(first, second)
+
+
+if __name__ == "__main__":
+    unittest.main()
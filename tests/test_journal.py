@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import latency
+from common import SandboxErrorData, read_json_report_sandboxes
+from journal import ResultsJournal, compact_journal, read_journal, resume_from_journal
+
+SANDBOX_NAME = "18-10-26_120000 - bp"
+
+
+def _error_event(event_id, text):
+    return {"id": event_id, "time": "2026-10-18T12:00:0{}Z".format(event_id), "event_type": "Error",
+            "event_text": text, "output": ""}
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.folder, "18-10-26_120000_bp.jsonl")
+        self.json_file_path = os.path.join(self.folder, "18-10-26_120000_bp.json")
+        self.logger = logging.getLogger("test_journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write_run(self):
+        """ two sandboxes - one Ready, one failed with errors - then a line torn by a crash """
+        journal = ResultsJournal(self.journal_path)
+        ready = SandboxErrorData("sb-ready")
+        failed = SandboxErrorData("sb-failed")
+        for sb_data in [ready, failed]:
+            sb_data.mark_time(latency.START_REQUESTED, 1000.0)
+            journal.record(sb_data)
+        ready.mark_time(latency.SETUP_FINISHED, 1030.0)
+        journal.record(ready, "Ready")
+        failed.failed_setup_stage = "Provisioning"
+        failed.mark_time(latency.SETUP_FINISHED, 1040.0)
+        journal.record_errors(failed, "setup", [_error_event(1, "Provisioning failed"), _error_event(2, "Timeout")])
+        journal.record(failed, "Error")
+        journal.close()
+        with open(self.journal_path, "a") as f:
+            f.write('{"t": 1050.0, "state": "Teardown", "sandbox": {"sandbox_id": "sb-re')
+
+    def test_torn_line_is_skipped(self):
+        self._write_run()
+        latest = read_journal(self.journal_path)
+        self.assertEqual(list(latest), ["sb-ready", "sb-failed"])
+        self.assertEqual(latest["sb-ready"]["state"], "Ready")
+        self.assertEqual(latest["sb-failed"]["state"], "Error")
+
+    def test_compact_journal(self):
+        self._write_run()
+        sandboxes = compact_journal(self.journal_path, self.json_file_path)
+        self.assertEqual([sb_data.sandbox_id for sb_data in sandboxes], ["sb-ready", "sb-failed"])
+
+        report_sandboxes = {sandbox["sandbox_id"]: sandbox for sandbox in read_json_report_sandboxes(
+            self.json_file_path)}
+        self.assertEqual(report_sandboxes["sb-failed"]["failed_setup_stage"], "Provisioning")
+        # the report has the full events back, not the references kept in memory
+        self.assertEqual([event["event_text"] for event in report_sandboxes["sb-failed"]["setup_errors"]],
+                         ["Provisioning failed", "Timeout"])
+        self.assertFalse(report_sandboxes["sb-ready"]["setup_errors"])
+        with open(self.json_file_path) as f:
+            report = json.load(f)
+        self.assertEqual(report["latency"]["phases"]["setup"]["count"], 2)
+
+    def test_resume_from_truncated_journal(self):
+        self._write_run()
+        listed_sandboxes = {
+            "sb-ready": {"name": SANDBOX_NAME, "state": "Ready"},
+            # started, but the process died before the journal write
+            "sb-lost": {"name": SANDBOX_NAME, "state": "Setup", "blueprint_id": "bp"},
+            "sb-other-run": {"name": "18-10-26_110000 - bp", "state": "Ready"},
+        }
+        journal = ResultsJournal(self.journal_path)
+        sandboxes = resume_from_journal(journal, listed_sandboxes, SANDBOX_NAME, self.logger)
+        journal.close()
+
+        self.assertEqual([sb_data.sandbox_id for sb_data in sandboxes], ["sb-ready", "sb-failed", "sb-lost"])
+        self.assertEqual(sandboxes[1].failed_setup_stage, "Provisioning")
+        # the sandbox found by name is journaled on a fresh line, not glued to the torn one
+        latest = read_journal(self.journal_path)
+        self.assertEqual(list(latest), ["sb-ready", "sb-failed", "sb-lost"])
+        self.assertEqual(latest["sb-lost"]["state"], "Setup")
+        self.assertIsNone(sandboxes[2].blueprint_id)
+
+    def test_resume_tags_mixed_workload_blueprint(self):
+        self._write_run()
+        journal = ResultsJournal(self.journal_path)
+        sandboxes = resume_from_journal(journal, {"sb-lost": {"name": SANDBOX_NAME, "blueprint_id": "bp2"}},
+                                        SANDBOX_NAME, self.logger, is_mixed_workload=True)
+        journal.close()
+        self.assertEqual(sandboxes[-1].blueprint_id, "bp2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import unittest
+
+from latency import LatencyHistogram, RELATIVE_PRECISION
+
+
+def _histogram(values):
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    return histogram
+
+
+class PercentileTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_within_bucket_precision(self):
+        histogram = _histogram([i / 10.0 for i in range(1, 1001)])
+        for percent, expected in [(50, 50.0), (90, 90.0), (99, 99.0)]:
+            value = histogram.percentile(percent)
+            self.assertGreaterEqual(value, expected)
+            self.assertLessEqual(value, expected * (1 + RELATIVE_PRECISION))
+
+    def test_top_percentile_is_exact_max(self):
+        histogram = _histogram([1.0, 2.0, 3.3333])
+        self.assertEqual(histogram.percentile(100), 3.3333)
+        self.assertEqual(histogram.max, 3.3333)
+
+    def test_values_below_a_millisecond(self):
+        histogram = _histogram([0, 0.0001])
+        self.assertEqual(histogram.min, 0.001)
+        self.assertEqual(histogram.percentile(50), 0.001)
+
+
+class MergeTest(unittest.TestCase):
+    def test_same_as_recording_everything_once(self):
+        first_values = [0.5, 1.2, 3.0, 8.5]
+        second_values = [0.2, 4.4, 60.0]
+        merged = _histogram(first_values)
+        merged.merge(_histogram(second_values))
+        expected = _histogram(first_values + second_values)
+        self.assertEqual(merged.buckets, expected.buckets)
+        self.assertEqual((merged.count, merged.min, merged.max), (expected.count, expected.min, expected.max))
+        self.assertAlmostEqual(merged.total, expected.total)
+        for percent in [50, 90, 99]:
+            self.assertEqual(merged.percentile(percent), expected.percentile(percent))
+
+    def test_empty_histograms(self):
+        histogram = LatencyHistogram()
+        histogram.merge(LatencyHistogram())
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (0, None, None))
+        histogram.merge(_histogram([2.0]))
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (1, 2.0, 2.0))
+        histogram.merge(LatencyHistogram())
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (1, 2.0, 2.0))
+
+    def test_other_is_not_changed(self):
+        other = _histogram([1.0, 2.0])
+        buckets = dict(other.buckets)
+        _histogram([3.0]).merge(other)
+        self.assertEqual(other.buckets, buckets)
+
+
+class DictRoundTripTest(unittest.TestCase):
+    def test_from_dict_of_to_dict(self):
+        histogram = _histogram([0.25, 1.0, 1.5, 12.0, 95.0])
+        # through json, as the report stores it - bucket keys come back as strings
+        restored = LatencyHistogram.from_dict(json.loads(json.dumps(histogram.to_dict())))
+        self.assertEqual(restored.buckets, histogram.buckets)
+        self.assertEqual(restored.count, histogram.count)
+        self.assertEqual((restored.min, restored.max), (0.25, 95.0))
+        self.assertAlmostEqual(restored.total, histogram.total, places=2)
+        self.assertEqual(restored.to_dict(), histogram.to_dict())
+
+    def test_empty(self):
+        restored = LatencyHistogram.from_dict(LatencyHistogram().to_dict())
+        self.assertEqual(restored.count, 0)
+        self.assertIsNone(restored.percentile(50))
+
+    def test_restored_histograms_merge(self):
+        first = _histogram([1.0, 2.0])
+        second = _histogram([4.0, 8.0])
+        merged = LatencyHistogram.from_dict(first.to_dict())
+        merged.merge(LatencyHistogram.from_dict(second.to_dict()))
+        expected = _histogram([1.0, 2.0, 4.0, 8.0])
+        self.assertEqual(merged.buckets, expected.buckets)
+        self.assertEqual(merged.percentile(50), expected.percentile(50))
+
+
+if __name__ == "__main__":
+    unittest.main()
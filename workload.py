@@ -0,0 +1,148 @@
+"""
+Mixed workloads - the blueprints of the "workload" section of run_config interleaved in one run
+launches of all blueprints share the run's connection pool, rate budget and ramp profile,
+so contention between blueprints shows up in the per blueprint stats of the json report
+"""
+import typing
+from collections import OrderedDict
+
+import latency
+
+DEFAULT_WORKLOAD_NAME = "mixed"
+
+
+class WorkloadBlueprint(typing.NamedTuple):
+    """ one blueprint of a mixed workload """
+    blueprint_id: str
+    blueprint_params: list
+    sandbox_quantity: int
+    sandbox_duration_iso_formatted: str
+    weight: float = 1
+
+
+def split_by_weight(quantity, weights):
+    """
+    largest remainder split - shares add up to quantity exactly
+    :param int quantity:
+    :param list weights:
+    :return: list of int, one per weight
+    """
+    total_weight = float(sum(weights))
+    if quantity <= 0 or not total_weight:
+        return [0] * len(weights)
+    exact = [quantity * weight / total_weight for weight in weights]
+    shares = [int(share) for share in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - shares[i], reverse=True)
+    for i in by_remainder[:quantity - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def interleave(quantities):
+    """
+    spread items evenly - copy k of an item with n copies sits (k + 0.5) / n of the way through
+    :param list quantities: copies of each item
+    :return: list of item indexes
+    """
+    positions = []
+    for index, quantity in enumerate(quantities):
+        positions.extend(((k + 0.5) / quantity, index) for k in range(quantity))
+    return [index for _, index in sorted(positions)]
+
+
+def get_workload(run_config):
+    """
+    :param RunConfig run_config:
+    :return: workload blueprints - a single blueprint run is a workload of one
+    """
+    if run_config.workload:
+        return run_config.workload
+    return (WorkloadBlueprint(blueprint_id=run_config.blueprint_id, blueprint_params=run_config.blueprint_params,
+                              sandbox_quantity=run_config.sandbox_quantity,
+                              sandbox_duration_iso_formatted=run_config.sandbox_duration_iso_formatted),)
+
+
+def get_launch_plan(run_config, resumed_sandboxes=None):
+    """
+    blueprint of every launch, each blueprint's launches spread evenly over the run
+    :param RunConfig run_config:
+    :param list resumed_sandboxes: SandboxErrorData already launched - only the missing quantity is planned
+    :return: list of WorkloadBlueprint, one per launch
+    """
+    resumed_sandboxes = resumed_sandboxes or []
+    missing_quantity = max(run_config.sandbox_quantity - len(resumed_sandboxes), 0)
+    workload = get_workload(run_config)
+    if len(workload) == 1:
+        return [workload[0]] * missing_quantity
+
+    resumed_counts = {}
+    for sb_data in resumed_sandboxes:
+        resumed_counts[sb_data.blueprint_id] = resumed_counts.get(sb_data.blueprint_id, 0) + 1
+    quantities = [max(blueprint.sandbox_quantity - resumed_counts.get(blueprint.blueprint_id, 0), 0)
+                  for blueprint in workload]
+    # resumed sandboxes the journal lost the blueprint of still count against the total
+    return [workload[index] for index in interleave(quantities)][:missing_quantity]
+
+
+def _get_blueprint_entry(sandbox_count=0, failed_setups=0, failed_teardowns=0):
+    entry = OrderedDict()
+    entry["sandboxes"] = sandbox_count
+    entry["failed_setups"] = failed_setups
+    entry["failed_teardowns"] = failed_teardowns
+    return entry
+
+
+def build_blueprint_report(sandbox_data_list):
+    """
+    sandbox counts, failures and latency per blueprint of a mixed run
+    :param list sandbox_data_list: SandboxErrorData
+    :return: json ready dict of blueprint id to stats, empty for single blueprint runs
+    """
+    by_blueprint = OrderedDict()
+    for sb_data in sandbox_data_list:
+        if sb_data.blueprint_id:
+            by_blueprint.setdefault(sb_data.blueprint_id, []).append(sb_data)
+    report = OrderedDict()
+    for blueprint_id, sandboxes in by_blueprint.items():
+        entry = _get_blueprint_entry(len(sandboxes), sum(1 for sb_data in sandboxes if sb_data.failed_setup_stage),
+                                     sum(1 for sb_data in sandboxes if sb_data.teardown_errors))
+        entry["latency"] = latency.build_latency_report(sandboxes)
+        report[blueprint_id] = entry
+    return report
+
+
+def merge_blueprint_reports(blueprint_reports):
+    """
+    combine "blueprints" sections of several json reports - e.g. one per distributed worker
+    :param list blueprint_reports: build_blueprint_report outputs
+    :return: json ready dict of blueprint id to stats
+    """
+    counts = OrderedDict()
+    latency_reports = OrderedDict()
+    for blueprint_report in blueprint_reports:
+        for blueprint_id, entry in blueprint_report.items():
+            merged = counts.setdefault(blueprint_id, _get_blueprint_entry())
+            for key in ["sandboxes", "failed_setups", "failed_teardowns"]:
+                merged[key] += entry[key]
+            latency_reports.setdefault(blueprint_id, []).append(entry["latency"])
+    for blueprint_id, merged in counts.items():
+        phases, stages = latency.merge_latency_reports(latency_reports[blueprint_id])
+        merged["latency"] = latency.get_latency_report(phases, stages)
+    return counts
+
+
+def format_blueprint_summary(sandbox_data_list, phase):
+    """
+    per blueprint latency of one phase for logging
+    :param list sandbox_data_list: SandboxErrorData
+    :param str phase: latency phase name, e.g. "setup" / "teardown"
+    :return: one line per blueprint
+    """
+    by_blueprint = OrderedDict()
+    for sb_data in sandbox_data_list:
+        by_blueprint.setdefault(sb_data.blueprint_id, []).append(sb_data)
+    lines = []
+    for blueprint_id, sandboxes in by_blueprint.items():
+        phase_histograms, _ = latency.build_latency_histograms(sandboxes)
+        lines.append("  {}: {}".format(blueprint_id, latency.format_latency_summary(phase_histograms.get(phase))))
+    return "\n".join(lines)